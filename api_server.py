@@ -7,20 +7,19 @@ load_dotenv()
 from typing import List, Optional
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
 from src.services.gemini_image_service import GeminiImageService
-from src.interface.types.external_types import (
-    GeminiBananaProImageToImageInput,
-    GeminiBananaProTextToImageInput
-)
+from src.services.artifact_sink import get_artifact_sink
 import asyncio
 import os
 import json
 import time
 import secrets
-from datetime import datetime
+import hashlib
+import math
 
 # --- Configuration & Secrets ---
 INTERNAL_API_SECRET = os.getenv("INTERNAL_API_SECRET")
@@ -28,11 +27,10 @@ if not INTERNAL_API_SECRET:
     print("⚠️  WARNING: INTERNAL_API_SECRET not set in .env! Security is compromised.")
 
 # --- Local Logging Setup ---
-# Base session ID for fallback
-SESSION_ID = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-LOG_BASE_DIR = os.path.join(os.getcwd(), "_generation_logs", SESSION_ID)
-os.makedirs(LOG_BASE_DIR, exist_ok=True)
-print(f"📂 Default logging session to: {LOG_BASE_DIR}")
+# Artifacts are written by a background thread into _generation_logs/<session>/<request>/
+# (bounded queue: when the disk can't keep up, logs are dropped instead of slowing requests)
+artifact_sink = get_artifact_sink()
+print(f"📂 Default logging session to: {artifact_sink.session_dir}")
 
 
 app = FastAPI()
@@ -96,86 +94,295 @@ class GenerateRequest(BaseModel):
 
 # --- Persona Flow Endpoints ---
 from src.interface.types.persona_types import DigitalPersona, InterpretRequest, GeneratePersonaRequest
-from src.services.gemini_text_service import GeminiTextService
-from src.services.prompt_compiler import PromptCompiler
+from src.services.gemini_text_service import GeminiTextService, InterpretBusyError
 
 text_service = GeminiTextService()
 
 @app.post("/interpret")
 async def interpret_persona(request: InterpretRequest):
+    # Async client: a slow Flash call no longer blocks the event loop (and every other route)
     try:
-        persona = text_service.interpret_persona(request.user_input)
+        persona = await text_service.interpret_persona_async(request.user_input)
         return persona
+    except InterpretBusyError as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Persona interpreter is busy, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/generate_persona")
+# Failures a client can act on keep their status on the sync routes: request rejected by
+# Vertex (400), rate limited (429: task queue full or Vertex quota), Vertex unavailable /
+# circuit open (503) or timed out (504). Anything else stays the legacy 500.
+_SYNC_PASSTHROUGH_CODES = (400, 429, 503, 504)
+SYNC_ERROR_RESPONSES = {
+    400: {"description": "Request rejected by Vertex (e.g. unsupported reference image)"},
+    429: {"description": "Task queue full or upstream quota exhausted; retry after the Retry-After header"},
+    503: {"description": "Vertex unavailable (circuit breaker open); retry after the Retry-After header"},
+    504: {"description": "Vertex did not answer within the retry deadline"},
+}
+
+@app.post("/generate_persona", responses=SYNC_ERROR_RESPONSES)
 async def generate_persona(request: GeneratePersonaRequest, raw_request: Request):
-    try:
-        # Compiler: JSON -> Professional Prompt
-        compiled_prompt = PromptCompiler.compile(request.persona)
-        
-        # Capture Transaction ID for Logging (Shared Logic with /generate)
-        transaction_id = raw_request.headers.get("X-Transaction-ID", f"unknown_{int(time.time())}")
-        
-        # Reuse existing Image Service (Text-to-Image Flow)
-        input_data = GeminiBananaProTextToImageInput(
-            prompt=compiled_prompt,
-            ratio=request.aspect_ratio,
-            image_size=request.image_size,
-            negative_prompt="low quality, bad anatomy, worst quality, unrealistic, cartoon, anime", # Standard negative
-            guidance_scale=60.0,
-            enhance_prompt=False # Compiler does the job
-        )
-        
-        result = await service.generate_image_from_text(input_data)
-
-        if not result.success:
-            raise HTTPException(status_code=500, detail=result.error or "Generation failed")
-        
-        if result.image_data:
-            # --- Local Logging: Save Artifacts ---
-            try:
-                req_dir_name = transaction_id if transaction_id else f"req_{int(time.time()*1000)}"
-                req_dir = os.path.join(LOG_BASE_DIR, req_dir_name)
-                os.makedirs(req_dir, exist_ok=True)
-                
-                # Save Metadata (The original JSON)
-                with open(os.path.join(req_dir, "persona.json"), "w", encoding="utf-8") as f:
-                    # Use json.dump with ensure_ascii=False to keep Chinese compliant
-                    json.dump(request.persona.model_dump(), f, indent=2, ensure_ascii=False)
-
-                # Save Compiled Prompt
-                with open(os.path.join(req_dir, "prompt_compiled.txt"), "w", encoding="utf-8") as f:
-                    f.write(compiled_prompt)
-
-                # Save Output Image
-                with open(os.path.join(req_dir, "output.png"), "wb") as f:
-                    f.write(result.image_data)
-                
-                print(f"✅ Saved persona log to {req_dir} (TxID: {transaction_id})")
-
-            except Exception as log_err:
-                print(f"⚠️ Failed to save local log: {log_err}")
-
-            b64_img = base64.b64encode(result.image_data).decode('utf-8')
-            return {
-                "image_data": f"data:image/png;base64,{b64_img}",
-                "compiled_prompt": compiled_prompt
-            }
-            
-        raise HTTPException(status_code=500, detail="No image data returned")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Capture Transaction ID for Logging (Shared Logic with /generate)
+    transaction_id = raw_request.headers.get("X-Transaction-ID", f"unknown_{int(time.time())}")
+    # Same queue + pipeline as /tasks/submit/persona, answered once the task is done
+    return await _run_and_wait(
+        _build_persona_worker(request, transaction_id), request.model_dump(),
+        task_type="persona", transaction_id=transaction_id, raw_request=raw_request,
+    )
 
 # --- Task Queue Integration ---
-from src.services.task_queue import task_queue, TaskStatus
+from src.services.task_queue import task_queue, TaskStatus, QueueFullError
+from src.services.task_store import create_task_store
+from src.services.task_broker import create_task_broker
+from src.services.input_resolver import get_input_resolver
+from src.services.blob_store import get_blob_store
+from src.services.generation_pipeline import GenerationPipeline, GenerationJob
+from src.services.task_dedup import TaskDeduplicator
+from src.services.task_batches import BatchRegistry
+from src.services.input_resolver import BLOB_REF_PREFIX, InputUnavailableError
+from src.services import metrics
+from src.services.config import env_int
+
+input_resolver = get_input_resolver()
+# Double clicks / proxy retries / Remix of the same payload land on one task instead of N paid calls
+task_dedup = TaskDeduplicator.from_env(task_queue)
+batch_registry = BatchRegistry.from_env(task_queue)
 
 class TaskResponse(BaseModel):
     task_id: str
     status: str
     message: str = "Task submitted"
+    queue_position: Optional[int] = None
+    reused: bool = False  # Answered with an existing task (replay / identical request): nothing new to bill
+
+def _task_lane(task_type: str, image_size: str) -> str:
+    """Priority class: 1K previews are interactive, 4K finals and persona sheets are batch work."""
+    size = str(image_size).upper()
+    if task_type == "persona" or "4K" in size:
+        return "batch"
+    if "2K" in size:
+        return "standard"
+    return "interactive"
+
+def _dedup_opted_out(raw_request: Request) -> bool:
+    # "Cache-Control: no-cache" = deliberate re-roll: don't share a running/finished identical request
+    cache_control = raw_request.headers.get("Cache-Control", "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control
+
+async def _submit_or_reject(
+    worker, metadata, task_type: str, transaction_id: str, raw_request: Request, max_running: Optional[int] = None,
+):
+    """
+    Admission control: a full pending queue becomes 429 + Retry-After instead of unbounded work.
+    Idempotent: a replayed X-Transaction-ID or an identical in-flight/recent request returns the
+    existing task. `max_running` overrides the per-user running cap for this task. Returns (task_id, reused).
+    """
+    # Set by the Next.js proxy from the session; used for fair scheduling and per-user caps
+    user_id = raw_request.headers.get("X-User-ID") or None
+    lane = _task_lane(task_type, metadata.get("image_size", "1K"))
+
+    tx_key = task_dedup.transaction_key(transaction_id, user_id)
+    content_key = None
+    if not _dedup_opted_out(raw_request):
+        # Hashes the input data URIs (possibly MBs): off the event loop
+        content_key = await run_in_threadpool(task_dedup.content_key, task_type, metadata, user_id)
+    # No awaits after find: its answer, submit and remember happen atomically on the event loop
+    existing = await task_dedup.find(tx_key, content_key)
+    if existing is not None:
+        return existing, True
+    try:
+        task_id = task_queue.submit_task(
+            worker, metadata=metadata, task_type=task_type, transaction_id=transaction_id,
+            user_id=user_id, lane=lane, max_running=max_running,
+        )
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Task queue is full, please retry later",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    task_dedup.remember(task_id, tx_key, content_key)
+    return task_id, False
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "rate_limiter": service.rate_limiter.stats(),
+        "hedging": service.hedge_policy.stats(),
+        "circuit_breaker": service.circuit_breaker.stats(),
+        "retry_policies": service.retry_policies.describe(),
+        "text_rate_limiter": text_service.rate_limiter.stats(),
+        "persona_cache": text_service.cache.stats(),
+        "task_dedup": task_dedup.stats(),
+        "task_queue": await task_queue.stats_async(),
+        "input_cache": service.input_cache.stats(),
+        "artifact_sink": artifact_sink.stats(),
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text format: per-stage latency histograms, retry counters, queue gauges (this process only)."""
+    # The queue gauges count the broker table in broker mode: render off the event loop
+    body = await run_in_threadpool(metrics.registry.render)
+    return PlainTextResponse(body, media_type=metrics.MetricsRegistry.CONTENT_TYPE)
+
+@app.on_event("startup")
+async def startup_services():
+    # TASK_BROKER=sqlite: queue + status shared by every API/worker process (see --role below)
+    broker = create_task_broker()
+    if broker is not None:
+        task_queue.attach_broker(broker)
+        task_queue.recover()
+        return
+    # Durable task records (TASK_STORE=sqlite|journal|memory); resume jobs lost by a restart
+    store = create_task_store()
+    if store is not None:
+        task_queue.attach_store(store)
+        task_queue.recover()
+
+@app.on_event("shutdown")
+async def shutdown_services():
+    # Stop queued/in-flight generations first, then release pooled upstream connections
+    await task_queue.shutdown()
+    await service.aclose()
+    await text_service.aclose()
+    await input_resolver.aclose()
+    # Write out queued generation logs before the process exits
+    await run_in_threadpool(artifact_sink.close)
+
+# RESULT_DELIVERY=datauri (default): results inline an "image_data" data URI, which clients
+# keep as thumbnails and send back as inputs. binary: the image stays once in the blob store
+# and clients fetch it from /tasks/{id}/result; that URL lives only as long as the task
+# (TASK_TTL) and its blob, so clients must copy the image if they keep it.
+RESULT_DELIVERY = os.getenv("RESULT_DELIVERY", "datauri").lower()
+
+# Every route (sync or queued) runs its generation through this one staged pipeline
+pipeline = GenerationPipeline(service, resolver=input_resolver, sink=artifact_sink)
+pipeline.add_stage_hook(
+    lambda stage, seconds, job, outcome: metrics.stage_seconds.observe(
+        seconds, stage=stage, outcome=outcome, image_size=job.image_size, aspect_ratio=job.aspect_ratio
+    )
+)
+metrics.queue_depth.set_function(lambda: task_queue.stats()["pending"])
+metrics.queue_inflight.set_function(lambda: task_queue.stats()["running"])
+metrics.vertex_circuit_state.set_function(
+    lambda: {"closed": 0, "half_open": 1, "open": 2}[service.circuit_breaker.state]
+)
+
+def _result_delivery() -> str:
+    return "ref" if RESULT_DELIVERY == "binary" else "datauri"
+
+def _generate_job(request: GenerateRequest, transaction_id: str) -> GenerationJob:
+    raw_inputs = []
+    if request.image_url: raw_inputs.append(request.image_url)
+    if request.images: raw_inputs.extend(request.images)
+    metadata = request.model_dump()
+    metadata['transaction_id'] = transaction_id
+    return GenerationJob(
+        prompt=request.prompt,
+        raw_inputs=raw_inputs,
+        aspect_ratio=request.aspect_ratio,
+        image_size=request.image_size,
+        negative_prompt=request.negative_prompt,
+        guidance_scale=request.guidance_scale,
+        enhance_prompt=request.enhance_prompt,
+        transaction_id=transaction_id,
+        log_files={"prompt.json": metadata},
+    )
+
+def _persona_job(request: GeneratePersonaRequest, transaction_id: str) -> GenerationJob:
+    return GenerationJob(
+        persona=request.persona,
+        aspect_ratio=request.aspect_ratio,
+        image_size=request.image_size,
+        transaction_id=transaction_id,
+    )
+
+def _build_generate_worker(request: GenerateRequest, transaction_id: str):
+    """Background job for /tasks/submit/generate and /generate (also rebuilt from the task store after a restart)."""
+    async def worker(progress_callback, **kwargs):
+        return await pipeline.run(_generate_job(request, transaction_id), progress_callback, delivery=_result_delivery())
+
+    return worker
+
+def _build_persona_worker(request: GeneratePersonaRequest, transaction_id: str):
+    """Background job for /tasks/submit/persona and /generate_persona (also rebuilt after a restart)."""
+    async def worker(progress_callback, **kwargs):
+        return await pipeline.run(_persona_job(request, transaction_id), progress_callback, delivery=_result_delivery())
+
+    return worker
+
+def _task_failure(task: Optional[dict]) -> HTTPException:
+    task = task or {}
+    detail = task.get("error") or task.get("message") or "Generation failed"
+    code = task.get("error_code")
+    if code not in _SYNC_PASSTHROUGH_CODES:
+        return HTTPException(status_code=500, detail=detail)
+    headers = None
+    if code in (429, 503) and task.get("retry_after") is not None:
+        headers = {"Retry-After": str(max(1, math.ceil(task["retry_after"])))}
+    return HTTPException(status_code=code, detail=detail, headers=headers)
+
+async def _run_and_wait(worker, metadata, task_type: str, transaction_id: str, raw_request: Request) -> dict:
+    """
+    Sync routes: submit through the task queue (admission control, fair scheduling, per-user
+    caps, broker workers) and wait for the outcome, then answer with the legacy inline data URI.
+    Errors: 429 when the queue is full, otherwise the failed task's status (see SYNC_ERROR_RESPONSES).
+    """
+    task_id, reused = await _submit_or_reject(worker, metadata, task_type=task_type, transaction_id=transaction_id, raw_request=raw_request)
+    sub = task_queue.subscribe([task_id])
+    try:
+        # A reused task may already be finished: then no further event will come
+        current = await task_queue.get_task_async(task_id)
+        while current is None or not task_queue.is_terminal(current["status"]):
+            event = await sub.queue.get()
+            if event["id"] == task_id:
+                current = event
+    except asyncio.CancelledError:
+        # Caller went away: don't keep generating for nobody (unless another request shares the task)
+        if not reused:
+            task_queue.cancel_task(task_id)
+        raise
+    finally:
+        task_queue.unsubscribe(sub)
+
+    task = await run_in_threadpool(task_queue.get_task_details, task_id)
+    if not task or task["status"] != TaskStatus.COMPLETED:
+        raise _task_failure(task)
+
+    result = dict(task.get("result") or {})
+    blob_id = result.pop("image_ref", None)
+    if blob_id and not result.get("image_data"):
+        image_bytes = await run_in_threadpool(get_blob_store().get, blob_id)
+        if image_bytes is None:
+            raise HTTPException(status_code=500, detail="No image data returned")
+        b64_img = await run_in_threadpool(lambda: base64.b64encode(image_bytes).decode('utf-8'))
+        result["image_data"] = f"data:{result.get('mime_type') or 'image/png'};base64,{b64_img}"
+    result.pop("mime_type", None)
+    result.pop("content_length", None)
+    if reused:
+        # Another request's generation: the proxy refunds this one
+        result["reused"] = True
+    return result
+
+async def _task_response(task_id: str, reused: bool, message: str) -> TaskResponse:
+    queued = await task_queue.get_task_async(task_id) or {}
+    if not reused:
+        return TaskResponse(task_id=task_id, status="PENDING", message=message, queue_position=queued.get("queue_position"))
+    # Same task as an identical earlier submission: report its real state
+    status = queued.get("status", TaskStatus.PENDING)
+    return TaskResponse(
+        task_id=task_id,
+        status=getattr(status, "value", status),
+        message="Identical request already submitted",
+        queue_position=queued.get("queue_position"),
+        reused=True,
+    )
 
 @app.post("/tasks/submit/generate", response_model=TaskResponse)
 async def submit_generate_task(request: GenerateRequest, raw_request: Request):
@@ -184,134 +391,13 @@ async def submit_generate_task(request: GenerateRequest, raw_request: Request):
     Returns a Task Manager ID immediately.
     """
     transaction_id = raw_request.headers.get("X-Transaction-ID", f"unknown_{int(time.time())}")
-    
-    # Define the worker function that will run in background
-    async def worker(progress_callback, **kwargs):
-        # Re-construct request context if needed (logs)
-        # We need to act as the generate_image logic here.
-        # It needs to do everything: collect inputs, call service, save logs.
-        
-        progress_callback(10, "Collecting Inputs...")
-        
-        # 1. Collect Inputs (Logic copied and adapted from original generate_image)
-        raw_inputs = []
-        if request.image_url: raw_inputs.append(request.image_url)
-        if request.images: raw_inputs.extend(request.images)
-        
-        image_inputs = []
-        for input_item in raw_inputs:
-            if input_item.startswith("data:"):
-                try:
-                    header, encoded = input_item.split(",", 1)
-                    image_inputs.append(base64.b64decode(encoded))
-                except: pass
-            elif input_item.startswith("http"):
-                # Remote URL
-                # NOTE: requests.get is sync, should ideally be async or wrapped, but okay for thread worker
-                import requests
-                resp = requests.get(input_item, timeout=30)
-                if resp.status_code == 200:
-                    image_inputs.append(resp.content)
-            else:
-                 # Local Path
-                try:
-                    if "/api/uploads/" in input_item:
-                         filename = input_item.split("/api/uploads/")[-1]
-                         possible_paths = [
-                            os.path.join("public", "uploads", filename),
-                            os.path.join(os.getcwd(), "public", "uploads", filename),
-                            os.path.join("/app", "public", "uploads", filename)
-                        ]
-                    else:
-                        clean_path = input_item.lstrip("/")
-                        possible_paths = [
-                            clean_path,
-                            os.path.join("public", clean_path),
-                            os.path.join(os.getcwd(), clean_path),
-                            os.path.join("/app", clean_path)
-                        ]
-                    
-                    for p in possible_paths:
-                        if os.path.exists(p) and os.path.isfile(p):
-                            with open(p, "rb") as f:
-                                image_inputs.append(f.read())
-                            break
-                except: pass
-
-        progress_callback(30, "正在等待 Gemini API 响应...")
-        
-        # 2. Call Service
-        # We need the service instance. Global 'service' is available in this module scope.
-        # But we need to pass the progress callback down to the service if we want valid realtime updates
-        # For now, we update before call.
-        
-        # Wrapper for service call to support passing callback if we modify service later
-        # The service.generate methods are async.
-        
-        result = None
-        if image_inputs:
-            input_data = GeminiBananaProImageToImageInput(
-                prompt=request.prompt,
-                image_url=image_inputs,
-                ratio=request.aspect_ratio,
-                image_size=request.image_size,
-                negative_prompt=request.negative_prompt,
-                guidance_scale=request.guidance_scale,
-                enhance_prompt=request.enhance_prompt
-            )
-            # Pass progress callback to service? 
-            # We haven't modified service signature yet. 
-            # We can modify service to accept 'on_progress' callback or similar.
-            # For now, let's just await. The service handles internal retries.
-            # To show "Retrying", we need to hook into the service.
-            # We will modify the service next. For now assume it works.
-            result = await service.generate_image_from_image(input_data, progress_callback=progress_callback)
-        else:
-            input_data = GeminiBananaProTextToImageInput(
-                prompt=request.prompt,
-                ratio=request.aspect_ratio,
-                image_size=request.image_size,
-                negative_prompt=request.negative_prompt,
-                guidance_scale=request.guidance_scale,
-                enhance_prompt=request.enhance_prompt
-            )
-            result = await service.generate_image_from_text(input_data, progress_callback=progress_callback)
-
-        progress_callback(90, "Processing Result...")
-        
-        if not result.success:
-            raise Exception(result.error or "Generation failed")
-        
-        if result.image_data:
-            # 3. Log Artifacts (Same logic as before)
-            try:
-                req_dir_name = transaction_id if transaction_id else f"req_{int(time.time()*1000)}"
-                req_dir = os.path.join(LOG_BASE_DIR, req_dir_name)
-                os.makedirs(req_dir, exist_ok=True)
-                
-                # Save Prompt
-                metadata = request.model_dump()
-                metadata['transaction_id'] = transaction_id
-                with open(os.path.join(req_dir, "prompt.json"), "w", encoding="utf-8") as f:
-                    json.dump(metadata, f, indent=2, ensure_ascii=False, default=str)
-                
-                # Save Output
-                with open(os.path.join(req_dir, "output.png"), "wb") as f:
-                    f.write(result.image_data)
-                    
-            except Exception as e:
-                print(f"Log error: {e}")
-
-            b64_img = base64.b64encode(result.image_data).decode('utf-8')
-            return {"image_data": f"data:image/png;base64,{b64_img}"}
-            
-        raise Exception("No image data returned")
+    worker = _build_generate_worker(request, transaction_id)
 
     # Submit to Queue
     # Pass full request data as metadata for Auto-Save
     metadata = request.model_dump()
-    task_id = task_queue.submit_task(worker, metadata=metadata)
-    return TaskResponse(task_id=task_id, status="PENDING", message="Task queued successfully")
+    task_id, reused = await _submit_or_reject(worker, metadata, task_type="generate", transaction_id=transaction_id, raw_request=raw_request)
+    return await _task_response(task_id, reused, "Task queued successfully")
 
 @app.post("/tasks/submit/persona", response_model=TaskResponse)
 async def submit_persona_task(request: GeneratePersonaRequest, raw_request: Request):
@@ -319,176 +405,319 @@ async def submit_persona_task(request: GeneratePersonaRequest, raw_request: Requ
     Async submission for Digital Human (Persona) generation.
     """
     transaction_id = raw_request.headers.get("X-Transaction-ID", f"unknown_{int(time.time())}")
+    worker = _build_persona_worker(request, transaction_id)
 
-    async def worker(progress_callback, **kwargs):
-        progress_callback(10, "Compiling Persona...")
-        
-        # 1. Compile Prompt
+    metadata = request.model_dump()
+    task_id, reused = await _submit_or_reject(worker, metadata, task_type="persona", transaction_id=transaction_id, raw_request=raw_request)
+    return await _task_response(task_id, reused, "Persona Task Queued")
+
+class BatchGenerateRequest(BaseModel):
+    images: Optional[List[str]] = None  # Shared reference images, sent once for all variants
+    variants: List[GenerateRequest]  # Prompt/config per item (own `images` are added to the shared ones)
+
+BATCH_MAX_ITEMS = env_int("BATCH_MAX_ITEMS", 16)
+# Children of one batch may run this many at once per user (TASK_USER_MAX_RUNNING still caps
+# the user's other tasks); 0 = only the worker pool limits the fan-out
+BATCH_USER_MAX_RUNNING = env_int("BATCH_USER_MAX_RUNNING", 4)
+
+async def _share_batch_inputs(images: List[str]) -> List[str]:
+    """
+    Resolve the shared data URIs once (concurrently) and store them as blob refs, so N children
+    don't carry N copies. URLs and upload names are left for each child to resolve.
+    An input that can't be decoded fails the whole batch (400) rather than N reference-less generations.
+    """
+    data_uris = [item for item in images if item.startswith("data:")]
+    if not data_uris:
+        return list(images)
+    # One call: the resolver fans out and keeps order; it also warms the input cache for every child
+    try:
+        data = await input_resolver.resolve(data_uris)
+    except InputUnavailableError as e:
+        raise HTTPException(status_code=e.status_code, detail=f"Shared images: {e}")
+    store = get_blob_store()
+    blob_ids = await asyncio.gather(*(run_in_threadpool(store.put, item) for item in data))
+    refs = iter(BLOB_REF_PREFIX + blob_id for blob_id in blob_ids)
+    return [next(refs) if item.startswith("data:") else item for item in images]
+
+@app.post("/tasks/submit/batch")
+async def submit_batch_task(request: BatchGenerateRequest, raw_request: Request):
+    """
+    Many prompt/config variants over the same reference images.
+    Each variant becomes a normal generate task (queued, fairly scheduled, rate limited, visible
+    at /tasks/{id}); the batch id groups them. Progress and partial results stream from
+    /tasks/batch/{id}/events as each child finishes.
+    Children run up to BATCH_USER_MAX_RUNNING at a time for the submitting user (default 4,
+    instead of the usual TASK_USER_MAX_RUNNING), within the shared worker pool.
+    """
+    if not request.variants:
+        raise HTTPException(status_code=400, detail="No variants given")
+    if len(request.variants) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} variants per batch")
+
+    transaction_id = raw_request.headers.get("X-Transaction-ID", f"unknown_{int(time.time())}")
+    batch_key = task_dedup.transaction_key(transaction_id, raw_request.headers.get("X-User-ID") or None)
+    existing = batch_registry.find(batch_key)
+    if existing is not None:
+        summary = await run_in_threadpool(batch_registry.summary, existing)
+        if summary is not None:
+            # Replayed submission: nothing new to bill
+            return {**summary, "reused": True}
+
+    shared = await _share_batch_inputs(request.images or [])
+    items = []
+    for index, variant in enumerate(request.variants):
+        child = variant.model_copy(update={"images": list(variant.images or []) + shared})
+        child_tx = f"{transaction_id}_{index}"
         try:
-            compiled_prompt = PromptCompiler.compile(request.persona)
-        except Exception as e:
-            raise Exception(f"Prompt Compilation Failed: {e}")
-            
-        progress_callback(30, "Generating Image...")
-
-        # 2. Call Service (Reuse generic text-to-image flow)
-        input_data = GeminiBananaProTextToImageInput(
-            prompt=compiled_prompt,
-            ratio=request.aspect_ratio,
-            image_size=request.image_size,
-            negative_prompt="low quality, bad anatomy, worst quality, unrealistic, cartoon, anime", 
-            guidance_scale=60.0,
-            enhance_prompt=False 
+            task_id, reused = await _submit_or_reject(
+                _build_generate_worker(child, child_tx), child.model_dump(),
+                task_type="generate", transaction_id=child_tx, raw_request=raw_request,
+                max_running=BATCH_USER_MAX_RUNNING,
+            )
+            items.append({"task_id": task_id, "reused": reused})
+        except HTTPException as e:
+            if e.status_code != 429:
+                raise
+            items.append({"status": "REJECTED", "error": e.detail, "retry_after": int(e.headers["Retry-After"])})
+
+    if not any(item.get("task_id") for item in items):
+        raise HTTPException(
+            status_code=429,
+            detail="Task queue is full, please retry later",
+            headers={"Retry-After": str(items[0]["retry_after"])},
         )
-        
-        result = await service.generate_image_from_text(input_data, progress_callback=progress_callback)
-        
-        progress_callback(90, "Saving Results...")
-
-        if not result.success:
-            raise Exception(result.error or "Generation failed")
-        
-        if result.image_data:
-            # 3. Log Artifacts
-            try:
-                req_dir_name = transaction_id if transaction_id else f"req_{int(time.time()*1000)}"
-                req_dir = os.path.join(LOG_BASE_DIR, req_dir_name)
-                os.makedirs(req_dir, exist_ok=True)
-                
-                # Metadata
-                with open(os.path.join(req_dir, "persona.json"), "w", encoding="utf-8") as f:
-                    json.dump(request.persona.model_dump(), f, indent=2, ensure_ascii=False)
-                
-                # Prompt
-                with open(os.path.join(req_dir, "prompt_compiled.txt"), "w", encoding="utf-8") as f:
-                    f.write(compiled_prompt)
-
-                # Image
-                with open(os.path.join(req_dir, "output.png"), "wb") as f:
-                    f.write(result.image_data)
-                    
-            except Exception as e:
-                print(f"Log error: {e}")
-
-            b64_img = base64.b64encode(result.image_data).decode('utf-8')
-            # Return complex object including metadata
-            return {
-                "image_data": f"data:image/png;base64,{b64_img}",
-                "compiled_prompt": compiled_prompt
-            }
-            
-        raise Exception("No image data returned")
+    batch_id = batch_registry.create(items, key=batch_key)
+    # One status lookup per child: broker queries in broker mode
+    return await run_in_threadpool(batch_registry.summary, batch_id)
+
+@app.get("/tasks/batch/{batch_id}")
+async def get_batch_status(batch_id: str):
+    summary = await run_in_threadpool(batch_registry.summary, batch_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return summary
+
+@app.get("/tasks/batch/{batch_id}/events")
+async def stream_batch_events(batch_id: str, request: Request):
+    """SSE for every child of a batch (same events as /tasks/events); `final` events carry each partial result."""
+    task_ids = batch_registry.task_ids(batch_id)
+    if task_ids is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return _task_event_response(task_ids, request)
+
+# Queued/running jobs are rebuilt from their stored request after a restart
+task_queue.register_handler(
+    "generate",
+    lambda record: _build_generate_worker(GenerateRequest(**record["metadata"]), record.get("transaction_id")),
+)
+task_queue.register_handler(
+    "persona",
+    lambda record: _build_persona_worker(GeneratePersonaRequest(**record["metadata"]), record.get("transaction_id")),
+)
+
+SSE_KEEPALIVE_SECONDS = 15
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@app.get("/tasks/events")
+async def stream_task_events(ids: str, request: Request):
+    """
+    Server-Sent Events stream for many tasks over one connection (?ids=a,b,c).
+    Emits `progress` events as TaskQueue.update_task runs, one `final` event per task
+    (with result_url for completed ones), and `done` once every task has finished.
+    """
+    task_ids = [t for t in ids.split(",") if t]
+    if not task_ids:
+        raise HTTPException(status_code=400, detail="No task ids given")
+    return _task_event_response(task_ids, request)
+
+def _task_event_response(task_ids: List[str], request: Request) -> StreamingResponse:
+    async def event_stream():
+        sub = task_queue.subscribe(task_ids)
+        remaining = set(task_ids)
+        try:
+            # Unknown ids (evicted / never existed) are finished right away
+            for task_id in task_ids:
+                if await task_queue.get_task_async(task_id) is None:
+                    remaining.discard(task_id)
+                    yield _sse("final", {"id": task_id, "status": "NOT_FOUND", "message": "Task not found"})
+
+            while remaining:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                if event["id"] not in remaining:
+                    continue
+                if task_queue.is_terminal(event["status"]):
+                    remaining.discard(event["id"])
+                    yield _sse("final", event)
+                else:
+                    yield _sse("progress", event)
+            yield _sse("done", {})
+        finally:
+            task_queue.unsubscribe(sub)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    metadata = request.model_dump()
-    task_id = task_queue.submit_task(worker, metadata=metadata)
-    return TaskResponse(task_id=task_id, status="PENDING", message="Persona Task Queued")
 @app.get("/tasks/{task_id}")
 async def get_task_status(task_id: str):
-    task = task_queue.get_task(task_id)
+    task = await task_queue.get_task_async(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
+
+    # Polls only get the lightweight status; the full record (result + metadata for the
+    # proxy's auto-save) is loaded from the blob store once the task has completed.
+    if task["status"] == TaskStatus.COMPLETED:
+        task = await run_in_threadpool(task_queue.get_task_details, task_id) or task
+        if isinstance(task.get("result"), dict) and task["result"].get("image_ref"):
+            task["result"]["image_url"] = f"/tasks/{task_id}/result"
     
     # Serialize for JSON response (handle specialized objects if any)
     return task
 
+RESULT_CHUNK_SIZE = 256 * 1024
+
+def _parse_range(header: str, size: int):
+    """Single 'bytes=' range -> (start, end) inclusive; None = serve everything; raises ValueError if unsatisfiable."""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None  # Multi-range isn't worth it for images: full body is a valid answer
+    start_s, _, end_s = spec.strip().partition("-")
+    if not start_s:
+        length = int(end_s)
+        if length <= 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(start_s)
+    end = min(int(end_s), size - 1) if end_s else size - 1
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+def _iter_file(path: str, start: int, length: int):
+    # Sync generator: Starlette runs it in the threadpool, chunk by chunk
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(RESULT_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def _decode_result_image(image_data: str):
+    """(bytes, sha256 hex, mime type) of a data URI result. Blocking: base64 + hash of MBs."""
+    header, encoded = image_data.split(",", 1)
+    data = base64.b64decode(encoded)
+    return data, hashlib.sha256(data).hexdigest(), header.split(";", 1)[0].replace("data:", "") or "image/png"
+
+@app.get("/tasks/{task_id}/result")
+async def get_task_result(task_id: str, request: Request):
+    """Streams the output image of a completed task (ETag = content hash, single Range supported)."""
+    task = await run_in_threadpool(task_queue.get_task_details, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if task["status"] != TaskStatus.COMPLETED:
+        raise HTTPException(status_code=409, detail=f"Task is {task['status']}")
+    result = task.get("result") or {}
+
+    if result.get("image_ref"):
+        blob_id = result["image_ref"]
+        path = get_blob_store().path(blob_id)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise HTTPException(status_code=410, detail="Result expired")
+        body_for = lambda start, length: _iter_file(path, start, length)
+        media_type = result.get("mime_type", "image/png")
+    elif str(result.get("image_data", "")).startswith("data:"):
+        # Task finished in datauri mode: decode once (off the event loop) and serve the same way
+        data, blob_id, media_type = await run_in_threadpool(_decode_result_image, result["image_data"])
+        size = len(data)
+        body_for = lambda start, length: iter([data[start:start + length]])
+    else:
+        raise HTTPException(status_code=404, detail="Task has no image result")
+
+    etag = f'"{blob_id}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private, max-age=3600"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    if byte_range is None:
+        return StreamingResponse(body_for(0, size), media_type=media_type,
+                                 headers={**headers, "Content-Length": str(size)})
+    start, end = byte_range
+    return StreamingResponse(body_for(start, end - start + 1), status_code=206, media_type=media_type,
+                             headers={**headers, "Content-Length": str(end - start + 1),
+                                      "Content-Range": f"bytes {start}-{end}/{size}"})
+
 @app.post("/tasks/{task_id}/cancel")
 async def cancel_task(task_id: str):
-    task_queue.cancel_task(task_id)
-    return {"message": "Cancellation requested"}
+    if not await run_in_threadpool(task_queue.cancel_task, task_id):
+        return {"message": "Task not found or already finished"}
+    return {"message": "Task cancelled"}
 
-@app.post("/generate")
+@app.post("/generate", responses=SYNC_ERROR_RESPONSES)
 async def generate_image_legacy(request: GenerateRequest, raw_request: Request):
     """Legacy Sync Endpoint (Retained for Face Swap or older clients)"""
     transaction_id = raw_request.headers.get("X-Transaction-ID", f"unknown_{int(time.time())}")
-    
-    # 1. Collect Inputs (Sync logic adapted from task worker)
-    raw_inputs = []
-    if request.image_url: raw_inputs.append(request.image_url)
-    if request.images: raw_inputs.extend(request.images)
-    
-    image_inputs = []
-    for input_item in raw_inputs:
-        if input_item.startswith("data:"):
-            try:
-                header, encoded = input_item.split(",", 1)
-                image_inputs.append(base64.b64decode(encoded))
-            except: pass
-        elif input_item.startswith("http"):
-            import requests # Lazy import
-            try:
-                resp = requests.get(input_item, timeout=30)
-                if resp.status_code == 200:
-                    image_inputs.append(resp.content)
-            except: pass
-        else:
-            try:
-                # Handle local paths
-                clean_path = input_item.lstrip("/")
-                possible_paths = [
-                   clean_path,
-                   os.path.join("public", clean_path),
-                   os.path.join(os.getcwd(), clean_path)
-                ] 
-                if "/api/uploads/" in input_item:
-                      filename = input_item.split("/api/uploads/")[-1]
-                      possible_paths.append(os.path.join("public", "uploads", filename))
-
-                for p in possible_paths:
-                    if os.path.exists(p) and os.path.isfile(p):
-                        with open(p, "rb") as f:
-                            image_inputs.append(f.read())
-                        break
-            except: pass
-
-    # 2. Call Service (Directly await)
-    def dummy_progress(p, m): pass # No-op callback
-    
+    # Same queue + pipeline as /tasks/submit/generate, answered once the task is done
+    return await _run_and_wait(
+        _build_generate_worker(request, transaction_id), request.model_dump(),
+        task_type="generate", transaction_id=transaction_id, raw_request=raw_request,
+    )
+
+async def _run_worker_node():
+    """--role worker: pull jobs from the shared broker, no HTTP server."""
+    await startup_services()
+    print(f"👷 Task worker running ({task_queue.max_workers} slots)")
     try:
-        if image_inputs:
-            input_data = GeminiBananaProImageToImageInput(
-                prompt=request.prompt,
-                image_url=image_inputs,
-                ratio=request.aspect_ratio,
-                image_size=request.image_size,
-                negative_prompt=request.negative_prompt,
-                guidance_scale=request.guidance_scale,
-                enhance_prompt=request.enhance_prompt
-            )
-            result = await service.generate_image_from_image(input_data, progress_callback=dummy_progress)
-        else:
-            input_data = GeminiBananaProTextToImageInput(
-                prompt=request.prompt,
-                ratio=request.aspect_ratio,
-                image_size=request.image_size,
-                negative_prompt=request.negative_prompt,
-                guidance_scale=request.guidance_scale,
-                enhance_prompt=request.enhance_prompt
-            )
-            result = await service.generate_image_from_text(input_data, progress_callback=dummy_progress)
-
-        if not result.success:
-            raise HTTPException(status_code=500, detail=result.error or "Generation failed")
-            
-        if result.image_data:
-             # Log Artifacts
-            try:
-                req_dir_name = transaction_id if transaction_id else f"req_{int(time.time()*1000)}"
-                req_dir = os.path.join(LOG_BASE_DIR, req_dir_name)
-                os.makedirs(req_dir, exist_ok=True)
-                with open(os.path.join(req_dir, "output.png"), "wb") as f:
-                    f.write(result.image_data)
-            except: pass
-            
-            b64_img = base64.b64encode(result.image_data).decode('utf-8')
-            return {"image_data": f"data:image/png;base64,{b64_img}"}
-            
-        raise HTTPException(status_code=500, detail="No image data returned")
-
-    except Exception as e:
-        # Catch-all
-        print(f"Legacy Generate Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        await asyncio.Event().wait()
+    finally:
+        await shutdown_services()
 
 if __name__ == "__main__":
-    # Host must be 127.0.0.1 for isolation
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--role", choices=["all", "api", "worker"], default="all",
+                        help="all: API + workers in one process; api: HTTP only; worker: executes queued tasks only")
+    parser.add_argument("--api-workers", type=int, default=1, help="Number of uvicorn processes serving the API")
+    args = parser.parse_args()
+
+    if args.role != "all" or args.api_workers > 1:
+        # Several processes only see the same tasks through the shared broker
+        os.environ.setdefault("TASK_BROKER", "sqlite")
+
+    if args.role == "worker":
+        try:
+            asyncio.run(_run_worker_node())
+        except KeyboardInterrupt:
+            pass
+    else:
+        if args.role == "api":
+            # Env for the spawned uvicorn processes, configure() for this one
+            os.environ["TASK_QUEUE_WORKERS"] = "0"
+            task_queue.configure(max_workers=0)
+        # Host must be 127.0.0.1 for isolation
+        if args.api_workers > 1 or args.role == "api":
+            uvicorn.run("api_server:app", host="127.0.0.1", port=8000, workers=args.api_workers)
+        else:
+            uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,353 @@
+"""
+Load benchmark for api_server.py: drives /tasks/submit/* + polling at a fixed concurrency and
+writes a machine-readable report (throughput, latency percentiles, peak RSS, event-loop lag,
+per-stage server timings from /metrics) for tracking regressions between releases.
+
+Fully offline against the mock Vertex server (starts both processes itself):
+
+    python scripts/benchmark.py --spawn --requests 200 --concurrency 20 --mock-args "--scale 0.1 --rate-429 0.02"
+
+Against an already running server:
+
+    python scripts/benchmark.py --api http://127.0.0.1:8000 --server-pid 12345 --requests 50
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import shlex
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_PERSONA = {
+    "meta": {"is_human_realistic": True},
+    "profile": {"age": 28, "gender": "Female", "ethnicity": "East Asian"},
+    "body": {"body_build": "Slim", "height_vibe": "Average"},
+    "look": {"hair_style": "Shoulder-length bob", "hair_color": "Black", "eye_color": "Dark brown", "face_feature": "Small mole under left eye"},
+    "skin": {"skin_tone": "Fair", "skin_texture": "Smooth with light freckles"},
+    "style": {"clothing": "Tailored beige trench coat", "expression": "Calm, confident", "lighting": "Soft window light"},
+}
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    def r(v):
+        return round(v, 4) if v is not None else None
+    return {
+        "count": len(values),
+        "mean": r(sum(values) / len(values)) if values else None,
+        "p50": r(percentile(values, 50)),
+        "p95": r(percentile(values, 95)),
+        "p99": r(percentile(values, 99)),
+        "max": r(max(values)) if values else None,
+    }
+
+
+def read_rss_mb(pid: int, field: str = "VmRSS") -> Optional[float]:
+    """Linux: VmRSS = current, VmHWM = peak resident set size of the process."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+    return None
+
+
+def parse_stage_histograms(text: str) -> Dict[str, Dict[str, Optional[float]]]:
+    """Per-stage mean and bucket-estimated p50/p95/p99 from imagegen_stage_seconds (all labels merged)."""
+    buckets: Dict[str, Dict[float, float]] = {}
+    sums: Dict[str, float] = {}
+    counts: Dict[str, float] = {}
+    for line in text.splitlines():
+        if not line.startswith("imagegen_stage_seconds"):
+            continue
+        name_labels, _, value = line.rpartition(" ")
+        labels = dict(
+            part.split("=", 1) for part in name_labels[name_labels.index("{") + 1:-1].split(",") if "=" in part
+        )
+        stage = labels.get("stage", '""').strip('"')
+        if name_labels.startswith("imagegen_stage_seconds_bucket"):
+            le = labels["le"].strip('"')
+            bound = math.inf if le == "+Inf" else float(le)
+            buckets.setdefault(stage, {})
+            buckets[stage][bound] = buckets[stage].get(bound, 0.0) + float(value)
+        elif name_labels.startswith("imagegen_stage_seconds_sum"):
+            sums[stage] = sums.get(stage, 0.0) + float(value)
+        elif name_labels.startswith("imagegen_stage_seconds_count"):
+            counts[stage] = counts.get(stage, 0.0) + float(value)
+
+    def estimate(cumulative: List[tuple], total: float, pct: float) -> Optional[float]:
+        target = total * pct / 100.0
+        for bound, count in cumulative:
+            if count >= target:
+                return bound if bound != math.inf else None
+        return None
+
+    report = {}
+    for stage, count in counts.items():
+        if not count:
+            continue
+        cumulative = sorted(buckets.get(stage, {}).items())
+        report[stage] = {
+            "count": int(count),
+            "mean": round(sums.get(stage, 0.0) / count, 4),
+            "p50_le": estimate(cumulative, count, 50),
+            "p95_le": estimate(cumulative, count, 95),
+            "p99_le": estimate(cumulative, count, 99),
+        }
+    return report
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.headers = {"X-Internal-Secret": os.getenv("INTERNAL_API_SECRET", "")}
+        self.mix = self._parse_mix(args.mix)
+        self.latencies: List[float] = []
+        self.submit_latencies: List[float] = []
+        self.result_fetch_latencies: List[float] = []
+        self.loop_lag: List[float] = []
+        self.outcomes: Dict[str, int] = {"COMPLETED": 0, "FAILED": 0, "CANCELLED": 0, "TIMEOUT": 0, "ERROR": 0}
+        self.rejected = 0
+        self.peak_rss_mb: Optional[float] = None
+        self._done = asyncio.Event()
+
+    @staticmethod
+    def _parse_mix(spec: str) -> List[str]:
+        kinds = []
+        for item in spec.split(","):
+            kind, _, weight = item.partition("=")
+            kinds.extend([kind.strip()] * int(weight or 1))
+        return kinds or ["generate"]
+
+    def _payload(self, kind: str, n: int) -> dict:
+        if kind == "persona":
+            return {"persona": SAMPLE_PERSONA, "image_size": self.args.image_size, "aspect_ratio": self.args.aspect_ratio}
+        return {
+            "prompt": f"benchmark shot #{n}: studio portrait, soft light",
+            "image_size": self.args.image_size,
+            "aspect_ratio": self.args.aspect_ratio,
+        }
+
+    async def _one(self, client: httpx.AsyncClient, n: int) -> None:
+        kind = self.mix[n % len(self.mix)]
+        headers = dict(self.headers, **{"X-Transaction-ID": f"bench_{n}", "X-User-ID": f"bench_user_{n % self.args.users}"})
+        started = time.perf_counter()
+        while True:
+            t = time.perf_counter()
+            resp = await client.post(f"/tasks/submit/{kind}", json=self._payload(kind, n), headers=headers)
+            self.submit_latencies.append(time.perf_counter() - t)
+            if resp.status_code != 429:
+                break
+            # Admission control: honour Retry-After like a well-behaved client
+            self.rejected += 1
+            await asyncio.sleep(min(float(resp.headers.get("Retry-After", "1")), 10.0))
+        if resp.status_code != 200:
+            self.outcomes["ERROR"] += 1
+            return
+        task_id = resp.json()["task_id"]
+
+        deadline = started + self.args.timeout
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(self.args.poll_interval)
+            task = (await client.get(f"/tasks/{task_id}", headers=self.headers)).json()
+            status = task.get("status")
+            if status in ("COMPLETED", "FAILED", "CANCELLED"):
+                break
+        else:
+            self.outcomes["TIMEOUT"] += 1
+            return
+
+        if status == "COMPLETED":
+            image_url = (task.get("result") or {}).get("image_url")
+            if image_url:
+                t = time.perf_counter()
+                await client.get(image_url, headers=self.headers)
+                self.result_fetch_latencies.append(time.perf_counter() - t)
+            self.latencies.append(time.perf_counter() - started)
+        self.outcomes[status] += 1
+
+    async def _probe_loop_lag(self, client: httpx.AsyncClient) -> None:
+        # /health is answered straight from the event loop: its latency is the loop's responsiveness
+        while not self._done.is_set():
+            t = time.perf_counter()
+            try:
+                await client.get("/health", headers=self.headers)
+                self.loop_lag.append(time.perf_counter() - t)
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+
+    async def _sample_rss(self) -> None:
+        while not self._done.is_set() and self.args.server_pid:
+            rss = read_rss_mb(self.args.server_pid)
+            if rss is not None:
+                self.peak_rss_mb = max(self.peak_rss_mb or 0.0, rss)
+            await asyncio.sleep(0.25)
+
+    async def run(self) -> dict:
+        limits = httpx.Limits(max_connections=self.args.concurrency + 4)
+        timeout = httpx.Timeout(60.0)
+        async with httpx.AsyncClient(base_url=self.args.api, limits=limits, timeout=timeout) as client, \
+                httpx.AsyncClient(base_url=self.args.api, timeout=timeout) as probe_client:
+            slots = asyncio.Semaphore(self.args.concurrency)
+
+            async def bounded(n: int) -> None:
+                async with slots:
+                    try:
+                        await self._one(client, n)
+                    except httpx.HTTPError as e:
+                        print(f"⚠️ request {n} failed: {e!r}")
+                        self.outcomes["ERROR"] += 1
+
+            samplers = [asyncio.create_task(self._probe_loop_lag(probe_client)), asyncio.create_task(self._sample_rss())]
+            started = time.perf_counter()
+            await asyncio.gather(*(bounded(n) for n in range(self.args.requests)))
+            duration = time.perf_counter() - started
+            self._done.set()
+            await asyncio.gather(*samplers, return_exceptions=True)
+
+            metrics_text = ""
+            try:
+                metrics_text = (await probe_client.get("/metrics", headers=self.headers)).text
+            except httpx.HTTPError:
+                pass
+
+        if self.args.server_pid:
+            # Kernel high-water mark covers spikes between samples
+            hwm = read_rss_mb(self.args.server_pid, "VmHWM")
+            if hwm is not None:
+                self.peak_rss_mb = max(self.peak_rss_mb or 0.0, hwm)
+
+        return {
+            "duration_s": round(duration, 3),
+            "throughput_rps": round(self.outcomes["COMPLETED"] / duration, 4) if duration else None,
+            "outcomes": self.outcomes,
+            "rejected_429": self.rejected,
+            "latency_s": summarize(self.latencies),
+            "submit_latency_s": summarize(self.submit_latencies),
+            "result_fetch_latency_s": summarize(self.result_fetch_latencies),
+            "event_loop_lag_s": summarize(self.loop_lag),
+            "peak_rss_mb": round(self.peak_rss_mb, 1) if self.peak_rss_mb is not None else None,
+            "server_stages": parse_stage_histograms(metrics_text),
+        }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _wait_ready(url: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.25)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def _spawn(args: argparse.Namespace) -> List[subprocess.Popen]:
+    """Start the mock Vertex server and api_server (memory task store, static token)."""
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "scripts", "mock_vertex_server.py"), "--port", str(args.mock_port),
+         "--warm", args.image_size, *shlex.split(args.mock_args)],
+        cwd=ROOT,
+    )
+    env = dict(
+        os.environ,
+        VERTEX_API_ENDPOINT=f"http://127.0.0.1:{args.mock_port}",
+        VERTEX_ACCESS_TOKEN="mock",
+        GOOGLE_CLOUD_PROJECT=os.getenv("GOOGLE_CLOUD_PROJECT", "bench"),
+        TASK_STORE=os.getenv("TASK_STORE", "memory"),
+    )
+    port = args.api.rsplit(":", 1)[-1].rstrip("/")
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api_server:app", "--host", "127.0.0.1", "--port", port, "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+    )
+    return [mock, api]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark api_server task endpoints")
+    parser.add_argument("--api", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10, help="Clients submitting + polling at once")
+    parser.add_argument("--users", type=int, default=4, help="Distinct X-User-ID values (fair scheduling buckets)")
+    parser.add_argument("--mix", default="generate=1", help="Task kinds and weights, e.g. generate=3,persona=1")
+    parser.add_argument("--image-size", default="1K")
+    parser.add_argument("--aspect-ratio", default="1:1")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=600.0, help="Per-task deadline in seconds")
+    parser.add_argument("--server-pid", type=int, default=None, help="api_server PID for RSS sampling (Linux)")
+    parser.add_argument("--spawn", action="store_true", help="Start the mock Vertex server and api_server")
+    parser.add_argument("--mock-port", type=int, default=8090)
+    parser.add_argument("--mock-args", default="", help="Extra arguments for mock_vertex_server.py")
+    parser.add_argument("--label", default="", help="Free-form tag stored with the results (e.g. release)")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    procs: List[subprocess.Popen] = []
+    try:
+        if args.spawn:
+            procs = _spawn(args)
+            args.server_pid = procs[1].pid
+            await _wait_ready(f"http://127.0.0.1:{args.mock_port}/stats")
+            await _wait_ready(f"{args.api}/health")
+
+        print(f"🏁 {args.requests} tasks ({args.mix}, {args.image_size} {args.aspect_ratio}) at concurrency {args.concurrency} → {args.api}")
+        results = await Benchmark(args).run()
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "label": args.label,
+        "git_commit": _git_commit(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output",)},
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    lat = results["latency_s"]
+    lag = results["event_loop_lag_s"]
+    print(f"✅ {results['outcomes']['COMPLETED']}/{args.requests} completed in {results['duration_s']}s "
+          f"({results['throughput_rps']} tasks/s, {results['rejected_429']} submit 429s)")
+    print(f"   latency p50={lat['p50']}s p95={lat['p95']}s p99={lat['p99']}s | loop lag p99={lag['p99']}s | peak RSS={results['peak_rss_mb']} MB")
+    print(f"📄 Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
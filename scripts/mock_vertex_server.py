@@ -0,0 +1,178 @@
+"""
+Local stand-in for Vertex AI `:generateContent` (image models), for load tests without quota.
+
+Returns real PNGs sized like Gemini's 1K/2K/4K outputs for the requested aspect ratio,
+after a log-normal latency, and injects 429s / 500s at configurable rates.
+
+    python scripts/mock_vertex_server.py --port 8090 --latency 1K=8,2K=12,4K=20 --rate-429 0.05
+
+Point the API at it with:
+
+    VERTEX_API_ENDPOINT=http://127.0.0.1:8090 VERTEX_ACCESS_TOKEN=mock GOOGLE_CLOUD_PROJECT=bench python api_server.py
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+# Long side / area basis of Gemini image sizes
+_BASE_PIXELS = {"1K": 1024, "2K": 2048, "4K": 4096}
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def make_png(width: int, height: int, noise: float, seed: int = 0) -> bytes:
+    """
+    RGB PNG of width x height. `noise` (0..1) is the share of random bytes per row, which sets
+    how well it compresses: ~0.5 gives file sizes in the range of real photographic outputs.
+    """
+    rng = random.Random(seed)
+    row_len = width * 3
+    noisy = int(row_len * max(0.0, min(1.0, noise)))
+    # Each row: filter byte, a smooth gradient (compresses well), then fresh random bytes
+    gradient = bytes((x * 7) & 0xFF for x in range(row_len - noisy))
+    raw = b"".join(b"\x00" + gradient + rng.randbytes(noisy) for _ in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(raw, 1))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def image_dimensions(image_size: str, aspect_ratio: str) -> tuple:
+    base = _BASE_PIXELS.get(str(image_size).upper(), 1024)
+    try:
+        w, h = (float(p) for p in aspect_ratio.split(":", 1))
+        ratio = w / h
+    except (ValueError, ZeroDivisionError):
+        ratio = 1.0
+    # Same pixel area as base x base, rounded to multiples of 16
+    width = int(round(base * math.sqrt(ratio) / 16)) * 16
+    height = int(round(base / math.sqrt(ratio) / 16)) * 16
+    return max(16, width), max(16, height)
+
+
+def parse_latency(spec: str) -> dict:
+    latency = {}
+    for item in spec.split(","):
+        size, _, seconds = item.partition("=")
+        if seconds:
+            latency[size.strip().upper()] = float(seconds)
+    return latency
+
+
+class MockVertex:
+    def __init__(self, latency: dict, sigma: float, scale: float, rate_429: float, rate_500: float, noise: float, seed: int) -> None:
+        self.latency = latency
+        self.sigma = sigma
+        self.scale = scale
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.noise = noise
+        self.rng = random.Random(seed)
+        self._bodies = {}  # (size, aspect) -> response body bytes
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "ok": 0, "429": 0, "500": 0}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def body_for(self, image_size: str, aspect_ratio: str) -> bytes:
+        key = (str(image_size).upper(), aspect_ratio)
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is None:
+                width, height = image_dimensions(*key)
+                png = make_png(width, height, self.noise, seed=zlib.crc32(repr(key).encode()))
+                body = json.dumps({
+                    "candidates": [{
+                        "content": {"role": "model", "parts": [
+                            {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(png).decode("ascii")}}
+                        ]},
+                        "finishReason": "STOP",
+                    }],
+                    "usageMetadata": {"promptTokenCount": 12, "candidatesTokenCount": 1290},
+                    "modelVersion": "mock",
+                }).encode("utf-8")
+                self._bodies[key] = body
+                print(f"🖼️  Prepared {key[0]} {key[1]} payload: {width}x{height}, PNG {len(png) / 1e6:.1f} MB, body {len(body) / 1e6:.1f} MB")
+        return body
+
+    def delay(self, image_size: str) -> float:
+        median = self.latency.get(str(image_size).upper(), self.latency.get("1K", 8.0))
+        return median * self.scale * math.exp(self.rng.gauss(0.0, self.sigma))
+
+
+def create_app(mock: MockVertex) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/{path:path}")
+    async def generate_content(path: str, request: Request):
+        if not path.endswith(":generateContent"):
+            return JSONResponse({"error": {"code": 404, "message": "Not found"}}, status_code=404)
+        payload = await request.json()
+        image_config = payload.get("generationConfig", {}).get("imageConfig", {})
+        image_size = image_config.get("imageSize", "1K")
+        aspect_ratio = image_config.get("aspectRatio", "1:1")
+
+        mock.counts["requests"] += 1
+        roll = mock.rng.random()
+        if roll < mock.rate_429:
+            mock.counts["429"] += 1
+            await asyncio.sleep(0.05 * mock.scale)
+            return JSONResponse({"error": {"code": 429, "message": "Resource exhausted", "status": "RESOURCE_EXHAUSTED"}}, status_code=429)
+
+        mock.in_flight += 1
+        mock.max_in_flight = max(mock.max_in_flight, mock.in_flight)
+        try:
+            body = await asyncio.to_thread(mock.body_for, image_size, aspect_ratio)
+            await asyncio.sleep(mock.delay(image_size))
+        finally:
+            mock.in_flight -= 1
+
+        if roll < mock.rate_429 + mock.rate_500:
+            mock.counts["500"] += 1
+            return JSONResponse({"error": {"code": 500, "message": "Internal error", "status": "INTERNAL"}}, status_code=500)
+        mock.counts["ok"] += 1
+        return Response(body, media_type="application/json")
+
+    @app.get("/stats")
+    async def stats():
+        return {**mock.counts, "in_flight": mock.in_flight, "max_in_flight": mock.max_in_flight}
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Vertex AI generateContent endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("MOCK_VERTEX_PORT", "8090")))
+    parser.add_argument("--latency", default="1K=8,2K=12,4K=20", help="Median seconds per image size")
+    parser.add_argument("--sigma", type=float, default=0.35, help="Log-normal spread of the latency")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply all latencies (e.g. 0.01 for fast runs)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--noise", type=float, default=0.5, help="0..1, higher = larger (less compressible) PNGs")
+    parser.add_argument("--seed", type=int, default=int(time.time()))
+    parser.add_argument("--warm", default="1K", help="Comma-separated sizes to pre-build at 1:1 (empty = none)")
+    args = parser.parse_args()
+
+    mock = MockVertex(parse_latency(args.latency), args.sigma, args.scale, args.rate_429, args.rate_500, args.noise, args.seed)
+    for size in filter(None, args.warm.split(",")):
+        mock.body_for(size.strip(), "1:1")
+    print(f"🧪 Mock Vertex listening on http://{args.host}:{args.port} (latency {args.latency} x{args.scale}, 429 rate {args.rate_429})")
+    uvicorn.run(create_app(mock), host=args.host, port=args.port, log_level="warning")
@@ -9,6 +9,14 @@ export const maxDuration = 600; // Increased to 600s (10min) for 4K/Retry genera
 
 type PrismaLikeError = { code?: string };
 
+// "4k=5积分 1k=1积分 2k=2积分"
+const creditCost = (size: unknown): number => {
+    const normalized = String(size || '1K').toUpperCase();
+    if (normalized.includes('4K')) return 5;
+    if (normalized.includes('2K')) return 2;
+    return 1; // Default 1K or other
+};
+
 export async function POST(req: NextRequest, { params }: { params: Promise<{ path: string[] }> }) {
     const { path } = await params;
     const pathString = path.join('/');
@@ -18,10 +26,17 @@ export async function POST(req: NextRequest, { params }: { params: Promise<{ pat
     let cost = 0;
     let userId: string | null = null;
     let shouldBill = false;
-    const transactionId = uuidv4(); // Generate Trace ID
-
-    // Only bill for generation endpoint
-    if (pathString.includes('generate')) {
+    // Trace ID: the client's id for this submission (stable across retries, so the backend can
+    // return the original task), or a fresh one for callers that don't send it
+    const clientTransactionId = req.headers.get('X-Transaction-ID');
+    const transactionId = clientTransactionId && /^[A-Za-z0-9_-]{8,64}$/.test(clientTransactionId)
+        ? clientTransactionId
+        : uuidv4();
+
+    // Only bill for generation endpoints (a batch is billed per variant)
+    const isBatch = pathString === 'tasks/submit/batch';
+    let variantCosts: number[] = [];
+    if (pathString.includes('generate') || isBatch) {
         shouldBill = true;
     }
 
@@ -49,12 +64,16 @@ export async function POST(req: NextRequest, { params }: { params: Promise<{ pat
             // Parse to find cost
             try {
                 const jsonBody = JSON.parse(bodyText);
-                const size = jsonBody.image_size || '1K';
-
-                // "4k=5积分 1k=1积分 2k=2积分"
-                if (String(size).toUpperCase().includes('4K')) cost = 5;
-                else if (String(size).toUpperCase().includes('2K')) cost = 2;
-                else cost = 1; // Default 1K or other
+                let size = jsonBody.image_size || '1K';
+
+                if (isBatch) {
+                    const variants: { image_size?: string }[] = Array.isArray(jsonBody.variants) ? jsonBody.variants : [];
+                    variantCosts = variants.map((variant) => creditCost(variant?.image_size));
+                    cost = variantCosts.reduce((sum, c) => sum + c, 0);
+                    size = `batch of ${variants.length}`;
+                } else {
+                    cost = creditCost(size);
+                }
 
                 // Check Balance
                 const user = await prisma.user.findUnique({ where: { id: userId } });
@@ -89,6 +108,12 @@ export async function POST(req: NextRequest, { params }: { params: Promise<{ pat
     }
     // --- BILLING LOGIC END ---
 
+    // Queued tasks are scheduled fairly per user, so the backend needs to know who submitted
+    if (!userId && pathString.startsWith('tasks/submit')) {
+        const session = await auth();
+        userId = session?.user?.id ?? null;
+    }
+
     // Imports needed (ensure these are at top of file, but tool might need help merging imports if not present)
     // Suggestion: I will add the imports via a separate block or rely on existing imports + add new ones if possible.
     // Actually, I should use multi_replace for imports + logic. But since I can update imports here too if I replace enough context or just add them.
@@ -114,7 +139,8 @@ export async function POST(req: NextRequest, { params }: { params: Promise<{ pat
             headers: {
                 'Content-Type': 'application/json',
                 'X-Internal-Secret': secret,
-                'X-Transaction-ID': transactionId
+                'X-Transaction-ID': transactionId,
+                ...(userId ? { 'X-User-ID': userId } : {}),
             },
             body: bodyText,
             cache: 'no-store',
@@ -144,14 +170,48 @@ export async function POST(req: NextRequest, { params }: { params: Promise<{ pat
 
             const errorText = await backendResponse.text();
             console.error(`[Proxy] [${transactionId}] Backend Error (${backendResponse.status}):`, errorText);
+            // 429 / 503 carry a Retry-After hint: pass it on so clients know when to retry
+            const retryAfter = backendResponse.headers.get('Retry-After');
             return NextResponse.json(
                 { error: `Backend failed: ${backendResponse.statusText}`, details: errorText },
-                { status: backendResponse.status }
+                { status: backendResponse.status, headers: retryAfter ? { 'Retry-After': retryAfter } : undefined }
             );
         }
 
         const data = await backendResponse.json();
 
+        // --- REFUND ON REUSE / REJECTED BATCH SLOTS ---
+        // The backend answered with an existing task (replayed transaction or identical request):
+        // that generation was billed when it was submitted. Batch variants the queue rejected
+        // (REJECTED) or shared with an existing task are refunded one by one.
+        let refund = 0;
+        let refundReason = '';
+        if (data.reused) {
+            refund = cost;
+            refundReason = `Reused ${isBatch ? 'Batch' : 'Task'} ${data.batch_id ?? data.task_id ?? ''}`;
+        } else if (isBatch && Array.isArray(data.items)) {
+            const unbilled = data.items.filter((item: { status?: string; reused?: boolean }) => item.status === 'REJECTED' || item.reused);
+            refund = unbilled.reduce((sum: number, item: { index?: number }) => sum + (variantCosts[item.index ?? -1] ?? 0), 0);
+            refundReason = `${unbilled.length} Batch Variants Rejected/Reused`;
+        }
+        if (shouldBill && userId && refund > 0) {
+            await prisma.$transaction([
+                prisma.user.update({
+                    where: { id: userId },
+                    data: { credits: { increment: refund } }
+                }),
+                prisma.creditLog.create({
+                    data: {
+                        userId: userId,
+                        amount: refund,
+                        reason: `Refund: ${refundReason} [TxID: ${transactionId}]`
+                    }
+                })
+            ]);
+            console.log(`[Billing] [${transactionId}] Refunded ${refund} credits to ${userId} (${refundReason}).`);
+        }
+        // -------------------------
+
         if (shouldBill && userId && data.image_data && !data.creationId) {
             data.persistenceStatus = 'PENDING';
         }
@@ -286,6 +346,52 @@ export async function GET(req: NextRequest, { params }: { params: Promise<{ path
     // Inject Secret even for GET requests if they exist/are protected
     const secret = process.env.INTERNAL_API_SECRET || "";
 
+    // --- TASK EVENT STREAM (SSE) ---
+    // Pass the backend's text/event-stream straight through instead of buffering it as JSON
+    if (pathString === 'tasks/events') {
+        try {
+            const streamResponse = await fetch(`${backendUrl}${req.nextUrl.search}`, {
+                cache: 'no-store',
+                headers: { 'X-Internal-Secret': secret, 'Accept': 'text/event-stream' },
+                signal: req.signal,
+            });
+            if (!streamResponse.ok || !streamResponse.body) {
+                return NextResponse.json({ error: 'Task stream unavailable' }, { status: streamResponse.status || 502 });
+            }
+            return new Response(streamResponse.body, {
+                status: 200,
+                headers: {
+                    'Content-Type': 'text/event-stream',
+                    'Cache-Control': 'no-cache, no-transform',
+                    'Connection': 'keep-alive',
+                },
+            });
+        } catch {
+            return NextResponse.json({ error: 'Proxy failed' }, { status: 502 });
+        }
+    }
+
+    // --- BINARY TASK RESULT ---
+    // Stream the image through untouched; conditional/range headers go both ways
+    if (/^tasks\/[^/]+\/result$/.test(pathString)) {
+        try {
+            const forwardHeaders: Record<string, string> = { 'X-Internal-Secret': secret };
+            for (const name of ['range', 'if-none-match', 'if-range']) {
+                const value = req.headers.get(name);
+                if (value) forwardHeaders[name] = value;
+            }
+            const resultResponse = await fetch(backendUrl, { cache: 'no-store', headers: forwardHeaders, signal: req.signal });
+            const headers = new Headers();
+            for (const name of ['content-type', 'content-length', 'content-range', 'accept-ranges', 'etag', 'cache-control']) {
+                const value = resultResponse.headers.get(name);
+                if (value) headers.set(name, value);
+            }
+            return new Response(resultResponse.body, { status: resultResponse.status, headers });
+        } catch {
+            return NextResponse.json({ error: 'Proxy failed' }, { status: 502 });
+        }
+    }
+
     try {
         const backendResponse = await fetch(backendUrl, {
             cache: 'no-store',
@@ -293,9 +399,14 @@ export async function GET(req: NextRequest, { params }: { params: Promise<{ path
         });
         const data = await backendResponse.json();
 
+        // Binary results: point the client at the proxied /tasks/{id}/result URL
+        if (data.result && typeof data.result.image_url === 'string' && data.result.image_url.startsWith('/tasks/')) {
+            data.result.image_url = `/api/py${data.result.image_url}`;
+        }
+
         // --- ASYNC TASK AUTO-SAVE ---
         // Check if this is a Task Response with COMPLETED status and Image Data
-        if (data.status === 'COMPLETED' && data.result && data.result.image_data) {
+        if (data.status === 'COMPLETED' && data.result && (data.result.image_data || data.result.image_ref)) {
             const taskId = typeof data.id === 'string' ? data.id : null;
 
             if (taskId && inFlightAsyncTaskSaves.has(taskId)) {
@@ -311,7 +422,7 @@ export async function GET(req: NextRequest, { params }: { params: Promise<{ path
                         console.log(`[Auto-Save-Async] Task ${taskId} completed. Saving...`);
 
                         // Imports
-                        const { saveImageToStorage, saveInputImageToStorage } = await import('@/lib/storage');
+                        const { saveImageToStorage, saveImageBufferToStorage, saveInputImageToStorage } = await import('@/lib/storage');
                         const { revalidatePath } = await import('next/cache');
 
                         // 0. Check for existing record to prevent Double Save
@@ -324,8 +435,20 @@ export async function GET(req: NextRequest, { params }: { params: Promise<{ path
                             data.creationId = existing.id;
                             data.persistenceStatus = 'SAVED';
                         } else {
-                            // 1. Save Result Image
-                            const outputUrl = await saveImageToStorage(data.result.image_data);
+                            // 1. Save Result Image (binary results are fetched as raw bytes, no base64)
+                            let outputUrl: string;
+                            if (data.result.image_data) {
+                                outputUrl = await saveImageToStorage(data.result.image_data);
+                            } else {
+                                const imageResponse = await fetch(`http://127.0.0.1:8000/tasks/${taskId}/result`, {
+                                    cache: 'no-store',
+                                    headers: { 'X-Internal-Secret': secret }
+                                });
+                                if (!imageResponse.ok) {
+                                    throw new Error(`Result fetch failed (${imageResponse.status})`);
+                                }
+                                outputUrl = await saveImageBufferToStorage(Buffer.from(await imageResponse.arrayBuffer()));
+                            }
 
                             // 2. Metadata Extraction
                             const metadata = data.metadata || {};
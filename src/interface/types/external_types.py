@@ -1,6 +1,6 @@
 from enum import Enum
 from typing import List, Optional, Union
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 class GeminiAspectRatio(str, Enum):
     RATIO_1_1 = "1:1"
@@ -36,10 +36,15 @@ class GeminiBananaProTextToImageInput(BaseModel):
     enhance_prompt: bool = Field(default=True, description="Enable prompt enhancement")
 
 class GeminiBananaProImageOutput(BaseModel):
+    # bytearray: the stream decoder's buffer is passed through as is instead of copied to bytes
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     status: int = Field(200, description="HTTP status code")
     success: bool = Field(True, description="Whether the operation was successful")
-    image_data: Optional[bytes] = Field(None, description="Generated image bytes")
+    image_data: Optional[Union[bytes, bytearray]] = Field(None, description="Generated image bytes")
+    mime_type: Optional[str] = Field(None, description="MIME type of image_data, as reported by the model")
     prompt: str = Field(..., description="Prompt used")
     model: str = Field(..., description="Model name used")
     error: Optional[str] = Field(None, description="Error message if any")
+    retry_after: Optional[float] = Field(None, description="Seconds to wait before retrying, if known")
     source_image_url: Optional[List[str]] = Field(None, description="Source URLs if available")
@@ -15,7 +15,15 @@ export async function saveImageToStorage(base64Data: string): Promise<string> {
     if (!base64Image) {
         throw new Error('Invalid base64 data');
     }
+    return writeImageFile(base64Image, 'base64');
+}
+
+// Binary results (GET /tasks/{id}/result) are written as-is, no base64 round trip
+export async function saveImageBufferToStorage(data: Buffer): Promise<string> {
+    return writeImageFile(data);
+}
 
+async function writeImageFile(data: string | Buffer, encoding?: BufferEncoding): Promise<string> {
     // 2. Generate unique filename
     const filename = `${uuidv4()}.png`;
     const filepath = path.join(UPLOAD_DIR, filename);
@@ -23,7 +31,7 @@ export async function saveImageToStorage(base64Data: string): Promise<string> {
     // 3. Write to disk (Railway Volume mounted at public/uploads)
     console.log(`[Storage] Writing file to: ${filepath}`);
     try {
-        await fs.promises.writeFile(filepath, base64Image, { encoding: 'base64' });
+        await fs.promises.writeFile(filepath, data, encoding ? { encoding } : undefined);
 
         // Verify write
         const stats = await fs.promises.stat(filepath);
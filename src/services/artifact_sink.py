@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.services.metrics import stage_seconds
+from src.services.config import env_float, env_int, lazy_singleton
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_LOG_ROOT = os.path.join(os.getcwd(), "_generation_logs")
+
+
+def _session_name() -> str:
+    return datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+
+class ArtifactSink:
+    """
+    Background writer for the local generation logs (_generation_logs/<session>/<request>/...).
+
+    Request handlers and task workers only hand files over with submit(); a single daemon
+    thread writes them in batches. The hand-off never blocks: when the bounded queue is
+    full the artifact set is dropped and counted in `dropped`.
+
+    Layout and retention:
+      - a session directory per process start, rotated every `rotate_hours` of uptime
+      - session directories older than `retention_days` are deleted
+      - above `max_bytes` in total, the oldest sessions are deleted until under the limit
+    Both limits default to 0 (disabled): the logs are the local library's history, so
+    deleting them is opt-in. The current session is never pruned.
+    """
+
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        max_queue: int = 256,
+        batch_size: int = 32,
+        rotate_hours: float = 24.0,
+        retention_days: float = 0.0,
+        max_bytes: int = 0,
+        prune_interval: float = 600.0,
+    ) -> None:
+        self.root = root or os.getenv("ARTIFACT_LOG_DIR", _DEFAULT_LOG_ROOT)
+        self.batch_size = max(1, batch_size)
+        self.rotate_hours = rotate_hours
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+
+        self._queue: "queue.Queue[Optional[Tuple[str, Dict[str, Any], Optional[Dict[str, str]]]]]" = queue.Queue(maxsize=max(1, max_queue))
+        self._pending = 0  # submitted but not yet written (or failed)
+        self._idle = threading.Condition()
+        self._closed = False
+
+        self.session_dir = ""
+        self._session_started = 0.0
+        self._rotate()
+        self._last_prune = 0.0
+
+        # Monitoring counters
+        self.written = 0
+        self.bytes_written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.pruned_sessions = 0
+
+        self._thread = threading.Thread(target=self._writer_loop, name="ArtifactSink-writer", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_env(cls) -> "ArtifactSink":
+        return cls(
+            max_queue=env_int("ARTIFACT_QUEUE_SIZE", 256),
+            batch_size=env_int("ARTIFACT_BATCH_SIZE", 32),
+            rotate_hours=env_float("ARTIFACT_ROTATE_HOURS", 24.0),
+            retention_days=env_float("ARTIFACT_RETENTION_DAYS", 0.0),
+            max_bytes=int(env_float("ARTIFACT_MAX_MB", 0) * 1024 * 1024),
+            prune_interval=env_float("ARTIFACT_PRUNE_INTERVAL", 600.0),
+        )
+
+    # --- Public API ---
+
+    def submit(self, request_dir: str, files: Dict[str, Any], labels: Optional[Dict[str, str]] = None) -> bool:
+        """
+        Queue `files` (name -> bytes | str | JSON-able dict/list) for <session>/<request_dir>/.
+        Never blocks; returns False (and counts a drop) if the queue is full or closed.
+        `labels` (image_size, aspect_ratio) tag the "artifact_write" stage timing.
+        """
+        if self._closed:
+            self.dropped += 1
+            return False
+        with self._idle:
+            self._pending += 1
+        try:
+            self._queue.put_nowait((request_dir, files, labels))
+        except queue.Full:
+            self._done(1)
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"Artifact queue full, dropped logs for {request_dir} ({self.dropped} dropped so far)")
+            return False
+        return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything submitted so far is on disk. Returns False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Shutdown hook: drain the queue and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        if not self.flush(timeout):
+            logger.warning(f"Artifact sink closed with {self._pending} artifact sets unwritten")
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "session_dir": self.session_dir,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "bytes_written": self.bytes_written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "pruned_sessions": self.pruned_sessions,
+        }
+
+    # --- Writer thread ---
+
+    def _writer_loop(self) -> None:
+        while True:
+            try:
+                item = self._queue.get(timeout=self.prune_interval if self.prune_interval > 0 else None)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                return
+            batch: List[Tuple[str, Dict[str, Any], Optional[Dict[str, str]]]] = [item] if item else []
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    extra = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if extra is None:
+                    stop = True
+                    break
+                batch.append(extra)
+
+            if batch:
+                if self.rotate_hours > 0 and time.time() - self._session_started >= self.rotate_hours * 3600:
+                    self._rotate()
+                for request_dir, files, labels in batch:
+                    started = time.perf_counter()
+                    self._write_one(request_dir, files)
+                    if labels is not None:
+                        stage_seconds.observe(time.perf_counter() - started, stage="artifact_write", outcome="ok", **labels)
+                self._done(len(batch))
+
+            if self.prune_interval > 0 and time.monotonic() - self._last_prune >= self.prune_interval:
+                self._last_prune = time.monotonic()
+                self._prune()
+            if stop:
+                return
+
+    def _done(self, count: int) -> None:
+        with self._idle:
+            self._pending -= count
+            if self._pending <= 0:
+                self._idle.notify_all()
+
+    def _write_one(self, request_dir: str, files: Dict[str, Any]) -> None:
+        # Request dirs come from client headers: keep them a single path component
+        safe_name = os.path.basename(request_dir.replace("\\", "/")) or f"req_{int(time.time() * 1000)}"
+        target_dir = os.path.join(self.session_dir, safe_name)
+        try:
+            os.makedirs(target_dir, exist_ok=True)
+            for name, content in files.items():
+                if isinstance(content, (dict, list)):
+                    data = json.dumps(content, indent=2, ensure_ascii=False, default=str).encode("utf-8")
+                elif isinstance(content, str):
+                    data = content.encode("utf-8")
+                else:
+                    data = content  # bytes-like (the generated image): written without a copy
+                # Temp file + rename: the local library never sees a half-written file
+                path = os.path.join(target_dir, name)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self.bytes_written += len(data)
+            self.written += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Failed to write artifacts to {target_dir}: {e}")
+
+    # --- Rotation / retention ---
+
+    def _rotate(self) -> None:
+        self.session_dir = os.path.join(self.root, _session_name())
+        os.makedirs(self.session_dir, exist_ok=True)
+        self._session_started = time.time()
+
+    def _prune(self) -> None:
+        if self.retention_days <= 0 and self.max_bytes <= 0:
+            return
+        try:
+            sessions = []
+            with os.scandir(self.root) as entries:
+                for entry in entries:
+                    if entry.is_dir() and entry.path != self.session_dir:
+                        sessions.append((entry.stat().st_mtime, entry.path))
+        except OSError as e:
+            logger.warning(f"Cannot scan {self.root} for retention: {e}")
+            return
+        sessions.sort()  # oldest first
+
+        doomed = []
+        if self.retention_days > 0:
+            cutoff = time.time() - self.retention_days * 86400
+            doomed = [path for mtime, path in sessions if mtime < cutoff]
+        if self.max_bytes > 0:
+            kept = [path for _, path in sessions if path not in doomed]
+            total = self._dir_size(self.session_dir) + sum(self._dir_size(p) for p in kept)
+            for path in kept:
+                if total <= self.max_bytes:
+                    break
+                total -= self._dir_size(path)
+                doomed.append(path)
+
+        for path in doomed:
+            shutil.rmtree(path, ignore_errors=True)
+            self.pruned_sessions += 1
+        if doomed:
+            logger.info(f"Pruned {len(doomed)} old generation log sessions from {self.root}")
+
+    @staticmethod
+    def _dir_size(path: str) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+        return total
+
+
+@lazy_singleton
+def get_artifact_sink() -> ArtifactSink:
+    return ArtifactSink.from_env()
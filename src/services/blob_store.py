@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import Optional
+
+from src.services.config import lazy_singleton
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_BLOB_DIR = os.path.join(os.getcwd(), "_blob_store")
+
+
+class BlobStore:
+    """
+    Content-addressed file store: blob id = sha256 of the bytes.
+    Files live under <root>/<id[:2]>/<id>, so identical payloads are stored once.
+    Writes are atomic (temp file + rename); old blobs are removed by prune().
+    """
+
+    def __init__(self, root: Optional[str] = None) -> None:
+        self.root = root or os.getenv("BLOB_STORE_DIR", _DEFAULT_BLOB_DIR)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, blob_id: str) -> str:
+        if len(blob_id) != 64 or not all(c in "0123456789abcdef" for c in blob_id):
+            raise ValueError(f"Invalid blob id: {blob_id!r}")
+        return os.path.join(self.root, blob_id[:2], blob_id)
+
+    def put(self, data: bytes) -> str:
+        blob_id = hashlib.sha256(data).hexdigest()
+        target = self.path(blob_id)
+        if os.path.exists(target):
+            # Already stored; refresh mtime so prune() keeps it alive
+            os.utime(target, None)
+            return blob_id
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_id
+
+    def get(self, blob_id: str) -> Optional[bytes]:
+        try:
+            with open(self.path(blob_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, blob_id: str) -> bool:
+        return os.path.exists(self.path(blob_id))
+
+    def delete(self, blob_id: str) -> None:
+        try:
+            os.remove(self.path(blob_id))
+        except FileNotFoundError:
+            pass
+
+    def prune(self, max_age_seconds: float) -> int:
+        """Delete blobs not written/touched for max_age_seconds. Returns the number removed."""
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                full_path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getmtime(full_path) < cutoff:
+                        os.remove(full_path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            logger.info(f"Pruned {removed} blobs older than {int(max_age_seconds)}s from {self.root}")
+        return removed
+
+
+@lazy_singleton
+def get_blob_store() -> BlobStore:
+    return BlobStore()
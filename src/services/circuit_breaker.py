@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from src.services.retry_policy import classify_error
+from src.services.config import env_bool, env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Causes that say the endpoint itself is unhealthy. 429 is quota (the rate limiter's
+# business), other 4xx / "no image" mean Vertex answered fine.
+_FAILURE_CAUSES = ("5xx", "timeout", "network")
+
+
+class CircuitOpenError(Exception):
+    """Call refused without touching the endpoint: the breaker is open (or its probe slots are taken)."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"Vertex image endpoint unavailable (circuit open), retry in {math.ceil(retry_after)}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open breaker fed with the outcome of every upstream call.
+
+    Closed: outcomes of the last `window` seconds are kept; once there are at least
+    `min_calls` of them and the failure rate (5xx + timeouts + network errors) reaches
+    `error_threshold`, or the timeout rate alone reaches `timeout_threshold`, it opens.
+
+    Open: every call is refused for `open_seconds`. After that it is half-open and lets
+    `probes` calls through at a time; `probe_successes` successful probes close it again,
+    a failed probe re-opens it for twice as long (up to `max_open_seconds`).
+
+    Rate-limited (429) and cancelled calls are neutral: they neither trip nor close it.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        window: float = 60.0,
+        min_calls: int = 10,
+        error_threshold: float = 0.5,
+        timeout_threshold: float = 0.3,
+        open_seconds: float = 30.0,
+        max_open_seconds: float = 300.0,
+        probes: int = 1,
+        probe_successes: int = 2,
+        wait_when_open: bool = False,
+    ) -> None:
+        self.enabled = enabled
+        self.window = max(1.0, window)
+        self.min_calls = max(1, min_calls)
+        self.error_threshold = error_threshold
+        self.timeout_threshold = timeout_threshold
+        self.open_seconds = max(0.1, open_seconds)
+        self.max_open_seconds = max(self.open_seconds, max_open_seconds)
+        self.probes = max(1, probes)
+        self.probe_successes = max(1, probe_successes)
+        # What a job does while open: fail right away (default) or wait for the probe, within its deadline
+        self.wait_when_open = wait_when_open
+
+        self._state = CLOSED
+        self._outcomes: Deque[Tuple[float, Optional[str]]] = deque()  # (monotonic time, failure cause or None)
+        self._opened_at = 0.0
+        self._open_for = self.open_seconds
+        self._probes_in_flight = 0
+        self._probe_ok = 0
+        self._lock = threading.Lock()
+
+        # Monitoring counters
+        self.trips = 0
+        self.rejected = 0
+        self.probes_sent = 0
+
+    @classmethod
+    def from_env(cls) -> "CircuitBreaker":
+        return cls(
+            enabled=env_bool("VERTEX_BREAKER", True),
+            window=env_float("VERTEX_BREAKER_WINDOW", 60.0),
+            min_calls=env_int("VERTEX_BREAKER_MIN_CALLS", 10),
+            error_threshold=env_float("VERTEX_BREAKER_ERROR_RATE", 0.5),
+            timeout_threshold=env_float("VERTEX_BREAKER_TIMEOUT_RATE", 0.3),
+            open_seconds=env_float("VERTEX_BREAKER_OPEN_SECONDS", 30.0),
+            max_open_seconds=env_float("VERTEX_BREAKER_MAX_OPEN_SECONDS", 300.0),
+            probe_successes=env_int("VERTEX_BREAKER_PROBE_SUCCESSES", 2),
+            wait_when_open=os.getenv("VERTEX_BREAKER_OPEN_ACTION", "fail").lower() == "wait",
+        )
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def check(self) -> None:
+        """Raise CircuitOpenError if a call would be refused right now. Claims nothing."""
+        with self._lock:
+            retry_after = self._refusal(time.monotonic())
+            if retry_after is not None:
+                self.rejected += 1
+        if retry_after is not None:
+            raise CircuitOpenError(retry_after)
+
+    def acquire(self) -> bool:
+        """Admit one call or raise CircuitOpenError. True = the call is a half-open probe (pass it to record)."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            retry_after = self._refusal(now)
+            if retry_after is not None:
+                self.rejected += 1
+                raise CircuitOpenError(retry_after)
+            if self._state == HALF_OPEN:
+                self._probes_in_flight += 1
+                self.probes_sent += 1
+                return True
+            return False
+
+    def record(self, exc: Optional[BaseException], probe: bool = False) -> None:
+        """Outcome of an admitted call: exc=None for success, else the exception it raised."""
+        if not self.enabled:
+            return
+        if exc is None:
+            cause = None
+        elif isinstance(exc, asyncio.CancelledError):
+            cause = "cancelled"
+        else:
+            cause = classify_error(exc)
+            if cause not in _FAILURE_CAUSES and cause != "429":
+                cause = None  # Vertex answered (4xx, no image): healthy as far as we're concerned
+        neutral = cause in ("cancelled", "429")
+
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if probe:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if state != HALF_OPEN or neutral:
+                    return
+                if cause is None:
+                    self._probe_ok += 1
+                    if self._probe_ok >= self.probe_successes:
+                        self._close()
+                else:
+                    self._trip(now, min(self.max_open_seconds, self._open_for * 2), f"probe failed ({cause})")
+                return
+
+            # Stragglers admitted before the breaker opened don't count towards recovery
+            if state != CLOSED or neutral:
+                return
+            self._outcomes.append((now, cause))
+            self._prune(now)
+            total = len(self._outcomes)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for _, c in self._outcomes if c is not None)
+            timeouts = sum(1 for _, c in self._outcomes if c == "timeout")
+            if failures / total >= self.error_threshold or timeouts / total >= self.timeout_threshold:
+                self._trip(now, self.open_seconds, f"{failures}/{total} failed, {timeouts} timed out in {self.window:.0f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            self._prune(now)
+            total = len(self._outcomes)
+            failures = sum(1 for _, c in self._outcomes if c is not None)
+            timeouts = sum(1 for _, c in self._outcomes if c == "timeout")
+            return {
+                "enabled": self.enabled,
+                "state": state,
+                "open_action": "wait" if self.wait_when_open else "fail",
+                "retry_in_s": round(max(0.0, self._opened_at + self._open_for - now), 1) if state == OPEN else 0.0,
+                "window_calls": total,
+                "error_rate": round(failures / total, 4) if total else 0.0,
+                "timeout_rate": round(timeouts / total, 4) if total else 0.0,
+                "error_threshold": self.error_threshold,
+                "timeout_threshold": self.timeout_threshold,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "probes": self.probes_sent,
+            }
+
+    # --- Internals (caller holds the lock) ---
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self._open_for:
+            self._state = HALF_OPEN
+            self._probe_ok = 0
+            logger.info("Vertex circuit breaker half-open: probing")
+        return self._state
+
+    def _refusal(self, now: float) -> Optional[float]:
+        """Seconds until a call may go through, or None if it may go now."""
+        if not self.enabled:
+            return None
+        state = self._current_state(now)
+        if state == OPEN:
+            return max(0.1, self._opened_at + self._open_for - now)
+        if state == HALF_OPEN and self._probes_in_flight >= self.probes:
+            # A probe is out: its answer decides, check back shortly
+            return min(self.open_seconds, 5.0)
+        return None
+
+    def _prune(self, now: float) -> None:
+        cutoff = now - self.window
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+
+    def _trip(self, now: float, open_for: float, reason: str) -> None:
+        self._state = OPEN
+        self._opened_at = now
+        self._open_for = open_for
+        self._probe_ok = 0
+        self._outcomes.clear()
+        self.trips += 1
+        logger.warning(f"Vertex circuit breaker open for {open_for:.0f}s: {reason}")
+
+    def _close(self) -> None:
+        self._state = CLOSED
+        self._open_for = self.open_seconds
+        self._probe_ok = 0
+        self._outcomes.clear()
+        logger.info("Vertex circuit breaker closed: probes succeeded")
@@ -0,0 +1,71 @@
+import functools
+import logging
+import os
+import threading
+from typing import Callable, List, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_TRUE = ("1", "true", "yes", "on")
+_FALSE = ("0", "false", "no", "off")
+
+
+def env_float(name: str, default: float) -> float:
+    """Float setting from the environment; unset or invalid -> default (with a warning if invalid)."""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning(f"Invalid value for {name}: {value!r}, using default {default}")
+        return default
+
+
+def env_int(name: str, default: int) -> int:
+    """Integer setting; "2.0" is accepted as 2."""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(float(value))
+    except ValueError:
+        logger.warning(f"Invalid value for {name}: {value!r}, using default {default}")
+        return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """1/true/yes/on or 0/false/no/off (any case)."""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    value = value.strip().lower()
+    if value in _TRUE:
+        return True
+    if value in _FALSE:
+        return False
+    logger.warning(f"Invalid value for {name}: {value!r}, using default {default}")
+    return default
+
+
+def lazy_singleton(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    Turn `factory` into a process-wide get_x() accessor: the instance is built on the
+    first call (not at import, so env changes before startup still apply) and shared after.
+    `get_x.reset()` drops it, for tests.
+    """
+    lock = threading.Lock()
+    holder: List[T] = []
+
+    @functools.wraps(factory)
+    def get() -> T:
+        if not holder:
+            with lock:
+                if not holder:
+                    holder.append(factory())
+        return holder[0]
+
+    get.reset = holder.clear  # type: ignore[attr-defined]
+    return get
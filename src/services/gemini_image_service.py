@@ -1,28 +1,51 @@
+import asyncio
 import base64
+import importlib.util
 import logging
 import mimetypes
 import os
 import json
-import requests
+import math
 import time
-from typing import Union, List, Dict, Any
+from typing import Union, List, Dict, Any, Optional, Tuple
+from urllib.parse import urlsplit
 
-from google import genai
-from google.genai import types
-import google.auth
-from google.auth.transport.requests import Request as GoogleAuthRequest
+import httpx
 
 from src.interface.types.external_types import (
     GeminiBananaProImageOutput,
     GeminiBananaProImageToImageInput,
     GeminiBananaProTextToImageInput,
 )
+from src.services.vertex_auth import get_vertex_token_provider
+from src.services.rate_limiter import vertex_rate_limiter
+from src.services.input_cache import detect_mime_type, get_input_cache
+from src.services.vertex_stream_parser import InlineImageStreamDecoder
+from src.services.hedging import HedgePolicy
+from src.services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from src.services.metrics import generations_total, hedges_total, retries_total, stage_seconds
+from src.services.retry_policy import NoImageError, UpstreamError, classify_error, get_retry_policies, parse_retry_after
+from src.services.config import env_float, env_int
 
 logger = logging.getLogger(__name__)
 
 # Default model configuration
 _DEFAULT_MODEL = "gemini-3-pro-image-preview"
 _DEFAULT_LOCATION = "global"
+_DEFAULT_API_ENDPOINT = "https://aiplatform.googleapis.com"
+
+# HTTP/2 comes from the 'h2' package (httpx[http2] in requirements.txt); without it the client falls back to HTTP/1.1 keep-alive.
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _call_outcome(exc: BaseException) -> str:
+    """Metrics outcome of a failed Vertex call: 429 / 5xx / timeout / network / no_image / cancelled / error."""
+    if isinstance(exc, NoImageError):
+        return "no_image"
+    if isinstance(exc, asyncio.CancelledError):
+        return "cancelled"
+    return classify_error(exc) or "error"
+
 
 class GeminiImageService:
     def __init__(self) -> None:
@@ -30,21 +53,183 @@ class GeminiImageService:
         # Ensure we use global location as discovered
         self.location = "global" 
         self.model = _DEFAULT_MODEL
-        
-        # We still keep genai client for utility or simple calls if needed, 
-        # but principal generation will use raw requests.
-        self.client = genai.Client(vertexai=True, project=self.project_id, location=self.location)
-
-    def _get_headers(self) -> Dict[str, str]:
-        """Get authenticated headers for raw request."""
-        scopes = ["https://www.googleapis.com/auth/cloud-platform"]
-        creds, _ = google.auth.default(scopes=scopes)
-        if not creds.valid:
-            creds.refresh(GoogleAuthRequest())
-        return {
-            "Authorization": f"Bearer {creds.token}",
-            "Content-Type": "application/json; charset=utf-8"
-        }
+        # Overridable so tests / load runs can point at a local stub of :generateContent
+        self.api_endpoint = os.getenv("VERTEX_API_ENDPOINT", _DEFAULT_API_ENDPOINT).rstrip("/")
+
+        # Connection pool settings for the shared async transport
+        self.max_connections = env_int("GEMINI_HTTP_MAX_CONNECTIONS", 64)
+        self.max_keepalive_connections = env_int("GEMINI_HTTP_MAX_KEEPALIVE", 32)
+        self.max_connections_per_host = env_int("GEMINI_HTTP_MAX_PER_HOST", 32)
+        self.request_timeout = env_float("GEMINI_HTTP_TIMEOUT", 180.0)
+
+        # Created lazily on the serving event loop, closed by aclose() on shutdown
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._http_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        # Process-wide cached OAuth token (resolved once, refreshed ahead of expiry)
+        self._token_provider = get_vertex_token_provider()
+        # Process-wide adaptive limiter shared by every generation call
+        self.rate_limiter = vertex_rate_limiter
+        self.input_cache = get_input_cache()
+        # Optional tail-latency hedging (VERTEX_HEDGE=1): one duplicate call past the p95
+        self.hedge_policy = HedgePolicy.from_env()
+        # Per-size timeout / attempts / deadline (RETRY_POLICY_IMAGE_<SIZE>)
+        self.retry_policies = get_retry_policies()
+        # Stops every queued job from running its own retry ladder against a degraded endpoint
+        self.circuit_breaker = CircuitBreaker.from_env()
+
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """Return the shared keep-alive client, (re)creating it if the event loop changed."""
+        loop = asyncio.get_running_loop()
+        if self._http_client is None or self._http_client.is_closed or self._http_loop is not loop:
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=60.0,
+            )
+            self._http_client = httpx.AsyncClient(
+                http2=_HTTP2_AVAILABLE,
+                limits=limits,
+                timeout=httpx.Timeout(self.request_timeout, connect=30.0),
+            )
+            self._http_loop = loop
+            self._host_slots = {}
+            logger.info(
+                f"Created Vertex HTTP client (http2={_HTTP2_AVAILABLE}, "
+                f"max_connections={self.max_connections}, per_host={self.max_connections_per_host})"
+            )
+        return self._http_client
+
+    def _host_slot(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        slot = self._host_slots.get(host)
+        if slot is None:
+            slot = asyncio.Semaphore(self.max_connections_per_host)
+            self._host_slots[host] = slot
+        return slot
+
+    async def _post_for_image(
+        self, url: str, headers: Dict[str, str], payload: Dict[str, Any], labels: Optional[Dict[str, str]] = None,
+        stage: str = "vertex", timeout: Optional[float] = None,
+    ) -> Tuple[bytearray, str]:
+        """
+        POST generateContent and stream-decode the image out of the response body.
+        Returns (image bytes, mime type); raises UpstreamError for non-200 answers (with Retry-After)
+        and NoImageError for a 200 without an image. `timeout` overrides the client default.
+        With `labels`, records the `stage` (network, incl. body transfer) and "parse" (decode)
+        stages for every attempt, failed ones included, labelled with the call's outcome.
+        """
+        client = self._get_http_client()
+        request_timeout = httpx.Timeout(timeout, connect=min(30.0, timeout)) if timeout else httpx.USE_CLIENT_DEFAULT
+        async with self._host_slot(url):
+            started = time.perf_counter()
+            parse_time = 0.0
+            streamed = False
+            outcome = "ok"
+            try:
+                async with client.stream("POST", url, headers=headers, json=payload, timeout=request_timeout) as response:
+                    if response.status_code != 200:
+                        # Error bodies are small JSON; read them whole for the message
+                        error_text = (await response.aread()).decode("utf-8", "replace")
+                        raise UpstreamError(response.status_code, error_text, parse_retry_after(response.headers.get("Retry-After")))
+                    streamed = True
+                    decoder = InlineImageStreamDecoder()
+                    async for chunk in response.aiter_bytes():
+                        t = time.perf_counter()
+                        decoder.feed(chunk)
+                        parse_time += time.perf_counter() - t
+                    t = time.perf_counter()
+                    image_bytes = decoder.result()
+                    parse_time += time.perf_counter() - t
+                if not image_bytes:
+                    raise NoImageError("No image data found in response")
+                return image_bytes, decoder.mime_type or detect_mime_type(image_bytes)
+            except BaseException as e:
+                outcome = _call_outcome(e)
+                raise
+            finally:
+                if labels is not None:
+                    stage_seconds.observe(time.perf_counter() - started - parse_time, stage=stage, outcome=outcome, **labels)
+                    if streamed:
+                        stage_seconds.observe(parse_time, stage="parse", outcome=outcome, **labels)
+
+    async def _post_hedged(
+        self, url: str, headers: Dict[str, str], payload: Dict[str, Any], labels: Dict[str, str],
+        timeout: Optional[float] = None,
+    ) -> Tuple[bytearray, str]:
+        """
+        _post_for_image with optional hedging: if the call is still outstanding after the
+        policy's delay (adaptive p95 for this size) and the size has hedge budget left, one
+        duplicate goes out through the rate limiter. The first successful answer wins and the
+        other request is cancelled (its connection closed). If both fail, the primary's error is raised.
+        """
+        image_size = labels["image_size"]
+        policy = self.hedge_policy
+        policy.record_primary(image_size)
+        delay = policy.delay_for(image_size)
+
+        started = time.perf_counter()
+        primary = asyncio.ensure_future(self._post_for_image(url, headers, payload, labels, timeout=timeout))
+        hedge = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if not done:
+                    if policy.try_acquire(image_size):
+                        logger.info(f"Vertex call outstanding for {delay:.1f}s ({image_size}), sending hedge")
+                        hedges_total.inc(outcome="sent", **labels)
+                        hedge_started = time.perf_counter()
+                        hedge = asyncio.ensure_future(self._send_hedge(url, headers, payload, labels, timeout))
+                    else:
+                        hedges_total.inc(outcome="denied", **labels)
+
+            if hedge is None:
+                image = await primary
+                policy.observe(image_size, time.perf_counter() - started)
+                return image
+
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        hedges_total.inc(outcome="won" if task is hedge else "lost", **labels)
+                        # The winner's own latency (the loser's is unknown: it was cut short)
+                        policy.observe(image_size, time.perf_counter() - (hedge_started if task is hedge else started))
+                        return task.result()
+            # Neither produced an image: the primary's error decides what happens next
+            hedges_total.inc(outcome="both_failed", **labels)
+            return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+            if hedge is not None and hedge.done() and not hedge.cancelled():
+                hedge.exception()  # retrieved: a failed loser isn't an "unhandled" error
+
+    async def _send_hedge(
+        self, url: str, headers: Dict[str, str], payload: Dict[str, Any], labels: Dict[str, str], timeout: Optional[float]
+    ) -> Tuple[bytearray, str]:
+        # A hedge is a real request against the quota, so it queues behind the limiter like any other
+        await self.rate_limiter.acquire()
+        try:
+            return await self._post_for_image(url, headers, payload, labels, stage="vertex_hedge", timeout=timeout)
+        except UpstreamError as e:
+            if e.status_code == 429:
+                self.rate_limiter.on_rate_limited(e.retry_after)
+            raise
+
+    async def aclose(self) -> None:
+        """Close the pooled HTTP client. Called from the FastAPI shutdown hook."""
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
+        self._http_loop = None
+        self._host_slots = {}
+
+    async def _get_headers(self) -> Dict[str, str]:
+        """Get authenticated headers for raw request (cached token, no per-call credential lookup)."""
+        return await self._token_provider.get_headers()
 
     def _construct_part_dict(self, image_input: Union[str, bytes]) -> Dict[str, Any]:
         """Convert image input to raw API part dictionary (camelCase)."""
@@ -52,8 +237,8 @@ class GeminiImageService:
         data_b64 = ""
 
         if isinstance(image_input, bytes):
-            mime_type = self._detect_mime_type(image_input)
-            data_b64 = base64.b64encode(image_input).decode('utf-8')
+            # Encoded once per distinct image and shared across jobs/retries (content-addressed LRU)
+            return self.input_cache.part_for(image_input)
         
         elif isinstance(image_input, str):
             if image_input.startswith("data:"):
@@ -73,15 +258,7 @@ class GeminiImageService:
         }
 
     def _detect_mime_type(self, data: bytes) -> str:
-        if data.startswith(b"\x89PNG\r\n\x1a\n"):
-            return "image/png"
-        if data.startswith(b"\xff\xd8"):
-            return "image/jpeg"
-        if data.startswith(b"GIF8"):
-            return "image/gif"
-        if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
-            return "image/webp"
-        return "image/png"
+        return detect_mime_type(data)
 
     async def generate_image_from_image(
         self, input_data: GeminiBananaProImageToImageInput, **kwargs
@@ -106,27 +283,26 @@ class GeminiImageService:
         )
 
     async def _run_generation(self, prompt: str, images: List[Union[str, bytes]], aspect_ratio: str, image_size: str, progress_callback=None) -> GeminiBananaProImageOutput:
-        # Retry Strategy: 4s * (2^n) 
-        # 0: 4s
-        # 1: 8s
-        # 2: 16s
-        # 3: 32s
-        # 4: 64s
-        # 5: 128s
-        # 6: 256s (4m) ...
-        max_retries = 10 
-        retry_delay = 4
-        
-        import asyncio
-        import functools
+        # Attempts, per-call timeout and total deadline come from the size's RetryPolicy
+        # (1K fails fast, 4K gets patience, nothing retries past an hour). Errors are classified
+        # by status code / exception type: 429 re-queues behind the shared rate limiter (which
+        # pauses everyone, honouring Retry-After); 5xx, timeouts and dropped connections back
+        # off with decorrelated jitter; anything else fails right away.
+        # While the circuit breaker is open, no call goes out: the job fails fast with a 503
+        # (or, with VERTEX_BREAKER_OPEN_ACTION=wait, waits for the breaker's probe within its deadline).
+        policy = self.retry_policies.get("image", image_size)
+        budget = policy.start()
+        labels = {"image_size": image_size, "aspect_ratio": aspect_ratio}
 
-        for attempt in range(max_retries + 1):
+        while True:
+            attempt = budget.attempt
             try:
-                logger.info(f"Generating image with {self.model} (Native {image_size})... Attempt {attempt + 1}")
-                if attempt > 0 and progress_callback:
-                    progress_callback(50, f"Generating... (Attempt {attempt + 1}/{max_retries})")
+                logger.info(f"Generating image with {self.model} (Native {image_size})... Attempt {attempt}/{policy.max_attempts}")
+                if attempt > 1 and progress_callback:
+                    progress_callback(50, f"Generating... (Attempt {attempt}/{policy.max_attempts})")
                 
                 # 1. Build Payload
+                build_started = time.perf_counter()
                 parts = [{"text": prompt}]
                 if images:
                     for img in images:
@@ -146,89 +322,100 @@ class GeminiImageService:
                     }
                 }
 
+                stage_seconds.observe(time.perf_counter() - build_started, stage="payload_build", outcome="ok", **labels)
+
                 # 2. Send Request (Non-blocking)
-                url = f"https://aiplatform.googleapis.com/v1beta1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.model}:generateContent"
+                url = f"{self.api_endpoint}/v1beta1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.model}:generateContent"
                 
                 # Debug: Print payload for troubleshooting
                 logger.info(f"[DEBUG] API URL: {url}")
                 logger.info(f"[DEBUG] Payload: aspectRatio={aspect_ratio}, imageSize={image_size}, num_images={len(images) if images else 0}")
                 
-                # Run sync requests in thread pool to avoid blocking asyncio loop
-                loop = asyncio.get_running_loop()
-                # Reduced timeout to 180s to fail fast
-                # But since we are backend async now, we can tolerate longer timeouts if needed, 
-                # but standard HTTP request timeout is good.
-                call_request = functools.partial(requests.post, url, headers=self._get_headers(), json=payload, timeout=180)
-                response = await loop.run_in_executor(None, call_request)
-
-                if response.status_code == 429:
-                    raise ValueError(f"API Error 429: Rate limit exceeded")
-                
-                if response.status_code != 200:
-                    raise ValueError(f"API Error {response.status_code}: {response.text}")
+                # Don't even queue for a rate-limit slot while the endpoint is known to be down
+                self.circuit_breaker.check()
 
-                # 3. Parse Response
-                rjson = response.json()
-                image_bytes = None
-                
-                candidates = rjson.get("candidates", [])
-                for cand in candidates:
-                    content = cand.get("content", {})
-                    c_parts = content.get("parts", [])
-                    for part in c_parts:
-                        inline = part.get("inlineData", {})
-                        if "data" in inline:
-                            image_bytes = base64.b64decode(inline["data"])
-                            break
-                    if image_bytes: break
+                # Wait for our slot in the process-wide limiter (FIFO, adaptive QPS); the wait
+                # counts against the deadline like everything else
+                limiter_started = time.perf_counter()
+                await asyncio.wait_for(self.rate_limiter.acquire(), timeout=max(0.001, budget.remaining()))
+                stage_seconds.observe(time.perf_counter() - limiter_started, stage="rate_limit", outcome="ok", **labels)
 
-                if not image_bytes:
-                    raise ValueError("No image data found in response")
+                # Native async request over the shared keep-alive pool (no executor thread per call).
+                # 3. Parse Response: the body is scanned as it streams in and the base64 image is
+                # decoded chunk by chunk, so only the decoded bytes are ever held in memory.
+                auth_started = time.perf_counter()
+                headers = await self._get_headers()
+                stage_seconds.observe(time.perf_counter() - auth_started, stage="auth", outcome="ok", **labels)
+                probe = self.circuit_breaker.acquire()
+                try:
+                    image_bytes, mime_type = await self._post_hedged(url, headers, payload, labels, timeout=budget.attempt_timeout())
+                except BaseException as e:
+                    self.circuit_breaker.record(e, probe)
+                    raise
+                self.circuit_breaker.record(None, probe)
 
+                self.rate_limiter.on_success()
+                generations_total.inc(outcome="success", **labels)
                 return GeminiBananaProImageOutput(
                     success=True,
                     status=200,
                     image_data=image_bytes,
+                    mime_type=mime_type,
                     prompt=prompt,
                     model=self.model,
                 )
 
-            except Exception as e:
-                is_rate_limit = "429" in str(e) or "Resource exhausted" in str(e) or "Quota exceeded" in str(e)
-                is_timeout = "Read timed out" in str(e) or "ConnectTimeout" in str(e) or "TimeoutError" in str(e)
-                
-                if attempt < max_retries and (is_rate_limit or is_timeout):
-                    sleep_time = retry_delay * (2 ** attempt)
-                    reason = "API Limit Hit (429)" if is_rate_limit else "Request Timeout"
-                    msg = f"{reason}. Retrying in {sleep_time}s... ({attempt + 1}/{max_retries})"
-                    logger.warning(msg)
-                    
+            except CircuitOpenError as e:
+                if self.circuit_breaker.wait_when_open and e.retry_after < budget.remaining():
+                    logger.warning(f"Vertex circuit open, waiting {math.ceil(e.retry_after)}s for the probe... ({attempt}/{policy.max_attempts})")
                     if progress_callback:
-                        # Allow user to see we are waiting
-                        progress_callback(50, f"Waiting... {reason} ({sleep_time}s retry)")
-                        
-                    # Use async sleep!
-                    await asyncio.sleep(sleep_time)
+                        progress_callback(50, f"Waiting... Vertex unavailable (circuit open), next check in {math.ceil(e.retry_after)}s")
+                    await asyncio.sleep(e.retry_after)
                     continue
-                
-                # If it's not a retryable error, or we ran out of retries
-                if attempt == max_retries or not (is_rate_limit or is_timeout):
-                    logger.exception(f"Generation failed on attempt {attempt + 1}: {str(e)}")
+                logger.warning(f"Generation rejected on attempt {attempt}: {e}")
+                generations_total.inc(outcome="rejected", **labels)
+                return GeminiBananaProImageOutput(
+                    success=False,
+                    status=503,
+                    prompt=prompt,
+                    model=self.model,
+                    error=f"Generation failed: {e}",
+                    retry_after=e.retry_after,
+                )
+
+            except Exception as e:
+                if isinstance(e, UpstreamError) and e.status_code == 429:
+                    self.rate_limiter.on_rate_limited(e.retry_after)
+
+                decision = budget.next_retry(e)
+                if decision is None:
+                    logger.exception(f"Generation failed on attempt {attempt} ({time.monotonic() - budget.started:.0f}s elapsed): {str(e)}")
+                    generations_total.inc(outcome="failure", **labels)
                     return GeminiBananaProImageOutput(
                         success=False,
-                        status=500,
+                        status=getattr(e, "status_code", 504 if classify_error(e) == "timeout" else 500),
                         prompt=prompt,
                         model=self.model,
-                        error=f"Generation failed: {str(e)}",
+                        error=f"Generation failed: {str(e) or type(e).__name__}",
+                        retry_after=getattr(e, "retry_after", None),
                     )
-        
-        return GeminiBananaProImageOutput(
-            success=False,
-            status=500,
-            prompt=prompt,
-            model=self.model,
-            error="Unexpected generation failure",
-        )
+
+                cause, sleep_time = decision
+                retries_total.inc(cause=cause, **labels)
+                if cause == "429":
+                    # No private backoff: re-enter the shared limiter queue, which has already
+                    # lowered its rate and paused everyone for a (jittered) cooldown.
+                    logger.warning(f"API Limit Hit (429). Re-queued behind rate limiter... ({attempt}/{policy.max_attempts})")
+                    if progress_callback:
+                        progress_callback(50, f"Waiting... API Limit Hit (429), queued at {self.rate_limiter.rate:.2f} req/s")
+                else:
+                    reason = {"5xx": "Server Error", "timeout": "Request Timeout", "network": "Connection Error"}[cause]
+                    logger.warning(f"{reason}: {str(e) or type(e).__name__}. Retrying in {sleep_time:.1f}s... ({attempt}/{policy.max_attempts})")
+                    if progress_callback:
+                        # Allow user to see we are waiting
+                        progress_callback(50, f"Waiting... {reason} ({sleep_time:.0f}s retry)")
+                if sleep_time > 0:
+                    await asyncio.sleep(sleep_time)
 
     def _log_generation_assets(self, prompt: str, images: List[Union[str, bytes]], output_bytes: bytes):
         """Debug Utility: Save generation assets to local disk for inspection."""
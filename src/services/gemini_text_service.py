@@ -1,31 +1,220 @@
 import os
 import json
+import asyncio
+import hashlib
 import logging
+from typing import Dict, Optional
+
 from google import genai
 from google.genai import types
 from src.interface.types.persona_types import DigitalPersona
+from src.services.persona_cache import PersonaCache, get_persona_cache, normalize_text
+from src.services.rate_limiter import vertex_text_rate_limiter
+from src.services.retry_policy import classify_error, get_retry_policies
+from src.services.config import env_int
 
 logger = logging.getLogger(__name__)
 
+
+class InterpretBusyError(Exception):
+    """Too many interpretations already waiting for a slot."""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Persona interpreter is busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
 class GeminiTextService:
-    def __init__(self):
+    def __init__(self, cache: Optional[PersonaCache] = None):
         self.project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
         self.location = "us-central1" # Flash is often in us-central1 or global, let's try global if strictly needed, but SDK usually handles it.
         # Actually, let's stick to what image service uses or default.
         # For Flash 2.0 experimental, it might be specific.
         # Let's assume standard 'gemini-2.0-flash-exp' is available.
         
-        self.client = genai.Client(vertexai=True, project=self.project_id, location=self.location)
+        # Per-call timeout (the SDK keeps one pooled httpx client per sync/async side, so
+        # connections are reused). Retries are ours, from the shared policy engine.
+        self.retry_policy = get_retry_policies().get("text")
+        self.request_timeout = self.retry_policy.attempt_timeout
+        self.client = genai.Client(
+            vertexai=True, project=self.project_id, location=self.location,
+            http_options=types.HttpOptions(timeout=int(self.request_timeout * 1000)),
+        )
         # Switching to Gemini 2.5 Flash as requested (Note: This version may not exist)
         self.model_name = "gemini-2.5-flash" 
 
+        # Text model quota is separate from the image model's; 429s pace this limiter only
+        self.rate_limiter = vertex_text_rate_limiter
+        # /interpret concurrency: at most max_concurrency calls in flight, max_waiting queued
+        self.max_concurrency = env_int("INTERPRET_MAX_CONCURRENCY", 4)
+        self.max_waiting = env_int("INTERPRET_MAX_WAITING", 32)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._slots_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._waiting = 0
+        self._config: Optional[types.GenerateContentConfig] = None
+
+        # Repeated Magic Input strings are answered from the cache; identical in-flight
+        # requests share one model call
+        self.cache = cache or get_persona_cache()
+        self.cache_namespace = f"{self.model_name}:{self._schema_version()}"
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def _schema_version() -> str:
+        # Changes whenever the persona schema or the instruction changes, so old cache entries stop matching
+        schema = json.dumps(DigitalPersona.model_json_schema(), sort_keys=True)
+        return hashlib.sha256((schema + _SYSTEM_INSTRUCTION).encode("utf-8")).hexdigest()[:12]
+
+    def _get_config(self) -> types.GenerateContentConfig:
+        # The schema is resolved once, not on every request
+        if self._config is None:
+            from src.lib.schema_utils import resolve_pydantic_schema
+            self._config = types.GenerateContentConfig(
+                system_instruction=_SYSTEM_INSTRUCTION,
+                response_mime_type="application/json",
+                response_schema=resolve_pydantic_schema(DigitalPersona),
+                temperature=0.7, # Allow some creativity for "Invention"
+            )
+        return self._config
+
+    @staticmethod
+    def _parse_response(response) -> DigitalPersona:
+        # The SDK with response_schema should return a parsed object or text that strictly adheres.
+        # We can access parsed content if using pydantic in newer SDKs, but let's parse text to be safe across versions.
+        if not response.text:
+            raise ValueError("Empty response from Gemini")
+
+        # Parse JSON, then validate with Pydantic
+        data = json.loads(response.text)
+        return DigitalPersona(**data)
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._slots_loop = loop
+        return self._slots
+
+    async def interpret_persona_async(self, user_text: str) -> DigitalPersona:
+        """
+        Non-blocking interpret_persona for the /interpret endpoint (SDK async client, event loop stays free).
+        Raises InterpretBusyError when `max_waiting` callers are already queued for a slot.
+        """
+        cached = self.cache.get(self.cache_namespace, user_text)
+        if cached is not None:
+            return DigitalPersona(**cached)
+
+        key = normalize_text(user_text)
+        while key in self._inflight:
+            # Same text is already being interpreted: wait for that call instead of paying twice
+            pending = self._inflight[key]
+            try:
+                data = await asyncio.shield(pending)
+                return DigitalPersona(**data)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The first caller went away mid-call; take over
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            persona = await self._interpret_limited(user_text)
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody else may be waiting; don't let the loop log "exception never retrieved"
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            data = persona.model_dump()
+            self.cache.put(self.cache_namespace, user_text, data)
+            future.set_result(data)
+            return persona
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _interpret_limited(self, user_text: str) -> DigitalPersona:
+        slots = self._get_slots()
+        if slots.locked() and self._waiting >= self.max_waiting:
+            raise InterpretBusyError(retry_after=max(1, int(self.request_timeout // 4)))
+        self._waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            return await self._interpret_with_retries(user_text)
+        finally:
+            slots.release()
+
+    async def _interpret_with_retries(self, user_text: str) -> DigitalPersona:
+        prompt = f"User Intent: {user_text}"
+        config = self._get_config()
+        # Same policy engine as image generation (RETRY_POLICY_TEXT): typed error classes,
+        # decorrelated jitter, one deadline for limiter waits, calls and back-off together
+        budget = self.retry_policy.start()
+        while True:
+            try:
+                await asyncio.wait_for(self.rate_limiter.acquire(), timeout=max(0.001, budget.remaining()))
+                response = await asyncio.wait_for(
+                    self.client.aio.models.generate_content(
+                        model=self.model_name,
+                        contents=prompt,
+                        config=config,
+                    ),
+                    timeout=budget.attempt_timeout(),
+                )
+                self.rate_limiter.on_success()
+                return self._parse_response(response)
+            except Exception as e:
+                if classify_error(e) == "429":
+                    # Same as image generation: the shared limiter slows down and pauses, we re-queue behind it
+                    self.rate_limiter.on_rate_limited()
+                decision = budget.next_retry(e)
+                if decision is None:
+                    logger.error(f"Interpretation failed: {str(e) or type(e).__name__}")
+                    raise
+                cause, sleep_time = decision
+                logger.warning(f"Interpret failed ({cause}), retrying in {sleep_time:.1f}s ({budget.attempt - 1}/{self.retry_policy.max_attempts})")
+                if sleep_time > 0:
+                    await asyncio.sleep(sleep_time)
+
     def interpret_persona(self, user_text: str) -> DigitalPersona:
         """
         Interprets unstructured text into a strict DigitalPersona JSON structure.
-        Uses Gemini 2.0 Flash with low temperature for stability.
+        Blocking version for scripts; the API uses interpret_persona_async.
         """
-        
-        system_instruction = """
+        cached = self.cache.get(self.cache_namespace, user_text)
+        if cached is not None:
+            return DigitalPersona(**cached)
+        prompt = f"User Intent: {user_text}"
+
+        try:
+            response = self.client.models.generate_content(
+                model=self.model_name,
+                contents=prompt,
+                config=self._get_config(),
+            )
+            persona = self._parse_response(response)
+            self.cache.put(self.cache_namespace, user_text, persona.model_dump())
+            return persona
+
+        except Exception as e:
+            logger.error(f"Interpretation failed: {e}")
+            # Fallback or re-raise
+            raise e
+
+    async def aclose(self) -> None:
+        """Close the SDK's pooled async HTTP client. Called from the FastAPI shutdown hook."""
+        try:
+            await self.client.aio.aclose()
+        except Exception as e:
+            logger.debug(f"Text client close failed: {e}")
+
+
+_SYSTEM_INSTRUCTION = """
         You are a world-class Character Design Expert and Digital Human Architect.
         Your goal is to translate the user's vague or specific description into a COMPLETE, PROFESSIONAL, and BIOLOGICALLY CONSISTENT character specification.
 
@@ -49,39 +238,3 @@ class GeminiTextService:
             * *Example for Avatar:* "Na'vi Humanoid"
             * *Example for Elf:* "High-Fantasy Elven Figure"
         """
-
-        prompt = f"User Intent: {user_text}"
-
-        # Prepare Schema
-        from src.lib.schema_utils import resolve_pydantic_schema
-        final_schema = resolve_pydantic_schema(DigitalPersona)
-
-        try:
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    system_instruction=system_instruction,
-                    response_mime_type="application/json",
-                    response_schema=final_schema,
-                    temperature=0.7, # Allow some creativity for "Invention"
-                )
-            )
-            
-            # The SDK with response_schema should return a parsed object or text that strictly adheres.
-            # We can access parsed content if using pydantic in newer SDKs, but let's parse text to be safe across versions.
-            
-            if not response.text:
-                raise ValueError("Empty response from Gemini")
-
-            # Parse JSON
-            data = json.loads(response.text)
-            
-            # Validate with Pydantic
-            persona = DigitalPersona(**data)
-            return persona
-
-        except Exception as e:
-            logger.error(f"Interpretation failed: {e}")
-            # Fallback or re-raise
-            raise e
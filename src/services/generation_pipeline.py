@@ -0,0 +1,217 @@
+import asyncio
+import base64
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from src.interface.types.external_types import (
+    GeminiBananaProImageToImageInput,
+    GeminiBananaProTextToImageInput,
+)
+from src.interface.types.persona_types import DigitalPersona
+from src.services.artifact_sink import ArtifactSink, get_artifact_sink
+from src.services.blob_store import get_blob_store
+from src.services.input_resolver import InputImageResolver, get_input_resolver
+from src.services.prompt_compiler import PromptCompiler
+
+logger = logging.getLogger(__name__)
+
+# Standard negative prompt for persona portraits (the compiler writes the positive side)
+PERSONA_NEGATIVE_PROMPT = "low quality, bad anatomy, worst quality, unrealistic, cartoon, anime"
+
+STAGES = ("inputs", "compile", "generate", "persist", "encode")
+
+StageHook = Callable[[str, float, "GenerationJob", str], None]  # (stage, seconds, job, outcome)
+
+
+class GenerationError(Exception):
+    """The model call failed or returned no image. `status_code` is the HTTP status of the failure."""
+
+    def __init__(self, message: str, status_code: int = 500, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class GenerationJob:
+    """
+    One generation, independent of the route it came from.
+    Either `prompt` (free-form, optionally with reference images) or `persona` (compiled to a
+    prompt by PromptCompiler) is set. `log_files` are extra artifacts for the generation log.
+    """
+
+    __slots__ = (
+        "prompt", "persona", "raw_inputs", "aspect_ratio", "image_size", "negative_prompt",
+        "guidance_scale", "enhance_prompt", "transaction_id", "log_files", "timings",
+    )
+
+    def __init__(
+        self,
+        prompt: Optional[str] = None,
+        persona: Optional[DigitalPersona] = None,
+        raw_inputs: Optional[List[str]] = None,
+        aspect_ratio: str = "1:1",
+        image_size: str = "1K",
+        negative_prompt: Optional[str] = None,
+        guidance_scale: float = 60.0,
+        enhance_prompt: bool = True,
+        transaction_id: Optional[str] = None,
+        log_files: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        if (prompt is None) == (persona is None):
+            raise ValueError("GenerationJob needs exactly one of prompt / persona")
+        self.prompt = prompt
+        self.persona = persona
+        self.raw_inputs = raw_inputs or []
+        self.aspect_ratio = aspect_ratio
+        self.image_size = image_size
+        self.negative_prompt = negative_prompt
+        self.guidance_scale = guidance_scale
+        self.enhance_prompt = enhance_prompt
+        self.transaction_id = transaction_id
+        self.log_files = log_files or {}
+        self.timings: Dict[str, float] = {}
+
+
+class GenerationPipeline:
+    """
+    The one path every generation route goes through:
+
+        inputs ─┐
+                ├─> generate ─> persist (artifact sink, non-blocking)
+        compile ┘            └> encode  (blob store ref or data URI, off the event loop)
+
+    Input resolution and prompt compilation run concurrently; persisting and encoding the
+    output run concurrently. Every stage is timed and reported to the registered stage
+    hooks as (stage, seconds, job), so a speed-up or a metric in one place covers all routes.
+    """
+
+    def __init__(
+        self,
+        service,
+        resolver: Optional[InputImageResolver] = None,
+        sink: Optional[ArtifactSink] = None,
+    ) -> None:
+        self.service = service
+        self.resolver = resolver or get_input_resolver()
+        self.sink = sink or get_artifact_sink()
+        self._stage_hooks: List[StageHook] = []
+
+    def add_stage_hook(self, hook: StageHook) -> None:
+        self._stage_hooks.append(hook)
+
+    async def run(self, job: GenerationJob, progress_callback=None, delivery: str = "ref") -> Dict[str, Any]:
+        """
+        Runs all stages and returns the result dict:
+          delivery="ref":     {"image_ref", "mime_type", "content_length"} (image kept in the blob store)
+          delivery="datauri": {"image_data": "data:<mime type>;base64,..."}
+        plus "compiled_prompt" for persona jobs. Raises GenerationError if no image came back.
+        """
+        progress = progress_callback or (lambda p, m: None)
+        started = time.perf_counter()
+
+        progress(10, "Compiling Persona..." if job.persona is not None else "Collecting Inputs...")
+        images, prompt = await asyncio.gather(
+            self._timed("inputs", job, self.resolver.resolve(job.raw_inputs)),
+            self._timed("compile", job, self._compile(job)),
+        )
+
+        progress(30, "正在等待 Gemini API 响应...")
+        image_bytes, mime_type = await self._timed("generate", job, self._generate(job, prompt, images, progress))
+
+        progress(90, "Saving Results...")
+        _, result = await asyncio.gather(
+            self._timed("persist", job, self._persist(job, prompt, image_bytes, mime_type)),
+            self._timed("encode", job, self._encode(image_bytes, mime_type, delivery)),
+        )
+        if job.persona is not None:
+            result["compiled_prompt"] = prompt
+
+        summary = ", ".join(f"{stage}={job.timings[stage]:.3f}s" for stage in STAGES if stage in job.timings)
+        logger.info(f"Generation {job.transaction_id} done in {time.perf_counter() - started:.2f}s ({summary})")
+        return result
+
+    # --- Stages ---
+
+    async def _compile(self, job: GenerationJob) -> str:
+        if job.persona is None:
+            return job.prompt
+        try:
+            return PromptCompiler.compile(job.persona)
+        except Exception as e:
+            raise GenerationError(f"Prompt Compilation Failed: {e}")
+
+    async def _generate(self, job: GenerationJob, prompt: str, images: List[bytes], progress) -> Tuple[bytes, str]:
+        if job.persona is not None:
+            negative_prompt, guidance_scale, enhance_prompt = PERSONA_NEGATIVE_PROMPT, 60.0, False
+        else:
+            negative_prompt, guidance_scale, enhance_prompt = job.negative_prompt, job.guidance_scale, job.enhance_prompt
+
+        if images:
+            input_data = GeminiBananaProImageToImageInput(
+                prompt=prompt,
+                image_url=images,
+                ratio=job.aspect_ratio,
+                image_size=job.image_size,
+                negative_prompt=negative_prompt,
+                guidance_scale=guidance_scale,
+                enhance_prompt=enhance_prompt,
+            )
+            result = await self.service.generate_image_from_image(input_data, progress_callback=progress)
+        else:
+            input_data = GeminiBananaProTextToImageInput(
+                prompt=prompt,
+                ratio=job.aspect_ratio,
+                image_size=job.image_size,
+                negative_prompt=negative_prompt,
+                guidance_scale=guidance_scale,
+                enhance_prompt=enhance_prompt,
+            )
+            result = await self.service.generate_image_from_text(input_data, progress_callback=progress)
+
+        if not result.success:
+            raise GenerationError(result.error or "Generation failed", status_code=result.status, retry_after=result.retry_after)
+        if not result.image_data:
+            raise GenerationError("No image data returned")
+        return result.image_data, result.mime_type or "image/png"
+
+    async def _persist(self, job: GenerationJob, prompt: str, image_bytes: bytes, mime_type: str) -> None:
+        files = dict(job.log_files)
+        if job.persona is not None:
+            files.setdefault("persona.json", job.persona.model_dump())
+            files.setdefault("prompt_compiled.txt", prompt)
+        # Always output.png: the local library (src/lib/localLibrary.ts) and README read that name.
+        # The bytes are stored as returned (may be JPEG); browsers sniff the image type.
+        files["output.png"] = image_bytes
+        req_dir_name = job.transaction_id if job.transaction_id else f"req_{int(time.time()*1000)}"
+        # Hand-off only: the sink's writer thread does the disk I/O (timed there as "artifact_write")
+        self.sink.submit(req_dir_name, files, labels={"image_size": job.image_size, "aspect_ratio": job.aspect_ratio})
+
+    async def _encode(self, image_bytes: bytes, mime_type: str, delivery: str) -> Dict[str, Any]:
+        if delivery == "datauri":
+            b64_img = await asyncio.to_thread(lambda: base64.b64encode(image_bytes).decode("ascii"))
+            return {"image_data": f"data:{mime_type};base64,{b64_img}"}
+        blob_id = await asyncio.to_thread(get_blob_store().put, image_bytes)
+        return {"image_ref": blob_id, "mime_type": mime_type, "content_length": len(image_bytes)}
+
+    # --- Timing ---
+
+    async def _timed(self, stage: str, job: GenerationJob, coro: Awaitable[Any]) -> Any:
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            job.timings[stage] = elapsed
+            for hook in self._stage_hooks:
+                try:
+                    hook(stage, elapsed, job, outcome)
+                except Exception as e:
+                    logger.warning(f"Stage hook failed for {stage}: {e}")
@@ -0,0 +1,134 @@
+import logging
+import math
+import os
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from src.services.config import env_bool, env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_budgets(spec: str) -> Dict[str, float]:
+    """'0.05' (every size) or '1K=0,2K=0.05,4K=0.1'; a bare number sets the default ('*')."""
+    budgets: Dict[str, float] = {}
+    for item in spec.split(","):
+        size, sep, value = item.partition("=")
+        try:
+            if sep:
+                budgets[size.strip().upper()] = max(0.0, float(value))
+            elif size.strip():
+                budgets["*"] = max(0.0, float(size))
+        except ValueError:
+            logger.warning(f"Ignoring invalid hedge budget entry: {item!r}")
+    return budgets
+
+
+class HedgePolicy:
+    """
+    Decides when a Vertex generateContent call gets one duplicate ("hedge").
+
+    Delay: the `quantile` of the last `window` successful call latencies of the same image
+    size (never below `min_delay`). Until `min_samples` latencies are known, no hedging.
+
+    Budget: every primary call of a size earns `budget` credits, a hedge spends one, so
+    hedges stay at or below that share of extra requests (e.g. 0.05 = at most +5% quota).
+    Credits are capped at `burst` so a quiet hour doesn't save up a hedge storm.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        quantile: float = 0.95,
+        min_delay: float = 5.0,
+        budgets: Optional[Dict[str, float]] = None,
+        window: int = 200,
+        min_samples: int = 20,
+        burst: float = 2.0,
+    ) -> None:
+        self.enabled = enabled
+        self.quantile = min(max(quantile, 0.5), 0.999)
+        self.min_delay = min_delay
+        self.budgets = budgets if budgets is not None else {"*": 0.05}
+        self.window = max(10, window)
+        self.min_samples = max(1, min_samples)
+        self.burst = max(1.0, burst)
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._credits: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+        # Monitoring counters, per image size
+        self.primaries: Dict[str, int] = {}
+        self.hedges: Dict[str, int] = {}
+        self.denied: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls) -> "HedgePolicy":
+        return cls(
+            enabled=env_bool("VERTEX_HEDGE", False),
+            quantile=env_float("VERTEX_HEDGE_QUANTILE", 0.95),
+            min_delay=env_float("VERTEX_HEDGE_MIN_DELAY", 5.0),
+            budgets=_parse_budgets(os.getenv("VERTEX_HEDGE_BUDGET", "0.05")),
+            window=env_int("VERTEX_HEDGE_WINDOW", 200),
+            min_samples=env_int("VERTEX_HEDGE_MIN_SAMPLES", 20),
+        )
+
+    def budget_for(self, image_size: str) -> float:
+        return self.budgets.get(str(image_size).upper(), self.budgets.get("*", 0.0))
+
+    def record_primary(self, image_size: str) -> None:
+        size = str(image_size).upper()
+        with self._lock:
+            self.primaries[size] = self.primaries.get(size, 0) + 1
+            self._credits[size] = min(self.burst, self._credits.get(size, 0.0) + self.budget_for(size))
+
+    def observe(self, image_size: str, seconds: float) -> None:
+        """Latency of a successful call (request sent -> image decoded)."""
+        size = str(image_size).upper()
+        with self._lock:
+            samples = self._latencies.get(size)
+            if samples is None:
+                samples = self._latencies[size] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def delay_for(self, image_size: str) -> Optional[float]:
+        """Seconds to wait for the primary before hedging, or None if this call shouldn't hedge."""
+        size = str(image_size).upper()
+        if not self.enabled or self.budget_for(size) <= 0:
+            return None
+        with self._lock:
+            samples = self._latencies.get(size)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(self.quantile * len(ordered)) - 1))
+        return max(self.min_delay, ordered[index])
+
+    def try_acquire(self, image_size: str) -> bool:
+        """Spend one hedge credit for this size. False = over budget, don't hedge."""
+        size = str(image_size).upper()
+        with self._lock:
+            if self._credits.get(size, 0.0) >= 1.0:
+                self._credits[size] -= 1.0
+                self.hedges[size] = self.hedges.get(size, 0) + 1
+                return True
+            self.denied[size] = self.denied.get(size, 0) + 1
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        sizes = sorted(set(self.primaries) | set(self._latencies))
+        return {
+            "enabled": self.enabled,
+            "quantile": self.quantile,
+            "sizes": {
+                size: {
+                    "delay_s": self.delay_for(size),
+                    "budget": self.budget_for(size),
+                    "primaries": self.primaries.get(size, 0),
+                    "hedges": self.hedges.get(size, 0),
+                    "denied": self.denied.get(size, 0),
+                }
+                for size in sizes
+            },
+        }
@@ -0,0 +1,185 @@
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from src.services.config import env_float, lazy_singleton
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_CACHE_MB = env_float("INPUT_CACHE_MB", 256.0)
+
+
+def detect_mime_type(data: bytes) -> str:
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+class CachedImage:
+    """One input image: raw bytes, MIME type and (built on first use) the Vertex inlineData part."""
+
+    __slots__ = ("key", "data", "mime_type", "_part")
+
+    def __init__(self, key: str, data: bytes) -> None:
+        self.key = key
+        self.data = data
+        self.mime_type = detect_mime_type(data)
+        self._part: Optional[Dict[str, Any]] = None
+
+    @property
+    def nbytes(self) -> int:
+        # Raw bytes + base64 text (4/3) once the part exists
+        return len(self.data) + (len(self.data) * 4 // 3 if self._part is not None else 0)
+
+    def part(self) -> Dict[str, Any]:
+        if self._part is None:
+            self._part = {
+                "inlineData": {
+                    "mimeType": self.mime_type,
+                    "data": base64.b64encode(self.data).decode("ascii"),
+                }
+            }
+        return self._part
+
+
+class InputImageCache:
+    """
+    Process-wide LRU of input images keyed by sha256 of their bytes, bounded by total size.
+
+    Bake Angles / batch remixes send the same references over and over: with the cache they
+    are decoded (or read from disk) once, share a single bytes object across jobs, and their
+    base64 part is encoded once instead of on every job and every retry.
+    Aliases map cheaper keys (hash of a data URI, path + mtime of an upload) to the content
+    hash, so a repeated input skips decoding/reading entirely.
+    """
+
+    def __init__(self, max_bytes: int = int(_DEFAULT_CACHE_MB * 1024 * 1024)) -> None:
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self._aliases: Dict[str, str] = {}
+        # id(bytes object) -> content key: resolved inputs are the cached bytes objects, so a
+        # payload build finds its entry without hashing the image again (verified with `is`)
+        self._by_id: Dict[int, str] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Monitoring counters: hits/misses per resolved input, part_* per payload build
+        self.hits = 0
+        self.misses = 0
+        self.part_hits = 0
+        self.part_encodes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def content_key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def lookup(self, alias: str) -> Optional[CachedImage]:
+        """Cached image for an alias key, or None (counted as a miss)."""
+        with self._lock:
+            key = self._aliases.get(alias)
+            entry = self._entries.get(key) if key is not None else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, data: bytes, alias: Optional[str] = None, count: bool = True) -> CachedImage:
+        """
+        Returns the cached entry for these bytes, adding it if needed.
+        Pass count=False when the lookup was already counted (e.g. after an alias miss).
+        """
+        key = self.content_key(data)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+            else:
+                if count:
+                    self.misses += 1
+                entry = CachedImage(key, data)
+                if entry.nbytes * 2 > self.max_bytes:
+                    # Would take most of the cache (room for its base64 too): use it uncached
+                    return entry
+                self._entries[key] = entry
+                self._by_id[id(data)] = key
+                self._bytes += entry.nbytes
+                self._evict()
+            if alias is not None and key in self._entries:
+                self._aliases[alias] = key
+            return entry
+
+    def part_for(self, data: bytes) -> Dict[str, Any]:
+        """Vertex inlineData part for raw image bytes, encoded once per distinct image."""
+        with self._lock:
+            key = self._by_id.get(id(data))
+            entry = self._entries.get(key) if key is not None else None
+            if entry is not None and entry.data is not data:
+                entry = None
+        if entry is None:
+            # Bytes that didn't come out of the cache (or were evicted since): hash them once
+            entry = self.put(data, count=False)
+        with self._lock:
+            had_part = entry._part is not None
+            before = entry.nbytes
+            if had_part:
+                self.part_hits += 1
+            else:
+                self.part_encodes += 1
+        part = entry.part()
+        if not had_part:
+            with self._lock:
+                if self._entries.get(entry.key) is entry:
+                    self._bytes += entry.nbytes - before
+                    self._evict(keep=entry.key)
+        return part
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """Drop least recently used entries until under the byte bound. Caller holds the lock."""
+        while self._bytes > self.max_bytes and self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+            self._by_id.pop(id(entry.data), None)
+            self._bytes -= entry.nbytes
+            self.evictions += 1
+            stale = [a for a, k in self._aliases.items() if k == key]
+            for a in stale:
+                del self._aliases[a]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "part_hits": self.part_hits,
+                "part_encodes": self.part_encodes,
+                "evictions": self.evictions,
+            }
+
+
+@lazy_singleton
+def get_input_cache() -> InputImageCache:
+    return InputImageCache()
@@ -0,0 +1,283 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from src.services.blob_store import get_blob_store
+from src.services.input_cache import InputImageCache, get_input_cache
+from src.services.task_queue import TaskStatus, task_queue
+from src.services.config import env_float, env_int, lazy_singleton
+
+logger = logging.getLogger(__name__)
+
+
+# Inputs already stored in the blob store (see api_server's batch route)
+BLOB_REF_PREFIX = "blob:"
+# Output of an earlier task, as handed to clients (proxied under /api/py by Next.js)
+_TASK_RESULT_PATH = re.compile(r"^(?:/api/py)?/tasks/([^/?#]+)/result(?:[?#].*)?$")
+
+
+class InputTooLargeError(Exception):
+    pass
+
+
+class InputUnavailableError(Exception):
+    """Some inputs of a request could not be resolved. `status_code` is the HTTP status to answer with."""
+
+    status_code = 400
+
+
+class InputImageResolver:
+    """
+    Turns the `image_url` / `images` entries of a request into raw bytes.
+
+    Accepts data URIs, http(s) URLs, `blob:<sha256>` references into the blob store (shared
+    inputs of a batch), results of earlier tasks (`/tasks/<id>/result`, also under `/api/py`)
+    and local paths (`/api/uploads/<file>` or paths under public/). All inputs of a request are resolved concurrently on the event loop:
+      - downloads share one pooled httpx client and are streamed with a size cap
+      - local lookups and file reads run in threads
+      - the whole request gets `time_budget` seconds
+    Uploads are looked up in an in-memory index of public/uploads instead of probing
+    candidate paths on every request.
+    If any input can't be resolved (missing, expired, too large, late), the request fails with
+    InputUnavailableError instead of silently generating without it.
+    """
+
+    def __init__(
+        self,
+        upload_dirs: Optional[List[str]] = None,
+        public_dirs: Optional[List[str]] = None,
+        time_budget: float = 30.0,
+        max_bytes: int = 20 * 1024 * 1024,
+        max_concurrency: int = 8,
+        cache: Optional[InputImageCache] = None,
+    ) -> None:
+        cwd = os.getcwd()
+        # Upload dirs may not exist yet (the Next.js side creates them on first upload)
+        self.upload_dirs = self._unique_dirs(upload_dirs or [
+            os.path.join(cwd, "public", "uploads"),
+            os.path.join("/app", "public", "uploads"),
+        ])
+        self.public_dirs = self._unique_dirs(public_dirs or [cwd, os.path.join(cwd, "public"), "/app"])
+        self.time_budget = time_budget
+        self.max_bytes = max_bytes
+        self.max_concurrency = max_concurrency
+        # Resolved bytes go through the shared input cache, so repeated references are
+        # decoded/read once and the same bytes object reaches GeminiImageService
+        self.cache = cache or get_input_cache()
+
+        self._upload_index: Dict[str, str] = {}  # filename -> absolute path
+        self._index_built = False
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._http_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def from_env(cls) -> "InputImageResolver":
+        return cls(
+            time_budget=env_float("INPUT_FETCH_BUDGET_SECONDS", 30.0),
+            max_bytes=int(env_float("INPUT_MAX_MB", 20.0) * 1024 * 1024),
+            max_concurrency=env_int("INPUT_FETCH_CONCURRENCY", 8),
+        )
+
+    @staticmethod
+    def _unique_dirs(candidates: List[str]) -> List[str]:
+        dirs = []
+        for d in candidates:
+            real = os.path.realpath(d)
+            if real not in dirs:
+                dirs.append(real)
+        return dirs
+
+    # --- Public API ---
+
+    async def resolve(self, items: List[str]) -> List[bytes]:
+        """Resolves all inputs concurrently, keeping request order. Raises InputUnavailableError if any fails."""
+        if not items:
+            return []
+        started = time.monotonic()
+        slots = asyncio.Semaphore(self.max_concurrency)
+
+        failures: List[str] = []
+
+        async def resolve_one(item: str) -> Optional[bytes]:
+            async with slots:
+                try:
+                    return await self._resolve_item(item)
+                except Exception as e:
+                    logger.warning(f"Cannot resolve input {self._describe(item)}: {e}")
+                    failures.append(f"{self._describe(item)}: {e}")
+                    return None
+
+        tasks = [asyncio.ensure_future(resolve_one(item)) for item in items]
+        done, pending = await asyncio.wait(tasks, timeout=self.time_budget)
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(f"Input time budget ({self.time_budget}s) exceeded, {len(pending)} of {len(items)} inputs missing")
+            failures.append(f"{len(pending)} inputs not resolved within {self.time_budget}s")
+        if failures:
+            raise InputUnavailableError(f"{len(failures)} of {len(items)} input images unavailable: " + "; ".join(failures))
+
+        results = [t.result() for t in tasks]
+        logger.info(f"Resolved {len(results)}/{len(items)} inputs in {time.monotonic() - started:.2f}s")
+        return results
+
+    async def aclose(self) -> None:
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
+        self._http_loop = None
+
+    # --- Per-kind resolution ---
+
+    async def _resolve_item(self, item: str) -> Optional[bytes]:
+        # Hashing / base64 decoding of multi-MB inputs runs in a thread, never on the event loop
+        if item.startswith("data:"):
+            return await asyncio.to_thread(self._decode_data_uri, item)
+        if item.startswith(BLOB_REF_PREFIX):
+            return await asyncio.to_thread(self._read_blob, item[len(BLOB_REF_PREFIX):])
+        if item.startswith(("http://", "https://")):
+            data = await self._download(item)
+            return (await asyncio.to_thread(self.cache.put, data)).data
+        match = _TASK_RESULT_PATH.match(item)
+        if match:
+            return await asyncio.to_thread(self._read_task_result, match.group(1))
+        return await asyncio.to_thread(self._read_local, item)
+
+    def _decode_data_uri(self, item: str) -> bytes:
+        _, encoded = item.split(",", 1)
+        if len(encoded) * 3 // 4 > self.max_bytes:
+            raise InputTooLargeError(f"data URI larger than {self.max_bytes} bytes")
+        alias = "uri:" + hashlib.sha256(encoded.encode("ascii")).hexdigest()
+        cached = self.cache.lookup(alias)
+        if cached is not None:
+            return cached.data
+        return self.cache.put(base64.b64decode(encoded), alias=alias, count=False).data
+
+    def _read_blob(self, blob_id: str) -> bytes:
+        # Blob ids are content hashes, so a cached entry under this alias is always the same bytes
+        alias = BLOB_REF_PREFIX + blob_id
+        cached = self.cache.lookup(alias)
+        if cached is not None:
+            return cached.data
+        data = get_blob_store().get(blob_id)
+        if data is None:
+            raise FileNotFoundError("blob expired or never stored")
+        return self.cache.put(data, alias=alias, count=False).data
+
+    def _read_task_result(self, task_id: str) -> bytes:
+        task = task_queue.get_task_details(task_id)
+        if task is None or task["status"] != TaskStatus.COMPLETED:
+            raise FileNotFoundError("task result expired or not available")
+        result = task.get("result") or {}
+        if result.get("image_ref"):
+            return self._read_blob(result["image_ref"])
+        if str(result.get("image_data", "")).startswith("data:"):
+            return self._decode_data_uri(result["image_data"])
+        raise FileNotFoundError("task has no image result")
+
+    def _get_http_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._http_client is None or self._http_client.is_closed or self._http_loop is not loop:
+            self._http_client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=httpx.Timeout(self.time_budget, connect=10.0),
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            )
+            self._http_loop = loop
+        return self._http_client
+
+    async def _download(self, url: str) -> bytes:
+        client = self._get_http_client()
+        async with client.stream("GET", url) as resp:
+            resp.raise_for_status()
+            declared = resp.headers.get("Content-Length")
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                raise InputTooLargeError(f"Content-Length {declared} exceeds {self.max_bytes} bytes")
+            chunks, size = [], 0
+            async for chunk in resp.aiter_bytes():
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise InputTooLargeError(f"download exceeds {self.max_bytes} bytes")
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _read_local(self, item: str) -> bytes:
+        path = self._local_path(item)
+        if path is None:
+            raise FileNotFoundError("not found under public/")
+        st = os.stat(path)
+        if st.st_size > self.max_bytes:
+            raise InputTooLargeError(f"file larger than {self.max_bytes} bytes")
+        # Same file, unchanged since last read: skip the disk
+        alias = f"file:{path}:{st.st_mtime_ns}:{st.st_size}"
+        cached = self.cache.lookup(alias)
+        if cached is not None:
+            return cached.data
+        with open(path, "rb") as f:
+            return self.cache.put(f.read(), alias=alias, count=False).data
+
+    # --- Local path lookup ---
+
+    def _build_upload_index(self) -> None:
+        index = {}
+        for root in self.upload_dirs:
+            try:
+                with os.scandir(root) as entries:
+                    for entry in entries:
+                        if entry.is_file() and entry.name not in index:
+                            index[entry.name] = entry.path
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Cannot index upload dir {root}: {e}")
+        self._upload_index = index
+        self._index_built = True
+        logger.info(f"Indexed {len(index)} uploaded files in {self.upload_dirs}")
+
+    def _lookup_upload(self, filename: str) -> Optional[str]:
+        filename = os.path.basename(filename.split("?", 1)[0])
+        if not filename:
+            return None
+        if not self._index_built:
+            self._build_upload_index()
+        path = self._upload_index.get(filename)
+        if path is not None and os.path.isfile(path):
+            return path
+        # Uploaded after the index was built (or removed since): one check per upload dir
+        self._upload_index.pop(filename, None)
+        for root in self.upload_dirs:
+            candidate = os.path.join(root, filename)
+            if os.path.isfile(candidate):
+                self._upload_index[filename] = candidate
+                return candidate
+        return None
+
+    def _local_path(self, item: str) -> Optional[str]:
+        if "/api/uploads/" in item:
+            return self._lookup_upload(item.split("/api/uploads/")[-1])
+        if item.startswith("/uploads/"):
+            return self._lookup_upload(item[len("/uploads/"):])
+        clean_path = item.split("?", 1)[0].lstrip("/")
+        for root in self.public_dirs:
+            candidate = os.path.realpath(os.path.join(root, clean_path))
+            # Never resolve outside the served directories
+            if candidate.startswith(root + os.sep) and os.path.isfile(candidate):
+                return candidate
+        return None
+
+    @staticmethod
+    def _describe(item: str) -> str:
+        return item[:40] + "..." if item.startswith("data:") else item
+
+
+@lazy_singleton
+def get_input_resolver() -> InputImageResolver:
+    return InputImageResolver.from_env()
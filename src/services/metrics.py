@@ -0,0 +1,229 @@
+import logging
+import math
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Seconds; spans sub-millisecond stages (payload build, encode) up to slow 4K Vertex calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+# Label values come partly from requests (aspect_ratio, image_size): past this many series
+# per metric, new label combinations are folded into "other" instead of growing forever
+_MAX_SERIES = 500
+
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelKey:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) if labels[n] not in (None, "") else "unknown" for n in self.labelnames)
+
+    def _bounded(self, key: LabelKey, series: Dict[LabelKey, object]) -> LabelKey:
+        # Caller holds the lock
+        if key in series or len(series) < _MAX_SERIES:
+            return key
+        return tuple("other" for _ in key)
+
+    def _labels_text(self, key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, key)]
+        if extra is not None:
+            pairs.append(f'{extra[0]}="{extra[1]}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        """Exposition lines (HELP, TYPE, samples) for this metric."""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            key = self._bounded(key, self._values)
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{self._labels_text(k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Set directly, or read at scrape time from `set_function` (a number, or {label tuple: number})."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+        self._function: Optional[Callable[[], Union[float, Dict[LabelKey, float]]]] = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            key = self._bounded(key, self._values)
+            self._values[key] = float(value)
+
+    def set_function(self, fn: Callable[[], Union[float, Dict[LabelKey, float]]]) -> None:
+        self._function = fn
+
+    def render(self) -> List[str]:
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception as e:
+                logger.warning(f"Gauge {self.name} callback failed: {e}")
+                value = {}
+            values = value if isinstance(value, dict) else {(): value}
+            items = sorted((tuple(str(p) for p in k), float(v)) for k, v in values.items())
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return self._header() + [f"{self.name}{self._labels_text(k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # key -> [per-bucket counts..., +Inf count], sum
+        self._counts: Dict[LabelKey, List[int]] = {}
+        self._sums: Dict[LabelKey, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            key = self._bounded(key, self._counts)
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._sums[key] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(c), self._sums[k]) for k, c in self._counts.items())
+        lines = self._header()
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._labels_text(key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels_text(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._labels_text(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """All metrics of this process, rendered in the Prometheus text exposition format (0.0.4)."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# --- Generation metrics (shared by the pipeline, the Vertex client, the queue and the log sink) ---
+
+# stage: queue_wait, inputs, compile, payload_build, rate_limit, auth, vertex, vertex_hedge, parse, generate, artifact_write, encode
+# outcome: ok, error, cancelled; Vertex calls (vertex, vertex_hedge) break errors down into
+# 429, 5xx, timeout, network, no_image, so failed attempts show up next to the successful ones
+stage_seconds = registry.histogram(
+    "imagegen_stage_seconds",
+    "Time spent in each stage of a generation",
+    ("stage", "outcome", "image_size", "aspect_ratio"),
+)
+retries_total = registry.counter(
+    "imagegen_retries_total",
+    "Vertex call retries by cause (429, 5xx, timeout, network)",
+    ("cause", "image_size", "aspect_ratio"),
+)
+generations_total = registry.counter(
+    "imagegen_generations_total",
+    "Finished Vertex generations by outcome (success, failure, rejected by the circuit breaker)",
+    ("outcome", "image_size", "aspect_ratio"),
+)
+hedges_total = registry.counter(
+    "imagegen_hedges_total",
+    "Duplicate (hedged) Vertex calls: sent, won (hedge answered first), lost (primary answered first), both_failed, denied (over budget)",
+    ("outcome", "image_size", "aspect_ratio"),
+)
+vertex_circuit_state = registry.gauge(
+    "imagegen_vertex_circuit_state", "Vertex image circuit breaker: 0 closed, 1 half-open, 2 open"
+)
+queue_depth = registry.gauge("imagegen_task_queue_pending", "Tasks waiting in the TaskQueue")
+queue_inflight = registry.gauge("imagegen_task_queue_running", "Tasks currently executing in this process")
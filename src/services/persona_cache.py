@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, FrozenSet, Optional
+
+from src.services.config import env_float, env_int, lazy_singleton
+
+logger = logging.getLogger(__name__)
+
+
+_WHITESPACE = re.compile(r"\s+")
+# Spaces next to CJK characters carry no meaning ("赛博朋克 女孩" == "赛博朋克女孩")
+_CJK_SPACE = re.compile(r" ?([\u2e80-\u9fff\uac00-\ud7af]) ?")
+# Trailing punctuation doesn't change the intent ("赛博朋克女孩。" == "赛博朋克女孩")
+_TRAILING_PUNCT = " .,!?;:~。，！？；：…、"
+
+
+def normalize_text(text: str) -> str:
+    """NFKC (full-width -> half-width), case-folded, whitespace collapsed, trailing punctuation dropped."""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    text = _CJK_SPACE.sub(r"\1", _WHITESPACE.sub(" ", text))
+    return text.strip().rstrip(_TRAILING_PUNCT).strip()
+
+
+def _shingles(text: str) -> FrozenSet[str]:
+    # Character trigrams: works for CJK (no word boundaries) as well as for Latin text
+    compact = text.replace(" ", "")
+    if len(compact) < 3:
+        return frozenset([compact])
+    return frozenset(compact[i:i + 3] for i in range(len(compact) - 2))
+
+
+class _Entry:
+    __slots__ = ("namespace", "text", "shingles", "data", "created_at")
+
+    def __init__(self, namespace: str, text: str, data: Dict[str, Any], created_at: float) -> None:
+        self.namespace = namespace
+        self.text = text
+        self.shingles = _shingles(text)
+        self.data = data
+        self.created_at = created_at
+
+
+class PersonaCache:
+    """
+    LRU + TTL cache of persona interpretations (the model's JSON output, as a dict).
+
+    Keys are the normalized input text within a namespace (model name + schema/instruction
+    version), so a schema change or model switch never serves stale shapes. With
+    `similarity` > 0, a miss falls back to the most similar cached text of the same
+    namespace (trigram Jaccard) if it scores at least that high; 0 = exact matches only.
+
+    With `path` set, entries are appended to a JSONL file and reloaded (and compacted) on start.
+    File writes go through a single background thread (in order), so put() never blocks
+    the event loop on disk I/O.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        ttl: float = 7 * 86400.0,
+        similarity: float = 0.0,
+        path: Optional[str] = None,
+    ) -> None:
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.similarity = similarity
+        self.path = path
+        self._entries: "OrderedDict[tuple, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._file_lines = 0
+        self._writer: Optional[ThreadPoolExecutor] = None
+
+        # Monitoring counters
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.path:
+            self._load()
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PersonaCache-writer")
+
+    @classmethod
+    def from_env(cls) -> "PersonaCache":
+        return cls(
+            max_entries=env_int("PERSONA_CACHE_SIZE", 512),
+            ttl=env_float("PERSONA_CACHE_TTL_HOURS", 168.0) * 3600,
+            similarity=env_float("PERSONA_CACHE_SIMILARITY", 0.0),
+            path=os.getenv("PERSONA_CACHE_FILE") or None,
+        )
+
+    # --- Public API ---
+
+    def get(self, namespace: str, text: str) -> Optional[Dict[str, Any]]:
+        """Cached interpretation for `text`, or None. Callers get their own copy of the dict."""
+        norm = normalize_text(text)
+        now = time.time()
+        with self._lock:
+            key = (namespace, norm)
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                del self._entries[key]
+                entry = None
+            if entry is None and self.similarity > 0:
+                entry = self._nearest(namespace, norm, now)
+                if entry is not None:
+                    self.near_hits += 1
+                    key = (entry.namespace, entry.text)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            data = entry.data
+        # Round-trip copy: a caller mutating its persona must not change the cached one
+        return json.loads(json.dumps(data))
+
+    def put(self, namespace: str, text: str, data: Dict[str, Any]) -> None:
+        norm = normalize_text(text)
+        entry = _Entry(namespace, norm, data, time.time())
+        with self._lock:
+            self._insert(entry)
+        if self._writer is not None:
+            self._writer.submit(self._append, entry)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        if self._writer is not None:
+            self._writer.submit(self._rewrite, [])
+
+    def flush(self) -> None:
+        """Block until every queued file write is done."""
+        if self._writer is not None:
+            self._writer.submit(lambda: None).result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "persistent": bool(self.path),
+            }
+
+    # --- Internals (caller holds the lock) ---
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        return self.ttl > 0 and now - entry.created_at > self.ttl
+
+    def _insert(self, entry: _Entry) -> None:
+        key = (entry.namespace, entry.text)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _nearest(self, namespace: str, norm: str, now: float) -> Optional[_Entry]:
+        # Linear scan: bounded by max_entries, and only on an exact miss (which otherwise costs a model call)
+        query = _shingles(norm)
+        best, best_score = None, self.similarity
+        for entry in self._entries.values():
+            if entry.namespace != namespace or self._expired(entry, now):
+                continue
+            union = len(query | entry.shingles)
+            score = len(query & entry.shingles) / union if union else 0.0
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    # --- Persistence ---
+
+    @staticmethod
+    def _record(entry: _Entry) -> str:
+        return json.dumps(
+            {"ns": entry.namespace, "text": entry.text, "data": entry.data, "ts": entry.created_at},
+            ensure_ascii=False,
+        )
+
+    def _append(self, entry: _Entry) -> None:
+        # Runs on the writer thread
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(self._record(entry) + "\n")
+        except OSError as e:
+            logger.warning(f"Cannot persist persona cache entry to {self.path}: {e}")
+            return
+        self._file_lines += 1
+        if self._file_lines > 2 * self.max_entries:
+            with self._lock:
+                live = list(self._entries.values())
+            self._rewrite(live)
+
+    def _rewrite(self, entries) -> None:
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(self._record(entry) + "\n")
+            os.replace(tmp_path, self.path)
+            self._file_lines = len(entries)
+        except OSError as e:
+            logger.warning(f"Cannot rewrite persona cache file {self.path}: {e}")
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        loaded = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        entry = _Entry(record["ns"], record["text"], record["data"], float(record["ts"]))
+                    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                        continue  # torn last line after a crash
+                    if not self._expired(entry, now):
+                        self._insert(entry)
+                        loaded += 1
+        except OSError as e:
+            logger.warning(f"Cannot read persona cache file {self.path}: {e}")
+            return
+        # Compact: drop expired, evicted and superseded lines
+        self._rewrite(list(self._entries.values()))
+        self.evictions = 0
+        logger.info(f"Loaded {len(self._entries)} persona interpretations from {self.path} ({loaded} records read)")
+
+
+@lazy_singleton
+def get_persona_cache() -> PersonaCache:
+    return PersonaCache.from_env()
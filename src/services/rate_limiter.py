@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Dict, Optional
+
+from src.services.config import env_float
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    """
+    Process-wide token bucket whose refill rate is tuned with AIMD.
+
+    - Every upstream call does `await acquire()` first. Callers are served strictly in
+      arrival order (asyncio.Lock wakes waiters FIFO), so nobody backs off on their own.
+    - `on_success()` nudges the rate up (additive increase).
+    - `on_rate_limited()` cuts the rate (multiplicative decrease, at most once per cooldown
+      window so a burst of in-flight 429s counts as one signal) and pauses the whole queue.
+      Consecutive 429s without a success grow the pause exponentially.
+    - Waits get a little random jitter so a recovered queue doesn't fire in lockstep.
+    """
+
+    def __init__(
+        self,
+        rate: float = 2.0,
+        min_rate: float = 0.05,
+        max_rate: float = 20.0,
+        burst: float = 2.0,
+        increase_step: float = 0.1,
+        decrease_factor: float = 0.5,
+        cooldown: float = 4.0,
+        max_pause: float = 60.0,
+        jitter: float = 0.2,
+    ) -> None:
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.burst = max(burst, 1.0)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.max_pause = max_pause
+        self.jitter = jitter
+
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._limited_streak = 0
+        self._queued = 0
+        self._lock = None
+        self._lock_loop = None
+
+        # Monitoring counters
+        self.acquired_total = 0
+        self.success_total = 0
+        self.rate_limited_total = 0
+
+    @classmethod
+    def from_env(cls, prefix: str = "GEMINI_RATE_LIMIT", rate: float = 2.0, burst: float = 2.0) -> "AdaptiveRateLimiter":
+        return cls(
+            rate=env_float(f"{prefix}_QPS", rate),
+            min_rate=env_float(f"{prefix}_MIN_QPS", 0.05),
+            max_rate=env_float(f"{prefix}_MAX_QPS", 20.0),
+            burst=env_float(f"{prefix}_BURST", burst),
+            cooldown=env_float(f"{prefix}_COOLDOWN", 4.0),
+        )
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        if elapsed > 0:
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+            self._last_refill = now
+
+    def _reserve(self) -> float:
+        """Take one token and return how long the caller must wait before using it."""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self._paused_until - now)
+        if wait > 0:
+            # Nothing accrues while paused; restart the bucket empty at the end of the pause
+            self._tokens = 0.0
+            self._last_refill = self._paused_until
+        self._tokens -= 1.0
+        if self._tokens < 0:
+            wait += -self._tokens / self.rate
+        if wait > 0:
+            wait *= 1.0 + random.uniform(0, self.jitter)
+        return wait
+
+    async def acquire(self) -> None:
+        self._queued += 1
+        try:
+            # Holding the lock while sleeping keeps the queue strictly FIFO and paced
+            async with self._get_lock():
+                wait = self._reserve()
+                if wait > 0:
+                    try:
+                        await asyncio.sleep(wait)
+                    except asyncio.CancelledError:
+                        # Caller was cancelled (e.g. task cancelled): hand the reserved token back
+                        self._tokens += 1.0
+                        raise
+                self.acquired_total += 1
+        finally:
+            self._queued -= 1
+
+    def on_success(self) -> None:
+        self.success_total += 1
+        self._limited_streak = 0
+        # Additive increase, roughly +increase_step QPS per second of successful traffic
+        self.rate = min(self.max_rate, self.rate + self.increase_step / max(self.rate, 1.0))
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """`retry_after`: the upstream's Retry-After in seconds, if it sent one (the pause lasts at least that long)."""
+        self.rate_limited_total += 1
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            old_rate = self.rate
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._limited_streak += 1
+            logger.warning(f"Rate limited by upstream: {old_rate:.2f} -> {self.rate:.2f} QPS")
+        pause = min(self.max_pause, self.cooldown * (2 ** max(self._limited_streak - 1, 0)))
+        pause *= 1.0 + random.uniform(0, self.jitter)
+        if retry_after:
+            pause = max(pause, min(retry_after, self.max_pause))
+        self._paused_until = max(self._paused_until, now + pause)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "rate_qps": round(self.rate, 4),
+            "queue_depth": self._queued,
+            "paused_for_s": round(max(0.0, self._paused_until - now), 2),
+            "acquired_total": self.acquired_total,
+            "success_total": self.success_total,
+            "rate_limited_total": self.rate_limited_total,
+        }
+
+
+# Global instance, shared by every GeminiImageService call in this process
+vertex_rate_limiter = AdaptiveRateLimiter.from_env()
+# Text model (persona interpretation) has its own quota, so it gets its own limiter
+vertex_text_rate_limiter = AdaptiveRateLimiter.from_env("GEMINI_TEXT_RATE_LIMIT", rate=5.0, burst=5.0)
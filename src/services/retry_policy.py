@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+
+import httpx
+from google.genai import errors as genai_errors
+
+from src.services.config import lazy_singleton
+
+logger = logging.getLogger(__name__)
+
+# No job retries for longer than this, whatever the configuration says
+MAX_DEADLINE_SECONDS = 3600.0
+
+RETRY_CAUSES = ("429", "5xx", "timeout", "network")
+
+
+class UpstreamError(Exception):
+    """Non-200 answer from Vertex, carrying the status code (and Retry-After) instead of message text to parse."""
+
+    def __init__(self, status_code: int, message: str = "", retry_after: Optional[float] = None) -> None:
+        super().__init__(f"API Error {status_code}: {message}" if message else f"API Error {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class NoImageError(Exception):
+    """200 without an image (e.g. blocked by safety filters): retrying won't change the answer."""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After header (delta seconds or HTTP date) -> seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc: BaseException) -> Optional[str]:
+    """Retry cause of an exception ("429", "5xx", "timeout", "network"), or None if it is permanent."""
+    if isinstance(exc, UpstreamError):
+        code = exc.status_code
+    elif isinstance(exc, genai_errors.APIError):
+        code = exc.code
+    elif isinstance(exc, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return "timeout"
+    elif isinstance(exc, httpx.TransportError):
+        return "network"  # connection refused/reset, protocol errors
+    else:
+        return None
+    if code == 429:
+        return "429"
+    if code == 408:
+        return "timeout"
+    if code in (500, 502, 503, 504):
+        return "5xx"
+    return None
+
+
+class RetryPolicy:
+    """
+    How one kind of call is retried.
+
+      attempts   max calls in total (first try included)
+      deadline   total seconds from the first try, rate-limiter waits and back-off included
+      timeout    per-call timeout (shortened to what's left of the deadline)
+      base/max_delay  decorrelated jitter back-off: sleep = min(max_delay, U(base, 3 * previous sleep))
+      retry_on   causes worth retrying (see classify_error)
+
+    429s don't back off privately: the shared rate limiter already paused everyone, so the
+    retry only waits for Retry-After (if given) before queueing behind it again.
+    """
+
+    __slots__ = ("max_attempts", "deadline", "attempt_timeout", "base_delay", "max_delay", "retry_on")
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        deadline: float = 600.0,
+        attempt_timeout: float = 180.0,
+        base_delay: float = 2.0,
+        max_delay: float = 60.0,
+        retry_on: FrozenSet[str] = frozenset(RETRY_CAUSES),
+    ) -> None:
+        self.max_attempts = max(1, int(max_attempts))
+        self.deadline = min(max(1.0, deadline), MAX_DEADLINE_SECONDS)
+        self.attempt_timeout = max(1.0, attempt_timeout)
+        self.base_delay = max(0.0, base_delay)
+        self.max_delay = max(self.base_delay, max_delay)
+        self.retry_on = frozenset(retry_on)
+
+    _SPEC_KEYS = {
+        "attempts": ("max_attempts", int),
+        "deadline": ("deadline", float),
+        "timeout": ("attempt_timeout", float),
+        "base": ("base_delay", float),
+        "max_delay": ("max_delay", float),
+    }
+
+    def with_spec(self, spec: str) -> "RetryPolicy":
+        """Copy with overrides from 'attempts=4,deadline=300,timeout=90,base=2,max_delay=30,retry_on=429|timeout'."""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            key, _, value = item.partition("=")
+            key = key.strip().lower()
+            try:
+                if key == "retry_on":
+                    values["retry_on"] = frozenset(c.strip() for c in value.split("|") if c.strip() in RETRY_CAUSES)
+                elif key in self._SPEC_KEYS:
+                    name, cast = self._SPEC_KEYS[key]
+                    values[name] = cast(value)
+                else:
+                    logger.warning(f"Unknown retry policy key {key!r} in {spec!r}")
+            except ValueError:
+                logger.warning(f"Invalid retry policy value {item!r} in {spec!r}")
+        return RetryPolicy(**values)
+
+    def start(self) -> "RetryBudget":
+        return RetryBudget(self)
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "attempts": self.max_attempts,
+            "deadline_s": self.deadline,
+            "timeout_s": self.attempt_timeout,
+            "base_delay_s": self.base_delay,
+            "max_delay_s": self.max_delay,
+            "retry_on": sorted(self.retry_on),
+        }
+
+
+class RetryBudget:
+    """Retry state of one job under a RetryPolicy: attempts made, deadline, previous sleep."""
+
+    __slots__ = ("policy", "started", "attempt", "previous_delay")
+
+    def __init__(self, policy: RetryPolicy) -> None:
+        self.policy = policy
+        self.started = time.monotonic()
+        self.attempt = 1  # 1-based number of the call about to be made
+        self.previous_delay = policy.base_delay
+
+    def remaining(self) -> float:
+        return max(0.0, self.policy.deadline - (time.monotonic() - self.started))
+
+    def attempt_timeout(self) -> float:
+        return max(1.0, min(self.policy.attempt_timeout, self.remaining()))
+
+    def next_retry(self, exc: BaseException) -> Optional[Tuple[str, float]]:
+        """(cause, seconds to sleep) if the failed call should be retried, else None. Advances the attempt."""
+        cause = classify_error(exc)
+        if cause is None or cause not in self.policy.retry_on:
+            return None
+        if self.attempt >= self.policy.max_attempts:
+            return None
+
+        retry_after = getattr(exc, "retry_after", None)
+        if cause == "429":
+            delay = retry_after or 0.0
+        else:
+            upper = max(self.policy.base_delay, self.previous_delay * 3)
+            delay = min(self.policy.max_delay, random.uniform(self.policy.base_delay, upper))
+            self.previous_delay = delay
+            if retry_after:
+                delay = max(delay, retry_after)
+        # A retry that can't start before the deadline is a failure now, not later
+        if delay >= self.remaining():
+            return None
+        self.attempt += 1
+        return cause, delay
+
+
+# Defaults per (endpoint, image size): small jobs fail fast, big jobs get patience
+_DEFAULT_SPECS = {
+    ("image", "1K"): "attempts=4,deadline=300,timeout=90,base=2,max_delay=20",
+    ("image", "2K"): "attempts=5,deadline=600,timeout=150,base=2,max_delay=30",
+    ("image", "4K"): "attempts=6,deadline=1500,timeout=240,base=4,max_delay=60",
+    ("text", "*"): "attempts=4,deadline=120,timeout=60,base=1,max_delay=10",
+}
+
+
+class RetryPolicies:
+    """
+    Policy lookup by endpoint ("image", "text") and image size ("1K", "2K", "4K", "*").
+    Each default can be overridden (keys merged) with RETRY_POLICY_<ENDPOINT>_<SIZE>, e.g.
+    RETRY_POLICY_IMAGE_4K="attempts=8,deadline=2400" or RETRY_POLICY_TEXT="timeout=30".
+    """
+
+    def __init__(self, policies: Dict[Tuple[str, str], RetryPolicy]) -> None:
+        self._policies = policies
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicies":
+        policies = {}
+        for (endpoint, size), spec in _DEFAULT_SPECS.items():
+            env_name = f"RETRY_POLICY_{endpoint.upper()}" + (f"_{size}" if size != "*" else "")
+            policies[(endpoint, size)] = RetryPolicy().with_spec(spec).with_spec(os.getenv(env_name, ""))
+        return cls(policies)
+
+    def get(self, endpoint: str, image_size: str = "*") -> RetryPolicy:
+        size = str(image_size).upper()
+        policy = self._policies.get((endpoint, size)) or self._policies.get((endpoint, "*"))
+        if policy is None:
+            # Unknown size (e.g. a new tier): the most patient policy of that endpoint
+            candidates = [p for (e, _), p in self._policies.items() if e == endpoint]
+            policy = max(candidates, key=lambda p: p.deadline) if candidates else RetryPolicy()
+        return policy
+
+    def describe(self) -> Dict[str, Any]:
+        return {f"{endpoint}:{size}": policy.describe() for (endpoint, size), policy in self._policies.items()}
+
+
+@lazy_singleton
+def get_retry_policies() -> RetryPolicies:
+    return RetryPolicies.from_env()
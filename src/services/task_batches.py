@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from src.services.task_queue import TaskQueue, TaskStatus
+from src.services.config import env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRegistry:
+    """
+    Parent records of /tasks/submit/batch: batch id -> ordered child items.
+
+    A child is a normal TaskQueue task (own status, progress, result, SSE events), or a
+    rejected slot when the queue was full at submission. The batch status is derived from
+    the children on every read, so there is nothing to keep in sync. Records live in this
+    process only and expire like task records (`ttl` after creation, at most `max_batches`).
+    """
+
+    def __init__(self, queue: TaskQueue, ttl: float = 3600.0, max_batches: int = 500) -> None:
+        self.queue = queue
+        self.ttl = ttl
+        self.max_batches = max(1, max_batches)
+        self._batches: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._by_key: Dict[str, str] = {}  # idempotency key -> batch id
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, queue: TaskQueue) -> "BatchRegistry":
+        return cls(
+            queue,
+            ttl=env_float("BATCH_TTL_SECONDS", env_float("TASK_TTL_SECONDS", 3600.0)),
+            max_batches=env_int("BATCH_MAX_RECORDS", 500),
+        )
+
+    def create(self, items: List[Dict[str, Any]], key: Optional[str] = None) -> str:
+        """`items`: one dict per variant, {"task_id", "reused"} or {"status": "REJECTED", "error", "retry_after"}."""
+        batch_id = str(uuid.uuid4())
+        record = {"id": batch_id, "created_at": time.time(), "items": items, "key": key}
+        with self._lock:
+            self._evict_expired()
+            self._batches[batch_id] = record
+            if key is not None:
+                self._by_key[key] = batch_id
+            while len(self._batches) > self.max_batches:
+                _, old = self._batches.popitem(last=False)
+                self._by_key.pop(old.get("key"), None)
+        return batch_id
+
+    def find(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        with self._lock:
+            self._evict_expired()
+            return self._by_key.get(key)
+
+    def task_ids(self, batch_id: str) -> Optional[List[str]]:
+        with self._lock:
+            record = self._batches.get(batch_id)
+            if record is None:
+                return None
+            return [item["task_id"] for item in record["items"] if item.get("task_id")]
+
+    def summary(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """Batch view: aggregate status, per-status counts and the lightweight status of every child."""
+        with self._lock:
+            record = self._batches.get(batch_id)
+            if record is None:
+                return None
+            items = [dict(item) for item in record["items"]]
+
+        counts: Dict[str, int] = {}
+        views = []
+        for index, item in enumerate(items):
+            view: Dict[str, Any] = {"index": index}
+            task_id = item.get("task_id")
+            if task_id is None:
+                view.update({k: v for k, v in item.items() if k != "task_id"})
+            else:
+                task = self.queue.get_task(task_id)
+                view["task_id"] = task_id
+                if task is None:
+                    view.update(status="EXPIRED", message="Task record expired")
+                else:
+                    view.update({k: task[k] for k in ("status", "progress", "message", "error", "queue_position", "result_url") if k in task})
+                    view["status"] = getattr(view["status"], "value", view["status"])
+                if item.get("reused"):
+                    view["reused"] = True
+            counts[view["status"]] = counts.get(view["status"], 0) + 1
+            views.append(view)
+
+        return {
+            "batch_id": batch_id,
+            "status": self._aggregate(counts, len(views)),
+            "created_at": record["created_at"],
+            "total": len(views),
+            "counts": counts,
+            "items": views,
+            "events_url": f"/tasks/batch/{batch_id}/events",
+        }
+
+    @staticmethod
+    def _aggregate(counts: Dict[str, int], total: int) -> str:
+        pending = counts.get(TaskStatus.PENDING.value, 0)
+        completed = counts.get(TaskStatus.COMPLETED.value, 0)
+        if pending == total:
+            return TaskStatus.PENDING.value
+        if pending or counts.get(TaskStatus.PROCESSING.value, 0):
+            return TaskStatus.PROCESSING.value
+        if completed == total:
+            return TaskStatus.COMPLETED.value
+        return "PARTIAL" if completed else TaskStatus.FAILED.value
+
+    def _evict_expired(self) -> None:
+        """Caller holds the lock."""
+        if self.ttl <= 0:
+            return
+        cutoff = time.time() - self.ttl
+        while self._batches:
+            batch_id, record = next(iter(self._batches.items()))
+            if record["created_at"] >= cutoff:
+                break
+            del self._batches[batch_id]
+            self._by_key.pop(record.get("key"), None)
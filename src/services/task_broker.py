@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from src.services.task_store import SQLiteTaskStore, _DEFAULT_STORE_DIR, _TERMINAL_SQL, _dumps, _status
+from src.services.config import env_float
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_LEASE_SECONDS = env_float("TASK_BROKER_LEASE_SECONDS", 30.0)
+_DEFAULT_POLL_INTERVAL = env_float("TASK_BROKER_POLL_INTERVAL", 0.5)
+_DEFAULT_FLUSH_INTERVAL = env_float("TASK_BROKER_FLUSH_INTERVAL", 0.25)
+
+
+class SQLiteTaskBroker(SQLiteTaskStore):
+    """
+    Shared queue + status table for several API / worker processes (same host, or hosts
+    sharing the file over a filesystem with working locks).
+
+    - enqueue() inserts a PENDING row right away, so any process can see it, tagged for
+      fair scheduling the same way as the local queue (see TaskQueue._enqueue_pending).
+    - claim() atomically flips the lowest-tag PENDING row to PROCESSING and leases it to
+      `owner` for `lease_seconds`. The owner renews the lease while the job runs; rows whose
+      lease ran out (crashed/hung worker) go back to PENDING via requeue_expired().
+    - Progress writes from the owner go through the batched TaskStore writer and only
+      apply while the row is still leased to it and not finished (a remote cancel wins).
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        lease_seconds: float = _DEFAULT_LEASE_SECONDS,
+        poll_interval: float = _DEFAULT_POLL_INTERVAL,
+        flush_interval: float = _DEFAULT_FLUSH_INTERVAL,
+    ) -> None:
+        path = path or os.getenv("TASK_BROKER_PATH") or os.path.join(_DEFAULT_STORE_DIR, "broker.db")
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        super().__init__(path, flush_interval=flush_interval)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+        if "owner" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN owner TEXT")
+        if "lease_until" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN lease_until REAL")
+        if "user_id" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN user_id TEXT")
+        if "sched_tag" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN sched_tag REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_sched ON tasks (status, sched_tag)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user ON tasks (user_id, status)")
+        self._conn.commit()
+
+    @contextmanager
+    def _write_txn(self):
+        """Serialized write transaction (BEGIN IMMEDIATE takes the write lock up front)."""
+        with self._io_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except Exception:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+    # --- Queue operations ---
+
+    def enqueue(self, record: Dict[str, Any], cost: float = 1.0) -> None:
+        user_id = record.get("user_id")
+        with self._write_txn() as conn:
+            # Virtual time = tag of the next task in line (or of the last one claimed)
+            virtual_time = conn.execute(
+                "SELECT COALESCE((SELECT MIN(sched_tag) FROM tasks WHERE status = 'PENDING'),"
+                " (SELECT MAX(sched_tag) FROM tasks WHERE status != 'PENDING'), 0)"
+            ).fetchone()[0]
+            start = virtual_time
+            if user_id:
+                user_tag = conn.execute(
+                    "SELECT MAX(sched_tag) FROM tasks WHERE user_id = ? AND status IN ('PENDING', 'PROCESSING')",
+                    (user_id,),
+                ).fetchone()[0]
+                start = max(start, user_tag or 0)
+            conn.execute(
+                "INSERT INTO tasks (id, status, updated_at, data, user_id, sched_tag) VALUES (?, ?, ?, ?, ?, ?)",
+                (record["id"], _status(record), record["updated_at"], _dumps(record), user_id, start + cost),
+            )
+
+    def claim(self, max_running_per_user: int = 0) -> Optional[Dict[str, Any]]:
+        """
+        Takes the lowest-tag PENDING task whose user is below `max_running_per_user` running
+        tasks across all processes (0 = no cap; a task's own "max_running" overrides it).
+        Returns its record or None.
+        """
+        now = time.time()
+        cap = "COALESCE(json_extract(p.data, '$.max_running'), ?)"
+        with self._write_txn() as conn:
+            row = conn.execute(
+                "UPDATE tasks SET status = 'PROCESSING', owner = ?, lease_until = ?, updated_at = ?,"
+                " data = json_set(data, '$.status', 'PROCESSING', '$.message', 'Claimed by worker', '$.updated_at', ?)"
+                " WHERE id = (SELECT id FROM tasks AS p WHERE p.status = 'PENDING'"
+                f" AND ({cap} = 0 OR p.user_id IS NULL OR (SELECT COUNT(*) FROM tasks AS r"
+                f" WHERE r.user_id = p.user_id AND r.status = 'PROCESSING') < {cap})"
+                " ORDER BY p.sched_tag, p.rowid LIMIT 1)"
+                " RETURNING data",
+                (self.owner, now + self.lease_seconds, now, now, max_running_per_user, max_running_per_user),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def renew(self, task_ids: Iterable[str]) -> Set[str]:
+        """Extends the leases of running tasks. Returns the ids this process no longer owns."""
+        task_ids = list(task_ids)
+        if not task_ids:
+            return set()
+        lease_until = time.time() + self.lease_seconds
+        kept = set()
+        with self._write_txn() as conn:
+            for task_id in task_ids:
+                row = conn.execute(
+                    "UPDATE tasks SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'PROCESSING' RETURNING id",
+                    (lease_until, task_id, self.owner),
+                ).fetchone()
+                if row:
+                    kept.add(row[0])
+        return set(task_ids) - kept
+
+    def requeue_expired(self) -> int:
+        """Puts tasks whose worker stopped renewing back in the queue."""
+        now = time.time()
+        with self._write_txn() as conn:
+            rows = conn.execute(
+                "UPDATE tasks SET status = 'PENDING', owner = NULL, lease_until = NULL, updated_at = ?,"
+                " data = json_set(data, '$.status', 'PENDING', '$.progress', 0,"
+                " '$.message', 'Worker lost, re-queued', '$.updated_at', ?)"
+                " WHERE status = 'PROCESSING' AND lease_until < ? RETURNING id",
+                (now, now, now),
+            ).fetchall()
+        if rows:
+            logger.warning(f"Re-queued {len(rows)} tasks with expired leases")
+        return len(rows)
+
+    def release(self) -> int:
+        """Graceful shutdown: hand this process's running tasks back to the queue."""
+        self.flush()
+        now = time.time()
+        with self._write_txn() as conn:
+            rows = conn.execute(
+                "UPDATE tasks SET status = 'PENDING', owner = NULL, lease_until = NULL, updated_at = ?,"
+                " data = json_set(data, '$.status', 'PENDING', '$.progress', 0,"
+                " '$.message', 'Worker stopped, re-queued', '$.updated_at', ?)"
+                " WHERE status = 'PROCESSING' AND owner = ? RETURNING id",
+                (now, now, self.owner),
+            ).fetchall()
+        return len(rows)
+
+    def cancel(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Marks a task CANCELLED. Returns the updated record, or None if unknown/finished."""
+        now = time.time()
+        with self._write_txn() as conn:
+            row = conn.execute(
+                "UPDATE tasks SET status = 'CANCELLED', updated_at = ?,"
+                " data = json_set(data, '$.status', 'CANCELLED', '$.message', 'Cancelled by user', '$.updated_at', ?)"
+                f" WHERE id = ? AND status NOT IN {_TERMINAL_SQL} RETURNING data",
+                (now, now, task_id),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def prune_terminal(self, older_than: float) -> int:
+        with self._write_txn() as conn:
+            cursor = conn.execute(
+                f"DELETE FROM tasks WHERE status IN {_TERMINAL_SQL} AND updated_at < ?",
+                (time.time() - older_than,),
+            )
+        return cursor.rowcount
+
+    # --- Reads (any process) ---
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._io_lock:
+            row = self._conn.execute("SELECT data FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, task_ids: Iterable[str]) -> List[Dict[str, Any]]:
+        task_ids = list(task_ids)
+        if not task_ids:
+            return []
+        placeholders = ",".join("?" * len(task_ids))
+        with self._io_lock:
+            rows = self._conn.execute(f"SELECT data FROM tasks WHERE id IN ({placeholders})", task_ids).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def position(self, task_id: str) -> Optional[int]:
+        """1-based position of a PENDING task in the shared queue (ignoring per-user caps)."""
+        with self._io_lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM tasks AS p, (SELECT sched_tag, rowid AS rid FROM tasks"
+                " WHERE id = ? AND status = 'PENDING') AS me"
+                " WHERE p.status = 'PENDING' AND (p.sched_tag < me.sched_tag"
+                " OR (p.sched_tag = me.sched_tag AND p.rowid <= me.rid))",
+                (task_id,),
+            ).fetchone()
+        return row[0] or None
+
+    def counts(self) -> Dict[str, int]:
+        with self._io_lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        return dict(rows)
+
+    def count_pending(self) -> int:
+        return self.counts().get("PENDING", 0)
+
+    # --- Batched writer ---
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        # Records are read on demand; nothing is preloaded into a process
+        return []
+
+    def _write_batch(self, batch: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        updates: List[Tuple[Any, ...]] = []
+        for task_id, record in batch.items():
+            if record is None:
+                continue
+            status = _status(record)
+            updates.append((status, record.get("updated_at", 0), _dumps(record),
+                            task_id, self.owner, status))
+        if not updates:
+            return
+        with self._conn:
+            # Only the lease holder writes, and a finished row (e.g. cancelled elsewhere) is never reopened
+            self._conn.executemany(
+                "UPDATE tasks SET status = ?, updated_at = ?, data = ? WHERE id = ? AND owner = ?"
+                f" AND (status NOT IN {_TERMINAL_SQL} OR status = ?)",
+                updates,
+            )
+
+
+def create_task_broker(kind: Optional[str] = None) -> Optional[SQLiteTaskBroker]:
+    """Build the broker selected by TASK_BROKER: sqlite, or none (single-process queue, the default)."""
+    kind = (kind or os.getenv("TASK_BROKER", "none")).lower()
+    if kind == "sqlite":
+        return SQLiteTaskBroker()
+    if kind in ("none", ""):
+        return None
+    raise ValueError(f"Unknown TASK_BROKER backend: {kind}")
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from src.services.task_queue import TaskQueue, TaskStatus
+from src.services.config import env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+
+def _image_token(item: Any) -> Any:
+    # Data URIs are hashed by their payload only (same bytes, different MIME prefix = same input);
+    # URLs and upload names are already short and stable
+    if isinstance(item, str) and item.startswith("data:"):
+        encoded = item.split(",", 1)[-1]
+        return "sha256:" + hashlib.sha256(encoded.encode("ascii", "ignore")).hexdigest()
+    return item
+
+
+class TaskDeduplicator:
+    """
+    Idempotency layer in front of TaskQueue.submit_task.
+
+    Two keys point at a submitted task:
+      - the X-Transaction-ID (per user): a retried proxy call gets its original task back,
+        whatever state it is in, as long as the task record still exists
+      - a canonical hash of the request (task type, generation config, prompt, input image
+        hashes, user): byte-identical submissions (double clicks) share the running task.
+        With `result_ttl` > 0 a completed one is reused for that many seconds; off by default,
+        since asking again for the same inputs (Remix, regenerate) usually means a new image
+
+    Content matching can be skipped per request (a deliberate re-roll); failed and cancelled
+    tasks are never reused. Keys are kept in a bounded LRU of this process only.
+    """
+
+    def __init__(self, queue: TaskQueue, max_keys: int = 2048, result_ttl: float = 0.0) -> None:
+        self.queue = queue
+        self.max_keys = max(1, max_keys)
+        self.result_ttl = result_ttl
+        self._keys: "OrderedDict[str, str]" = OrderedDict()  # key -> task_id
+        self._lock = threading.Lock()
+
+        # Monitoring counters
+        self.coalesced = 0
+        self.reused_results = 0
+        self.replayed = 0
+
+    @classmethod
+    def from_env(cls, queue: TaskQueue) -> "TaskDeduplicator":
+        return cls(
+            queue,
+            max_keys=env_int("TASK_DEDUP_MAX_KEYS", 2048),
+            result_ttl=env_float("TASK_DEDUP_RESULT_TTL", 0.0),
+        )
+
+    @staticmethod
+    def content_key(task_type: str, metadata: Dict[str, Any], user_id: Optional[str]) -> str:
+        """Canonical request hash. Hashes multi-MB data URIs: call it off the event loop for large payloads."""
+        canonical = {k: v for k, v in metadata.items() if k not in ("image_url", "images")}
+        inputs = [metadata.get("image_url")] + list(metadata.get("images") or [])
+        canonical["inputs"] = [_image_token(item) for item in inputs if item]
+        blob = json.dumps([task_type, user_id or "", canonical], sort_keys=True, ensure_ascii=False, default=str)
+        return "req:" + hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def transaction_key(transaction_id: Optional[str], user_id: Optional[str]) -> Optional[str]:
+        # api_server invents "unknown_<ts>" when the header is missing: not an idempotency key
+        if not transaction_id or transaction_id.startswith("unknown_"):
+            return None
+        return f"tx:{user_id or ''}:{transaction_id}"
+
+    async def find(self, transaction_key: Optional[str], content_key: Optional[str]) -> Optional[str]:
+        """
+        Task id to answer with instead of submitting, or None. Pass content_key=None to opt out of content matching.
+        Status lookups of broker tasks run in the executor; if another request re-points one of the
+        keys meanwhile, the lookup is redone. So a None answer holds until the caller's next await:
+        submit and remember() before awaiting anything else.
+        """
+        while True:
+            with self._lock:
+                seen = (self._keys.get(transaction_key), self._keys.get(content_key))
+            task_id = await self._lookup(transaction_key, content_key)
+            if task_id is not None:
+                return task_id
+            with self._lock:
+                if (self._keys.get(transaction_key), self._keys.get(content_key)) == seen:
+                    return None
+
+    def remember(self, task_id: str, transaction_key: Optional[str], content_key: Optional[str]) -> None:
+        with self._lock:
+            for key in (transaction_key, content_key):
+                if key is None:
+                    continue
+                self._keys[key] = task_id
+                self._keys.move_to_end(key)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            keys = len(self._keys)
+        return {
+            "keys": keys,
+            "coalesced": self.coalesced,
+            "reused_results": self.reused_results,
+            "replayed": self.replayed,
+            "result_ttl": self.result_ttl,
+        }
+
+    async def _lookup(self, transaction_key: Optional[str], content_key: Optional[str]) -> Optional[str]:
+        if transaction_key is not None:
+            task_id = await self._live_task(transaction_key, allow_completed=True)
+            if task_id is not None:
+                self.replayed += 1
+                return task_id
+        if content_key is not None:
+            return await self._live_task(content_key, allow_completed=self.result_ttl > 0)
+        return None
+
+    async def _live_task(self, key: str, allow_completed: bool) -> Optional[str]:
+        with self._lock:
+            task_id = self._keys.get(key)
+        if task_id is None:
+            return None
+        # Local tasks answer inline; tasks of other broker processes are a blocking query
+        task = await self.queue.get_task_async(task_id)
+        status = task["status"] if task else None
+        if status in (TaskStatus.PENDING, TaskStatus.PROCESSING):
+            if key.startswith("req:"):
+                self.coalesced += 1
+            return task_id
+        if status == TaskStatus.COMPLETED and allow_completed:
+            # Transaction replays get their result for as long as the record lives;
+            # content matches only within result_ttl of completion
+            if key.startswith("tx:") or time.time() - float(task.get("updated_at") or 0) <= self.result_ttl:
+                if key.startswith("req:"):
+                    self.reused_results += 1
+                return task_id
+            return None
+        if status is None or self.queue.is_terminal(status):
+            # Expired, failed or cancelled: a new submission is the right answer
+            with self._lock:
+                if self._keys.get(key) == task_id:
+                    del self._keys[key]
+        return None
@@ -1,13 +1,43 @@
 import asyncio
+import json
+import math
+import os
 import uuid
 import time
 import logging
 import threading
-from typing import Dict, Any, Optional, Callable, Awaitable
+from typing import Dict, Any, Iterable, List, Optional, Callable, Awaitable, Set, Tuple
 from enum import Enum
 
+from src.services.blob_store import get_blob_store
+from src.services.metrics import stage_seconds
+from src.services.task_store import TaskStore
+from src.services.task_broker import SQLiteTaskBroker
+from src.services.config import env_float, env_int
+
 logger = logging.getLogger(__name__)
 
+# Worker pool size = max concurrent generations; pending queue bound = admission limit
+_DEFAULT_MAX_WORKERS = env_int("TASK_QUEUE_WORKERS", 4)
+_DEFAULT_MAX_PENDING = env_int("TASK_QUEUE_MAX_PENDING", 100)
+# Terminal task records are evicted after a TTL or when the table grows past max records
+_DEFAULT_TASK_TTL = env_float("TASK_TTL_SECONDS", 3600.0)
+_DEFAULT_MAX_RECORDS = env_int("TASK_MAX_RECORDS", 500)
+# Results/metadata larger than this are spilled to the blob store once the task is done
+_DEFAULT_SPILL_BYTES = env_int("TASK_RESULT_SPILL_BYTES", 64 * 1024)
+_BLOB_TTL = env_float("BLOB_TTL_SECONDS", 24 * 3600.0)
+_BLOB_PRUNE_INTERVAL = 600.0
+# Scheduling: each lane has a cost (roughly its relative run time); users share the pool
+# fairly by cost, and a single user never holds more than TASK_USER_MAX_RUNNING workers (0 = no cap)
+_DEFAULT_LANE_COSTS = os.getenv("TASK_LANE_COSTS", "interactive=1,standard=2,batch=4")
+_DEFAULT_USER_MAX_RUNNING = env_int("TASK_USER_MAX_RUNNING", 2)
+DEFAULT_LANE = "standard"
+# Broker mode: how often leases are renewed / expired ones re-queued / old rows pruned
+_BROKER_MAINTENANCE_INTERVAL = 5.0
+
+# Fields that are only returned by get_task_details (the polling path stays lightweight)
+_HEAVY_FIELDS = ("result", "metadata")
+
 class TaskStatus(str, Enum):
     PENDING = "PENDING"
     PROCESSING = "PROCESSING"
@@ -15,45 +45,479 @@ class TaskStatus(str, Enum):
     FAILED = "FAILED"
     CANCELLED = "CANCELLED"
 
+_TERMINAL_STATUSES = (TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED)
+
+def _parse_lane_costs(spec: str) -> Dict[str, float]:
+    costs = {}
+    for item in spec.split(","):
+        name, _, cost = item.partition("=")
+        try:
+            costs[name.strip()] = max(float(cost), 0.01)
+        except ValueError:
+            logger.warning(f"Ignoring invalid TASK_LANE_COSTS entry: {item!r}")
+    costs.setdefault(DEFAULT_LANE, 2.0)
+    return costs
+
+class QueueFullError(Exception):
+    """Raised by submit_task when the pending queue is at capacity."""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Task queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class TaskSubscription:
+    """
+    A push channel for status updates of a set of tasks (used by the SSE endpoint).
+    Events are delivered onto `queue` from whichever thread called update_task.
+    """
+    def __init__(self, task_ids: Iterable[str]):
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task_ids: Set[str] = set(task_ids)
+
+    def push(self, event: Dict[str, Any]):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
 class TaskQueue:
     _instance = None
     _tasks: Dict[str, Dict[str, Any]] = {}
     _lock = threading.Lock()
 
+    # Bounded worker pool: PENDING tasks wait in _pending until a worker picks them up
+    max_workers: int = _DEFAULT_MAX_WORKERS
+    max_pending: int = _DEFAULT_MAX_PENDING
+    _pending: List[str] = []
+
+    # Fair scheduling (self-clocked fair queuing): a task's tag is
+    # max(virtual time, its user's last tag) + lane cost, and workers take the lowest tag whose
+    # user is under the running cap. Cheap interactive jobs overtake queued 4K batches, and a
+    # user who queues fifty jobs only pushes back their own later jobs.
+    lane_costs: Dict[str, float] = _parse_lane_costs(_DEFAULT_LANE_COSTS)
+    max_running_per_user: int = _DEFAULT_USER_MAX_RUNNING
+    _tags: Dict[str, float] = {}  # pending task_id -> finish tag
+    _virtual_time: float = 0.0
+    _user_tags: Dict[str, float] = {}  # user_id -> tag of their latest queued task
+    _user_running: Dict[str, int] = {}
+    _slot_freed: Optional[asyncio.Event] = None  # wakes workers blocked by the per-user cap
+    _jobs: Dict[str, Tuple[Callable[..., Awaitable[Any]], tuple, dict]] = {}
+    _workers: List[asyncio.Task] = []
+    _available: Optional[asyncio.Semaphore] = None
+    _running: int = 0
+    _avg_duration: float = 60.0  # EMA of task run time, used for Retry-After hints
+    # task_id -> asyncio.Task running the job body, so cancel_task can interrupt it
+    _inflight: Dict[str, asyncio.Task] = {}
+    # Live SSE subscribers, notified from update_task/cancel_task
+    _subscribers: List[TaskSubscription] = []
+
+    # Record retention: terminal tasks expire, large payloads live in the blob store
+    task_ttl: float = _DEFAULT_TASK_TTL
+    max_records: int = _DEFAULT_MAX_RECORDS
+    spill_bytes: int = _DEFAULT_SPILL_BYTES
+    _last_blob_prune: float = 0.0
+
+    # Optional durable backend + job factories used to resume tasks after a restart
+    _store: Optional[TaskStore] = None
+    _handlers: Dict[str, Callable[[Dict[str, Any]], Callable[..., Awaitable[Any]]]] = {}
+
+    # Optional shared broker: several processes/hosts pull from one queue and status table.
+    # Local _tasks then only holds the tasks this process is executing.
+    _broker: Optional[SQLiteTaskBroker] = None
+    _watcher: Optional[asyncio.Task] = None
+    _remote_seen: Dict[str, float] = {}  # task_id -> updated_at already pushed to SSE subscribers
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(TaskQueue, cls).__new__(cls)
         return cls._instance
 
-    def submit_task(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> str:
+    def configure(
+        self,
+        max_workers: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        task_ttl: Optional[float] = None,
+        max_records: Optional[int] = None,
+        spill_bytes: Optional[int] = None,
+        lane_costs: Optional[Dict[str, float]] = None,
+        max_running_per_user: Optional[int] = None,
+    ):
+        """Override pool/retention/scheduling limits (pool size must be set before the first submission starts the workers)."""
+        if max_workers is not None:
+            # 0 = this process only submits/serves status (broker mode, other processes run the jobs)
+            self.max_workers = max(0, max_workers)
+        if max_pending is not None:
+            self.max_pending = max(1, max_pending)
+        if task_ttl is not None:
+            self.task_ttl = task_ttl
+        if max_records is not None:
+            self.max_records = max(1, max_records)
+        if spill_bytes is not None:
+            self.spill_bytes = spill_bytes
+        if lane_costs is not None:
+            self.lane_costs = {**self.lane_costs, **lane_costs}
+        if max_running_per_user is not None:
+            self.max_running_per_user = max(0, max_running_per_user)
+
+    def attach_store(self, store: TaskStore):
+        self._store = store
+
+    def attach_broker(self, broker: SQLiteTaskBroker):
+        """Switch to shared-queue mode. The broker is also the durable store."""
+        self._broker = broker
+        self._store = broker
+
+    def register_handler(self, task_type: str, factory: Callable[[Dict[str, Any]], Callable[..., Awaitable[Any]]]):
         """
-        Submits an async task to be executed in the background.
-        Returns the task_id.
+        Registers how to rebuild the job function of a `task_type` from its stored record
+        (metadata + transaction_id). Only typed tasks can be resumed after a restart.
+        """
+        self._handlers[task_type] = factory
+
+    def submit_task(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        *args,
+        task_type: Optional[str] = None,
+        transaction_id: Optional[str] = None,
+        user_id: Optional[str] = None,
+        lane: str = DEFAULT_LANE,
+        max_running: Optional[int] = None,
+        **kwargs,
+    ) -> str:
+        """
+        Submits an async task to the bounded worker pool.
+        `lane` picks the priority class (see lane_costs), `user_id` the fairness/cap bucket
+        (anonymous tasks are neither grouped nor capped). `max_running` overrides the per-user
+        running cap for this task: it starts while its user has fewer running tasks than that.
+        Returns the task_id, or raises QueueFullError when the pending queue is full.
         """
         task_id = str(uuid.uuid4())
-        
+        if lane not in self.lane_costs:
+            lane = DEFAULT_LANE
+        self._ensure_workers()
+        self._evict_expired()
+        if self._broker is not None:
+            return self._submit_to_broker(task_id, task_type, transaction_id, kwargs.get("metadata", {}), user_id, lane, max_running)
+
+        metadata = kwargs.get("metadata", {})
+        # The store only needs the metadata to rebuild the job after a restart: large payloads
+        # (input data URIs) go to the blob store once instead of into every record write
+        refs = self._spill({"metadata": metadata}) if metadata and self._store is not None else {}
+
         with self._lock:
+            if len(self._pending) >= self.max_pending:
+                raise QueueFullError(self._retry_after_hint(len(self._pending)))
+
             self._tasks[task_id] = {
                 "id": task_id,
                 "status": TaskStatus.PENDING,
                 "created_at": time.time(),
                 "updated_at": time.time(),
                 "progress": 0,
-                "message": "Initializing...",
+                "message": "Queued",
                 "result": None,
                 "error": None,
-                "metadata": kwargs.get("metadata", {})
+                "metadata": metadata,
+                "task_type": task_type,
+                "transaction_id": transaction_id,
+                "user_id": user_id,
+                "lane": lane,
+                "max_running": max_running,
             }
+            if refs:
+                self._tasks[task_id]["metadata_ref"] = refs["metadata"]
+            self._enqueue_pending(task_id)
+            self._jobs[task_id] = (func, args, kwargs)
+            record = dict(self._tasks[task_id])
+
+        self._save(record, urgent=True)
 
-        # Fire and forget - run in background
         # Note: In a real production app with multiple workers, we'd use Celery/Redis.
-        # For this single-process FastAPI app, creating a Task on the event loop is sufficient.
-        loop = asyncio.get_running_loop()
-        loop.create_task(self._execute_task(task_id, func, *args, **kwargs))
+        # For this single-process FastAPI app, a fixed pool of asyncio workers is sufficient.
+        self._available.release()
+        self._slot_freed.set()
         
         return task_id
 
+    # --- Fair scheduling ---
+
+    def _enqueue_pending(self, task_id: str):
+        """Tags and queues a PENDING task. Caller holds the lock."""
+        task = self._tasks[task_id]
+        user_id = task.get("user_id")
+        start = max(self._virtual_time, self._user_tags.get(user_id, 0.0)) if user_id else self._virtual_time
+        tag = start + self.lane_costs.get(task.get("lane") or DEFAULT_LANE, self.lane_costs[DEFAULT_LANE])
+        if user_id:
+            self._user_tags[user_id] = tag
+        self._tags[task_id] = tag
+        self._pending.append(task_id)
+
+    def _user_at_cap(self, user_id: Optional[str], max_running: Optional[int] = None) -> bool:
+        cap = self.max_running_per_user if max_running is None else max_running
+        return bool(user_id and cap and self._user_running.get(user_id, 0) >= cap)
+
+    def _pick_next(self) -> Optional[str]:
+        """Lowest-tag pending task whose user has a free slot (FIFO on ties). Caller holds the lock."""
+        best = None
+        for task_id in self._pending:
+            task = self._tasks[task_id]
+            if self._user_at_cap(task.get("user_id"), task.get("max_running")):
+                continue
+            if best is None or self._tags[task_id] < self._tags[best]:
+                best = task_id
+        if best is None:
+            return None
+        self._pending.remove(best)
+        self._virtual_time = max(self._virtual_time, self._tags.pop(best))
+        # Users whose last tag is behind the clock restart from virtual time anyway
+        self._user_tags = {u: t for u, t in self._user_tags.items() if t > self._virtual_time}
+        return best
+
+    def _queue_position(self, task_id: str) -> Optional[int]:
+        tag = self._tags.get(task_id)
+        if tag is None:
+            return None
+        # Estimate: ignores the per-user cap, which can only move a task forward
+        position, seen = 1, False
+        for other in self._pending:
+            if other == task_id:
+                seen = True
+            elif self._tags[other] < tag or (not seen and self._tags[other] == tag):
+                position += 1
+        return position
+
+    def _submit_to_broker(
+        self, task_id: str, task_type: Optional[str], transaction_id: Optional[str], metadata: Any,
+        user_id: Optional[str], lane: str, max_running: Optional[int] = None,
+    ) -> str:
+        """
+        Broker mode: any process may run the job, so it must be rebuildable from the record
+        (registered task_type). Large metadata goes to the blob store, which has to be shared too.
+        """
+        if task_type not in self._handlers:
+            raise ValueError(f"Task type {task_type!r} has no registered handler, cannot run it through the broker")
+        pending = self._broker.count_pending()
+        if pending >= self.max_pending:
+            raise QueueFullError(self._retry_after_hint(pending))
+
+        now = time.time()
+        record = {
+            "id": task_id,
+            "status": TaskStatus.PENDING,
+            "created_at": now,
+            "updated_at": now,
+            "progress": 0,
+            "message": "Queued",
+            "result": None,
+            "error": None,
+            "metadata": metadata,
+            "task_type": task_type,
+            "transaction_id": transaction_id,
+            "user_id": user_id,
+            "lane": lane,
+            "max_running": max_running,
+        }
+        refs = self._spill({"metadata": metadata}) if metadata else {}
+        if refs:
+            record["metadata"] = None
+            record["metadata_ref"] = refs["metadata"]
+        self._broker.enqueue(record, cost=self.lane_costs[lane])
+        if self._workers:
+            # Wake a local worker instead of waiting for its next poll
+            self._available.release()
+        return task_id
+
+    def _retry_after_hint(self, pending: int) -> int:
+        # Rough time until a pending slot frees up: one "round" of the worker pool
+        return max(1, min(300, math.ceil(self._avg_duration * pending / (max(self.max_workers, 1) * 4))))
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._broker is not None:
+            if self._watcher is None or self._watcher.done() or self._watcher.get_loop() is not loop:
+                self._watcher = loop.create_task(self._broker_watch_loop())
+        # Without a broker nobody else can run the jobs, so at least one worker
+        target = self.max_workers if self._broker is not None else max(1, self.max_workers)
+        alive = [w for w in self._workers if not w.done() and w.get_loop() is loop]
+        if alive and len(alive) >= target:
+            return
+        if not alive:
+            # First start (or a new event loop): hand out permits for anything already queued
+            self._available = asyncio.Semaphore(len(self._pending))
+            self._slot_freed = asyncio.Event()
+            if target == 0:
+                return
+        worker_loop = self._broker_worker_loop if self._broker is not None else self._worker_loop
+        for worker_id in range(len(alive), target):
+            alive.append(loop.create_task(worker_loop(worker_id)))
+        self._workers = alive
+        mode = f"broker {self._broker.owner}" if self._broker is not None else "local"
+        logger.info(f"TaskQueue running {len(alive)} workers ({mode}, max pending {self.max_pending})")
+
+    async def _worker_loop(self, worker_id: int):
+        while True:
+            await self._available.acquire()
+            with self._lock:
+                if not self._pending:
+                    # Permit of a job that was cancelled while queued
+                    continue
+                task_id = self._pick_next()
+                if task_id is not None:
+                    func, args, kwargs = self._jobs.pop(task_id)
+                    task = self._tasks.get(task_id)
+                    if task is None or task["status"] == TaskStatus.CANCELLED:
+                        continue
+                    user_id = task.get("user_id")
+                    if user_id:
+                        self._user_running[user_id] = self._user_running.get(user_id, 0) + 1
+                    self._running += 1
+            if task_id is None:
+                # Everything queued belongs to users at their cap: give the permit back and
+                # wait for one of their jobs to finish (or a new submission)
+                self._available.release()
+                self._slot_freed.clear()
+                await self._slot_freed.wait()
+                continue
+            started = time.monotonic()
+            try:
+                await self._execute_task(task_id, func, *args, **kwargs)
+            except Exception:
+                logger.exception(f"Worker {worker_id} crashed on task {task_id}")
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.monotonic() - started)
+                    if user_id:
+                        self._user_running[user_id] -= 1
+                        if not self._user_running[user_id]:
+                            del self._user_running[user_id]
+                self._slot_freed.set()
+
+    async def _broker_worker_loop(self, worker_id: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                record = await loop.run_in_executor(None, self._broker.claim, self.max_running_per_user)
+            except Exception as e:
+                logger.warning(f"Worker {worker_id} failed to claim from broker: {e}")
+                record = None
+            if record is None:
+                try:
+                    # Local submissions wake us early; remote ones are picked up on the next poll
+                    await asyncio.wait_for(self._available.acquire(), timeout=self._broker.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task_id = record["id"]
+            record["status"] = TaskStatus(record["status"])
+            try:
+                if record.get("metadata") is None and record.get("metadata_ref"):
+                    raw = await loop.run_in_executor(None, get_blob_store().get, record["metadata_ref"])
+                    record["metadata"] = json.loads(raw) if raw is not None else None
+                func = self._handlers[record["task_type"]](record)
+            except Exception as e:
+                logger.exception(f"Worker {worker_id} cannot rebuild task {task_id}")
+                func = None
+                error = e
+            with self._lock:
+                self._tasks[task_id] = record
+                self._running += 1
+            if func is None:
+                self.update_task(task_id, status=TaskStatus.FAILED, error=str(error), message=f"Error: {error}")
+                with self._lock:
+                    self._running -= 1
+                continue
+
+            started = time.monotonic()
+            try:
+                await self._execute_task(task_id, func, metadata=record.get("metadata"))
+            except Exception:
+                logger.exception(f"Worker {worker_id} crashed on task {task_id}")
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.monotonic() - started)
+                    # The broker row is the record of truth from here on
+                    self._tasks.pop(task_id, None)
+
+    async def _broker_watch_loop(self):
+        """
+        Per-process housekeeping in broker mode:
+        renews leases of local jobs (and drops the ones cancelled elsewhere or lost),
+        re-queues tasks of dead workers, prunes old rows, and pushes remote progress to SSE.
+        """
+        loop = asyncio.get_running_loop()
+        last_maintenance = last_prune = 0.0
+        while True:
+            await asyncio.sleep(self._broker.poll_interval)
+            try:
+                now = time.monotonic()
+                if now - last_maintenance >= min(_BROKER_MAINTENANCE_INTERVAL, self._broker.lease_seconds / 3):
+                    last_maintenance = now
+                    with self._lock:
+                        local_ids = list(self._inflight)
+                    lost = await loop.run_in_executor(None, self._broker.renew, local_ids)
+                    for task_id in lost:
+                        self._drop_local_job(task_id)
+                    await loop.run_in_executor(None, self._broker.requeue_expired)
+                    if now - last_prune > _BLOB_PRUNE_INTERVAL:
+                        last_prune = now
+                        await loop.run_in_executor(None, self._broker.prune_terminal, self.task_ttl)
+                await self._publish_remote_updates()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Broker maintenance failed: {e}")
+
+    def _drop_local_job(self, task_id: str):
+        """The broker row was cancelled elsewhere or re-leased: stop the job without writing anything back."""
+        with self._lock:
+            self._tasks.pop(task_id, None)
+            job = self._inflight.get(task_id)
+        if job is not None and not job.done():
+            logger.info(f"Task {task_id} was cancelled or re-assigned elsewhere, stopping local job")
+            job.cancel()
+
+    async def _publish_remote_updates(self):
+        with self._lock:
+            watched = {t for s in self._subscribers for t in s.task_ids if t not in self._tasks}
+        for task_id in list(self._remote_seen):
+            if task_id not in watched:
+                self._remote_seen.pop(task_id, None)
+        if not watched:
+            return
+        loop = asyncio.get_running_loop()
+        records = await loop.run_in_executor(None, self._broker.get_many, watched)
+        changed = []
+        for record in records:
+            if self._remote_seen.get(record["id"]) == record["updated_at"]:
+                continue
+            self._remote_seen[record["id"]] = record["updated_at"]
+            changed.append(record)
+        if changed:
+            # Views of pending tasks query their queue position: in the executor as well
+            views = await loop.run_in_executor(None, lambda: [self._remote_view(r) for r in changed])
+            for view in views:
+                self._publish(view)
+
+    def _remote_view(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """Status view of a broker record. Blocking (broker query): not on the event loop."""
+        record["status"] = TaskStatus(record["status"])
+        with self._lock:
+            view = self._status_view(record)
+        if record["status"] == TaskStatus.PENDING:
+            view["queue_position"] = self._broker.position(record["id"])
+        return view
+
     async def _execute_task(self, task_id: str, func: Callable, *args, **kwargs):
+        with self._lock:
+            task = self._tasks.get(task_id) or {}
+            created_at = task.get("created_at")
+            metadata = task.get("metadata") or {}
+        if created_at:
+            stage_seconds.observe(
+                max(0.0, time.time() - created_at), stage="queue_wait", outcome="ok",
+                image_size=metadata.get("image_size"), aspect_ratio=metadata.get("aspect_ratio"),
+            )
         self.update_task(task_id, status=TaskStatus.PROCESSING, progress=5, message="Starting...")
         
         try:
@@ -69,33 +533,199 @@ class TaskQueue:
             # (Simple Hack: just pass it as kwarg if the func seems to support it, 
             # or rely on the func to be wrapped)
             # For now, let's just run it. The service typically doesn't know about this queue.
-            # We might need to modify the service to accept a callback if we want fine-grained progress.
-            # But for now, let's just await the result.
-            
-            # If we want to support cancellation, we should check status periodically, 
-            # but standard await is hard to cancel unless we wrap in wait_for or similar.
-            
-            result = await func(progress_callback=progress_callback, *args, **kwargs)
             
+            # The job body runs as its own asyncio.Task so cancel_task() can interrupt it:
+            # the CancelledError aborts in-flight HTTP requests and retry sleeps immediately.
+            job = asyncio.ensure_future(func(progress_callback=progress_callback, *args, **kwargs))
             with self._lock:
-                if self._tasks[task_id]["status"] == TaskStatus.CANCELLED:
-                    logger.info(f"Task {task_id} finished but was cancelled. Discarding result.")
+                self._inflight[task_id] = job
+            try:
+                result = await job
+            except asyncio.CancelledError:
+                # Cancelled via cancel_task: swallow so the worker slot is freed for the next job.
+                # Anything else (e.g. shutdown cancelling this worker) keeps propagating.
+                if job.cancelled() and self._is_cancelled(task_id):
+                    logger.info(f"Task {task_id} cancelled while running.")
                     return
+                raise
+            finally:
+                with self._lock:
+                    self._inflight.pop(task_id, None)
+            
+            if self._is_cancelled(task_id):
+                logger.info(f"Task {task_id} finished but was cancelled. Discarding result.")
+                return
 
             self.update_task(task_id, status=TaskStatus.COMPLETED, progress=100, message="Completed", result=result)
             
         except Exception as e:
             logger.exception(f"Task {task_id} failed: {e}")
-            with self._lock:
-                # If already cancelled, don't mark as failed
-                if self._tasks[task_id]["status"] == TaskStatus.CANCELLED:
-                    return
+            # If already cancelled, don't mark as failed
+            if self._is_cancelled(task_id):
+                return
             
-            self.update_task(task_id, status=TaskStatus.FAILED, error=str(e), message=f"Error: {str(e)}")
+            # HTTP-ish status of the failure (e.g. 429, 503 from GenerationError) for sync callers
+            self.update_task(
+                task_id, status=TaskStatus.FAILED, error=str(e), message=f"Error: {str(e)}",
+                error_code=getattr(e, "status_code", None), retry_after=getattr(e, "retry_after", None),
+            )
+
+        finally:
+            await self._offload_heavy_fields(task_id)
+            self._evict_expired()
+
+    def _is_cancelled(self, task_id: str) -> bool:
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return task is None or task["status"] == TaskStatus.CANCELLED
+
+    # --- Retention: result offloading & eviction ---
+
+    def _spill(self, fields: Dict[str, Any]) -> Dict[str, str]:
+        """Blocking: write oversized field values to the blob store, return {field: blob_id}."""
+        store = get_blob_store()
+        refs = {}
+        for key, value in fields.items():
+            encoded = json.dumps(value, ensure_ascii=False, default=str).encode("utf-8")
+            if len(encoded) >= self.spill_bytes:
+                refs[key] = store.put(encoded)
+        return refs
+
+    async def _offload_heavy_fields(self, task_id: str):
+        """Move a finished task's large result/metadata out of the in-memory dict."""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return
+            fields = {k: task[k] for k in _HEAVY_FIELDS if task.get(k) is not None and not task.get(f"{k}_ref")}
+            # Spilled at submit already: just drop the in-memory copy
+            spilled = [k for k in _HEAVY_FIELDS if task.get(k) is not None and task.get(f"{k}_ref")]
+            for key in spilled:
+                task[key] = None
+        if not fields:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+            refs = await loop.run_in_executor(None, self._spill, fields)
+        except Exception as e:
+            logger.warning(f"Failed to offload task {task_id} payload, keeping it in memory: {e}")
+            return
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return
+            for key, blob_id in refs.items():
+                task[key] = None
+                task[f"{key}_ref"] = blob_id
+            record = dict(task)
+        self._save(record, urgent=True)
+
+    def _evict_expired(self):
+        """Drop terminal tasks past their TTL, then the oldest terminal ones above max_records."""
+        now = time.time()
+        with self._lock:
+            terminal = [t for t in self._tasks.values() if t["status"] in _TERMINAL_STATUSES]
+            expired = [t["id"] for t in terminal if now - t["updated_at"] > self.task_ttl]
+            overflow = len(self._tasks) - len(expired) - self.max_records
+            if overflow > 0:
+                expired_ids = set(expired)
+                alive = sorted((t for t in terminal if t["id"] not in expired_ids), key=lambda t: t["updated_at"])
+                expired.extend(t["id"] for t in alive[:overflow])
+            for task_id in expired:
+                self._tasks.pop(task_id, None)
+        if expired:
+            # Broker rows are shared with other processes and pruned by the watch loop instead
+            if self._store is not None and self._broker is None:
+                self._store.delete(expired)
+            logger.info(f"Evicted {len(expired)} finished tasks ({len(self._tasks)} remaining)")
+
+        # Blobs are content-addressed and may be shared, so they age out on their own clock
+        if now - self._last_blob_prune > _BLOB_PRUNE_INTERVAL:
+            self._last_blob_prune = now
+            try:
+                asyncio.get_running_loop().run_in_executor(None, get_blob_store().prune, _BLOB_TTL)
+            except RuntimeError:
+                pass
+
+    def _status_view(self, task: Dict[str, Any]) -> Dict[str, Any]:
+        """Lightweight copy of a record (no result/metadata payloads). Caller holds the lock."""
+        view = {k: v for k, v in task.items() if k not in _HEAVY_FIELDS and not k.endswith("_ref")}
+        view["has_result"] = task.get("result") is not None or "result_ref" in task
+        if task["status"] == TaskStatus.PENDING and task["id"] in self._tags:
+            view["queue_position"] = self._queue_position(task["id"])
+        if task["status"] == TaskStatus.COMPLETED:
+            # Where the output image can be fetched (keeps pushed events small)
+            view["result_url"] = f"/tasks/{task['id']}/result"
+        return view
 
     def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Lightweight status view (no result/metadata payloads) for the polling path.
+        Tasks of other processes are read from the broker (blocking): use get_task_async on the loop.
+        """
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                return self._status_view(task)
+        if self._broker is not None:
+            record = self._broker.get(task_id)
+            if record is not None:
+                return self._remote_view(record)
+        return None
+
+    async def get_task_async(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """get_task for the event loop: local tasks inline, broker lookups in the executor."""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                return self._status_view(task)
+        if self._broker is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_task, task_id)
+
+    def get_task_details(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Full record with result/metadata loaded back from the blob store. Blocking (disk I/O)."""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            task = dict(task) if task is not None else None
+        if task is None and self._broker is not None:
+            task = self._broker.get(task_id)
+        if task is None:
+            return None
+        store = get_blob_store()
+        for key in _HEAVY_FIELDS:
+            blob_id = task.pop(f"{key}_ref", None)
+            if blob_id and task.get(key) is None:
+                raw = store.get(blob_id)
+                task[key] = json.loads(raw) if raw is not None else None
+        return task
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue figures; in broker mode this counts the shared table (blocking: stats_async on the loop)."""
         with self._lock:
-            return self._tasks.get(task_id)
+            stats = {
+                "workers": self.max_workers,
+                "running": self._running,
+                "pending": len(self._pending),
+                "max_pending": self.max_pending,
+                "avg_task_seconds": round(self._avg_duration, 2),
+                "pending_by_lane": {
+                    lane: sum(1 for t in self._pending if self._tasks[t].get("lane", DEFAULT_LANE) == lane)
+                    for lane in self.lane_costs
+                },
+                "max_running_per_user": self.max_running_per_user,
+                "users_running": len(self._user_running),
+            }
+        if self._broker is not None:
+            counts = self._broker.counts()
+            stats["pending"] = counts.get("PENDING", 0)
+            stats["broker"] = {"owner": self._broker.owner, "path": self._broker.path, "tasks": counts}
+        return stats
+
+    async def stats_async(self) -> Dict[str, Any]:
+        if self._broker is None:
+            return self.stats()
+        return await asyncio.get_running_loop().run_in_executor(None, self.stats)
 
     def update_task(self, task_id: str, **updates):
         with self._lock:
@@ -110,15 +740,186 @@ class TaskQueue:
                 task.update(updates)
                 task["updated_at"] = time.time()
                 self._tasks[task_id] = task
+                event = self._status_view(task)
+                record = dict(task)
+            else:
+                return
+        # Progress ticks are batched by the store; status transitions are flushed promptly.
+        # A completion carrying a result waits for _offload_heavy_fields to save the slim record.
+        self._save(record, urgent="status" in updates and "result" not in updates)
+        self._publish(event)
+
+    # --- Durability ---
+
+    def _save(self, record: Dict[str, Any], urgent: bool = False):
+        if self._store is not None:
+            # Payloads with a blob ref are never rewritten: progress flushes stay a few hundred bytes
+            for key in _HEAVY_FIELDS:
+                if record.get(f"{key}_ref"):
+                    record[key] = None
+            self._store.save(record, urgent=urgent)
+
+    def recover(self) -> int:
+        """
+        Loads records from the attached store (call once at startup, on the serving loop).
+        Finished tasks stay available for pickup; queued/running ones are re-queued if a
+        handler for their task_type is registered, otherwise marked FAILED.
+        Returns the number of re-queued tasks.
+        """
+        if self._store is None:
+            return 0
+        self._ensure_workers()
+        if self._broker is not None:
+            # Shared queue: records stay in the broker, dead workers' tasks come back via their leases
+            return self._broker.requeue_expired()
+        requeued, lost = 0, []
+        for record in self._store.load_all():
+            task_id = record["id"]
+            record["status"] = TaskStatus(record["status"])
+            with self._lock:
+                if task_id in self._tasks:
+                    continue
+            if record["status"] not in _TERMINAL_STATUSES:
+                factory = self._handlers.get(record.get("task_type"))
+                func = None
+                if factory is not None:
+                    try:
+                        if record.get("metadata") is None and record.get("metadata_ref"):
+                            raw = get_blob_store().get(record["metadata_ref"])
+                            record["metadata"] = json.loads(raw) if raw is not None else None
+                        func = factory(record)
+                    except Exception as e:
+                        logger.warning(f"Cannot rebuild task {task_id}: {e}")
+                if func is None:
+                    record.update(status=TaskStatus.FAILED, error="Interrupted by server restart",
+                                  message="Error: Interrupted by server restart", updated_at=time.time())
+                    lost.append(record)
+                else:
+                    record.update(status=TaskStatus.PENDING, progress=0,
+                                  message="Recovered after restart, re-queued", updated_at=time.time())
+                    with self._lock:
+                        self._tasks[task_id] = record
+                        self._enqueue_pending(task_id)
+                        self._jobs[task_id] = (func, (), {"metadata": record.get("metadata")})
+                    self._available.release()
+                    requeued += 1
+                    self._save(dict(record), urgent=True)
+                    continue
+            with self._lock:
+                self._tasks[task_id] = record
+        for record in lost:
+            self._save(dict(record), urgent=True)
+        self._evict_expired()
+        logger.info(f"Recovered {len(self._tasks)} tasks from store ({requeued} re-queued, {len(lost)} lost)")
+        return requeued
 
-    def cancel_task(self, task_id: str):
+    # --- Push notifications (SSE) ---
+
+    def subscribe(self, task_ids: Iterable[str]) -> TaskSubscription:
+        """
+        Registers a subscriber and queues a snapshot of each known task as its first events.
+        Snapshots of other processes' tasks are read from the broker in the executor and
+        pushed when ready; later changes of those come from _publish_remote_updates.
+        """
+        sub = TaskSubscription(task_ids)
         with self._lock:
-            if task_id in self._tasks:
-                self._tasks[task_id]["status"] = TaskStatus.CANCELLED
-                self._tasks[task_id]["message"] = "Cancelled by user"
-                # Actual cancellation of running asyncio task is tricky without the task object reference.
-                # For this implementation, we set the flag. The worker *should* check this flag if possible,
-                # or at least we ignore the result.
-                
+            self._subscribers.append(sub)
+            snapshots = [self._status_view(self._tasks[t]) for t in sub.task_ids if t in self._tasks]
+            remote_ids = [t for t in sub.task_ids if t not in self._tasks]
+        for event in snapshots:
+            sub.push(event)
+        if self._broker is not None and remote_ids:
+            def push_remote():
+                for record in self._broker.get_many(remote_ids):
+                    sub.push(self._remote_view(record))
+            sub.loop.run_in_executor(None, push_remote)
+        return sub
+
+    def unsubscribe(self, sub: TaskSubscription):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def _publish(self, event: Dict[str, Any]):
+        with self._lock:
+            targets = [s for s in self._subscribers if event["id"] in s.task_ids]
+        for sub in targets:
+            try:
+                sub.push(event)
+            except RuntimeError:
+                # Subscriber's loop is gone (client disconnected mid-shutdown)
+                self.unsubscribe(sub)
+
+    @staticmethod
+    def is_terminal(status: Any) -> bool:
+        return status in _TERMINAL_STATUSES
+
+    def cancel_task(self, task_id: str) -> bool:
+        """
+        Cancels a task. Pending tasks leave the queue; running tasks have their job
+        cancelled (aborting HTTP calls / retry sleeps) so the worker slot frees up at once.
+        Returns False if the task is unknown or already finished.
+        Tasks of other processes are cancelled in the broker (blocking): run it off the loop there.
+        """
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None and self._broker is not None:
+                remote = True
+            elif task is None or task["status"] in _TERMINAL_STATUSES:
+                return False
+            else:
+                remote = False
+        if remote:
+            # Queued anywhere or running in another process: its owner notices on the next lease renewal
+            record = self._broker.cancel(task_id)
+            if record is None:
+                return False
+            self._publish(self._remote_view(record))
+            return True
+
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None or task["status"] in _TERMINAL_STATUSES:
+                return False
+            task["status"] = TaskStatus.CANCELLED
+            task["message"] = "Cancelled by user"
+            task["updated_at"] = time.time()
+            if task_id in self._jobs:
+                # Still queued: drop it (its semaphore permit is skipped by the worker loop)
+                self._pending.remove(task_id)
+                self._tags.pop(task_id, None)
+                self._jobs.pop(task_id, None)
+            job = self._inflight.get(task_id)
+            event = self._status_view(task)
+            record = dict(task)
+
+        self._save(record, urgent=True)
+        self._publish(event)
+        if job is not None and not job.done():
+            # Thread-safe: schedules the cancel on the loop that owns the job
+            job.get_loop().call_soon_threadsafe(job.cancel)
+        return True
+
+    async def shutdown(self):
+        """Stop workers and in-flight jobs (FastAPI shutdown hook)."""
+        with self._lock:
+            jobs = list(self._inflight.values())
+            workers = list(self._workers)
+        if self._watcher is not None:
+            workers.append(self._watcher)
+            self._watcher = None
+        for t in jobs + workers:
+            t.cancel()
+        await asyncio.gather(*jobs, *workers, return_exceptions=True)
+        self._workers = []
+        if self._broker is not None:
+            # Let another process pick up what we were running instead of waiting for the lease to expire
+            released = self._broker.release()
+            if released:
+                logger.info(f"Released {released} running tasks back to the shared queue")
+        if self._store is not None:
+            # Interrupted tasks keep their PENDING/PROCESSING state and are resumed by recover()
+            self._store.close()
+
 # Global instance
 task_queue = TaskQueue()
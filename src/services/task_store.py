@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional
+
+from src.services.config import env_float
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_STORE_DIR = os.path.join(os.getcwd(), "_task_store")
+_DEFAULT_FLUSH_INTERVAL = env_float("TASK_STORE_FLUSH_INTERVAL", 1.0)
+_TERMINAL_SQL = "('COMPLETED', 'FAILED', 'CANCELLED')"
+
+
+def _dumps(record: Dict[str, Any]) -> str:
+    return json.dumps(record, ensure_ascii=False, default=str)
+
+
+def _status(record: Dict[str, Any]) -> str:
+    # TaskStatus is a str Enum, but str() of it gives "TaskStatus.X" on 3.11+
+    status = record["status"]
+    return getattr(status, "value", status)
+
+
+class TaskStore(ABC):
+    """
+    Durable backend for TaskQueue records.
+
+    save()/delete() only stage changes in memory; a background thread writes them in
+    batches every `flush_interval` seconds, so progress ticks never hit the disk one by one.
+    `urgent=True` (submissions, terminal states) wakes the writer immediately.
+    """
+
+    def __init__(self, flush_interval: float = _DEFAULT_FLUSH_INTERVAL) -> None:
+        self.flush_interval = flush_interval
+        self._dirty: Dict[str, Optional[Dict[str, Any]]] = {}  # task_id -> record (None = delete)
+        self._dirty_lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._flush_loop, name=f"{type(self).__name__}-writer", daemon=True)
+        self._thread.start()
+
+    # --- Public API ---
+
+    def save(self, record: Dict[str, Any], urgent: bool = False) -> None:
+        with self._dirty_lock:
+            self._dirty[record["id"]] = record
+        if urgent:
+            self._wakeup.set()
+
+    def delete(self, task_ids: Iterable[str]) -> None:
+        with self._dirty_lock:
+            for task_id in task_ids:
+                self._dirty[task_id] = None
+
+    def flush(self) -> None:
+        with self._dirty_lock:
+            batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+        with self._io_lock:
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.error(f"Task store flush failed ({len(batch)} records), will retry: {e}")
+                with self._dirty_lock:
+                    # Keep newer staged versions over the failed ones
+                    for task_id, record in batch.items():
+                        self._dirty.setdefault(task_id, record)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=5)
+        self.flush()
+        with self._io_lock:
+            self._close_backend()
+
+    @abstractmethod
+    def load_all(self) -> List[Dict[str, Any]]:
+        """Every stored record, for TaskQueue recovery at startup."""
+
+    # --- Backend hooks ---
+
+    @abstractmethod
+    def _write_batch(self, batch: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        """Apply one batch of staged changes (record, or None = delete) atomically if the backend can."""
+
+    def _close_backend(self) -> None:
+        pass
+
+    def _flush_loop(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class SQLiteTaskStore(TaskStore):
+    """Default local backend: one SQLite table in WAL mode (readers never block the writer)."""
+
+    def __init__(self, path: Optional[str] = None, flush_interval: float = _DEFAULT_FLUSH_INTERVAL) -> None:
+        self.path = path or os.path.join(_DEFAULT_STORE_DIR, "tasks.db")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: commits are durable across process crashes without an fsync per commit
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " data TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        super().__init__(flush_interval=flush_interval)
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        with self._io_lock:
+            rows = self._conn.execute("SELECT data FROM tasks ORDER BY updated_at").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def _write_batch(self, batch: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        upserts = [
+            (task_id, _status(record), record.get("updated_at", 0), _dumps(record))
+            for task_id, record in batch.items() if record is not None
+        ]
+        deletes = [(task_id,) for task_id, record in batch.items() if record is None]
+        with self._conn:
+            if upserts:
+                self._conn.executemany(
+                    "INSERT INTO tasks (id, status, updated_at, data) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET status=excluded.status, updated_at=excluded.updated_at, data=excluded.data "
+                    # A terminal row is final: late progress writes must not resurrect a cancelled task
+                    f"WHERE tasks.status NOT IN {_TERMINAL_SQL} OR tasks.status = excluded.status",
+                    upserts,
+                )
+            if deletes:
+                self._conn.executemany("DELETE FROM tasks WHERE id = ?", deletes)
+
+    def _close_backend(self) -> None:
+        self._conn.close()
+
+
+class JournalTaskStore(TaskStore):
+    """
+    Append-only JSONL journal ({"op": "put"|"del", ...} per line), one fsync per batch.
+    The journal is replayed and compacted on load.
+    """
+
+    def __init__(self, path: Optional[str] = None, flush_interval: float = _DEFAULT_FLUSH_INTERVAL) -> None:
+        self.path = path or os.path.join(_DEFAULT_STORE_DIR, "tasks.journal")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        super().__init__(flush_interval=flush_interval)
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        records: Dict[str, Dict[str, Any]] = {}
+        with self._io_lock:
+            self._file.flush()
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn last line after a crash
+                        continue
+                    if entry.get("op") == "put":
+                        records[entry["record"]["id"]] = entry["record"]
+                    elif entry.get("op") == "del":
+                        records.pop(entry["id"], None)
+            self._compact(records.values())
+        return sorted(records.values(), key=lambda r: r.get("updated_at", 0))
+
+    def _compact(self, records: Iterable[Dict[str, Any]]) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(_dumps({"op": "put", "record": record}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _write_batch(self, batch: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        lines = []
+        for task_id, record in batch.items():
+            entry = {"op": "put", "record": record} if record is not None else {"op": "del", "id": task_id}
+            lines.append(_dumps(entry) + "\n")
+        self._file.write("".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close_backend(self) -> None:
+        self._file.close()
+
+
+def create_task_store(kind: Optional[str] = None) -> Optional[TaskStore]:
+    """Build the store selected by TASK_STORE: sqlite (default), journal, or memory (no persistence)."""
+    kind = (kind or os.getenv("TASK_STORE", "sqlite")).lower()
+    path = os.getenv("TASK_STORE_PATH") or None
+    if kind == "sqlite":
+        return SQLiteTaskStore(path)
+    if kind == "journal":
+        return JournalTaskStore(path)
+    if kind in ("memory", "none", ""):
+        return None
+    raise ValueError(f"Unknown TASK_STORE backend: {kind}")
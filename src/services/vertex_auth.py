@@ -0,0 +1,116 @@
+import asyncio
+import datetime
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import google.auth
+from google.auth.transport.requests import Request as GoogleAuthRequest
+
+from src.services.config import lazy_singleton
+
+logger = logging.getLogger(__name__)
+
+_CLOUD_PLATFORM_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+class VertexTokenProvider:
+    """
+    Caches the Vertex bearer token for the whole process.
+
+    Credentials are resolved once (google.auth.default reads files / metadata server).
+    The token is reused until it gets close to expiry:
+      - inside `background_margin` seconds: keep serving it, refresh in the background
+      - inside `refresh_margin` seconds (or missing): callers wait for the refresh
+    All refreshes go through one shared task, so concurrent jobs never refresh in parallel.
+    VERTEX_ACCESS_TOKEN, if set, is used as-is instead (local mock server / benchmarks).
+    """
+
+    def __init__(
+        self,
+        scopes: Optional[List[str]] = None,
+        refresh_margin: float = 60.0,
+        background_margin: float = 300.0,
+    ) -> None:
+        self.scopes = scopes or _CLOUD_PLATFORM_SCOPES
+        self.refresh_margin = refresh_margin
+        self.background_margin = max(background_margin, refresh_margin)
+
+        self._credentials: Any = None
+        self._project_id: Optional[str] = None
+        # Guards the blocking resolve/refresh which runs in an executor thread
+        self._sync_lock = threading.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._refresh_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.refresh_count = 0
+        self.static_token = os.getenv("VERTEX_ACCESS_TOKEN") or None
+
+    def _seconds_left(self) -> Optional[float]:
+        creds = self._credentials
+        if creds is None or not creds.token:
+            return None
+        expiry = getattr(creds, "expiry", None)
+        if expiry is None:
+            # Some credential types never expire (or don't report it)
+            return float("inf") if creds.valid else None
+        if expiry.tzinfo is not None:
+            expiry = expiry.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds()
+
+    def _refresh_blocking(self) -> None:
+        with self._sync_lock:
+            if self._credentials is None:
+                self._credentials, self._project_id = google.auth.default(scopes=self.scopes)
+                logger.info("Resolved Google application default credentials")
+            left = self._seconds_left()
+            # Another caller may have refreshed while we waited on the lock
+            if left is not None and left > self.background_margin:
+                return
+            self._credentials.refresh(GoogleAuthRequest())
+            self.refresh_count += 1
+            logger.info("Refreshed Vertex access token")
+
+    async def _run_refresh(self) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._refresh_blocking)
+
+    def _ensure_refresh_task(self) -> asyncio.Task:
+        loop = asyncio.get_running_loop()
+        task = self._refresh_task
+        if task is None or task.done() or self._refresh_loop is not loop:
+            task = loop.create_task(self._run_refresh())
+            task.add_done_callback(self._on_refresh_done)
+            self._refresh_task = task
+            self._refresh_loop = loop
+        return task
+
+    @staticmethod
+    def _on_refresh_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Vertex token refresh failed: {task.exception()}")
+
+    async def get_token(self) -> str:
+        if self.static_token:
+            return self.static_token
+        left = self._seconds_left()
+        if left is None or left <= self.refresh_margin:
+            # Token missing or about to expire: wait for the (shared) refresh.
+            # Shielded so a cancelled caller doesn't abort the refresh for everyone else.
+            await asyncio.shield(self._ensure_refresh_task())
+        elif left <= self.background_margin:
+            self._ensure_refresh_task()
+        return self._credentials.token
+
+    async def get_headers(self) -> Dict[str, str]:
+        token = await self.get_token()
+        return {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json; charset=utf-8"
+        }
+
+
+@lazy_singleton
+def get_vertex_token_provider() -> VertexTokenProvider:
+    return VertexTokenProvider()
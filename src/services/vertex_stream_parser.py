@@ -0,0 +1,153 @@
+import base64
+from typing import List, Optional
+
+_QUOTE = 0x22
+_BACKSLASH = 0x5C
+
+# Object keys from the body root down to an image part (arrays are transparent)
+_INLINE_DATA_PATH = (None, "candidates", "content", "parts", "inlineData")
+
+
+class InlineImageStreamDecoder:
+    """
+    Incremental reader for a generateContent response body.
+
+    Feed it the raw HTTP chunks as they arrive: it finds the first
+    `candidates[].content.parts[].inlineData.data` string (and that part's mimeType; a
+    `data` key anywhere else is skipped) and base64-decodes it on the fly,
+    so the body text and the parsed base64 string never exist in memory; only the decoded
+    image does. Only the JSON structure around strings is tokenized (a few KB for these
+    responses); string contents are skipped with bytes.find().
+    """
+
+    def __init__(self) -> None:
+        # One entry per open container: [name, current_key, is_array]. `name` is the key the
+        # container was stored under (array elements inherit the array's name).
+        self._stack: List[list] = []
+        self._expect_key = False
+        self._in_string = False
+        self._escape = False
+        self._role = "skip"  # "key" | "mime" | "target" | "skip" for the string being read
+        self._buf = bytearray()  # key / mimeType text
+        self._pending = b""  # base64 tail not yet aligned to 4 chars
+        self._out = bytearray()
+        self._target: Optional[list] = None  # stack entry of the inlineData object being decoded
+
+        self.found = False
+        self.complete = False
+        self.mime_type: Optional[str] = None
+        self.bytes_seen = 0
+
+    def feed(self, chunk: bytes) -> None:
+        self.bytes_seen += len(chunk)
+        i, n = 0, len(chunk)
+        while i < n:
+            if self._in_string:
+                i = self._scan_string(chunk, i, n)
+                continue
+            c = chunk[i]
+            if c == _QUOTE:
+                self._start_string()
+            elif c == 0x7B:  # {
+                self._push(is_array=False)
+            elif c == 0x5B:  # [
+                self._push(is_array=True)
+            elif c == 0x7D or c == 0x5D:  # } ]
+                if self._stack:
+                    self._stack.pop()
+                self._expect_key = False
+            elif c == 0x3A:  # :
+                self._expect_key = False
+            elif c == 0x2C:  # ,
+                self._expect_key = bool(self._stack) and not self._stack[-1][2]
+            i += 1
+
+    def result(self) -> Optional[bytearray]:
+        """
+        Decoded image, or None if the response had no complete inlineData.data. This is the
+        decoder's own buffer handed over as is (no copy of a multi-MB image): bytes-like
+        everywhere it goes (blob store, base64, files), just don't mutate it.
+        """
+        if not self.complete:
+            return None
+        return self._out
+
+    # --- Internals ---
+
+    def _push(self, is_array: bool) -> None:
+        parent = self._stack[-1] if self._stack else None
+        if parent is None:
+            name = None
+        elif parent[2]:
+            name = parent[0]
+        else:
+            name = parent[1]
+        self._stack.append([name, None, is_array])
+        self._expect_key = not is_array
+
+    def _in_inline_data(self) -> bool:
+        """Top of the stack is a parts[].inlineData object."""
+        return tuple(entry[0] for entry in self._stack if not entry[2]) == _INLINE_DATA_PATH
+
+    def _start_string(self) -> None:
+        self._in_string = True
+        top = self._stack[-1] if self._stack else None
+        if top is not None and not top[2] and self._expect_key:
+            self._role = "key"
+            self._buf.clear()
+        elif top is not None and not top[2] and top[1] == "data" and not self.found and self._in_inline_data():
+            self._role = "target"
+            self.found = True
+            self._target = top
+        elif (top is not None and not top[2] and top[1] == "mimeType" and self._in_inline_data()
+              and (self._target is None or top is self._target)):
+            # Before the image: the latest part's type; after it: only its own part's
+            self._role = "mime"
+            self._buf.clear()
+        else:
+            self._role = "skip"
+
+    def _scan_string(self, chunk: bytes, i: int, n: int) -> int:
+        if self._escape:
+            # Escaped char (possibly split across chunks). In base64 only "\/" can occur.
+            self._escape = False
+            self._consume(chunk[i:i + 1])
+            return i + 1
+        quote = chunk.find(b'"', i)
+        backslash = chunk.find(b"\\", i, quote if quote != -1 else n)
+        if backslash != -1:
+            self._consume(chunk[i:backslash])
+            self._escape = True
+            return backslash + 1
+        if quote == -1:
+            self._consume(chunk[i:])
+            return n
+        self._consume(chunk[i:quote])
+        self._end_string()
+        return quote + 1
+
+    def _consume(self, segment: bytes) -> None:
+        if not segment or self._role == "skip":
+            return
+        if self._role == "target":
+            data = self._pending + segment if self._pending else segment
+            aligned = len(data) - len(data) % 4
+            if aligned:
+                self._out += base64.b64decode(data[:aligned])
+            self._pending = bytes(data[aligned:])
+        else:
+            self._buf += segment
+
+    def _end_string(self) -> None:
+        self._in_string = False
+        if self._role == "key":
+            self._stack[-1][1] = self._buf.decode("utf-8", "replace")
+        elif self._role == "mime":
+            self.mime_type = self._buf.decode("utf-8", "replace")
+        elif self._role == "target":
+            if self._pending:
+                # Unpadded tail
+                self._out += base64.b64decode(self._pending + b"=" * (-len(self._pending) % 4))
+                self._pending = b""
+            self.complete = True
+        self._role = "skip"
@@ -1,5 +1,6 @@
 import { create } from 'zustand';
 import { persist } from 'zustand/middleware';
+import { v4 as uuidv4 } from 'uuid';
 import { generatePrompt } from '@/utils/promptUtils';
 
 export interface TaskItem {
@@ -216,7 +217,7 @@ export const useStudioStore = create<StudioState>()(
             updateTaskStatus: (taskId, status, progress, message, result) => set((state) => ({
                 activeTasks: state.activeTasks.map(t =>
                     t.id === taskId
-                        ? { ...t, status: status as any, progress, message, thumbnail: result?.image_data ? result.image_data : t.thumbnail }
+                        ? { ...t, status: status as any, progress, message, thumbnail: resultImageSrc(result) || t.thumbnail }
                         : t
                 )
             })),
@@ -237,7 +238,8 @@ export const useStudioStore = create<StudioState>()(
                     setGenerationStatus('Submitting Task...');
                     const response = await fetch(endpoint, {
                         method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
+                        // One id per submission: the proxy bills and the backend deduplicates by it
+                        headers: { 'Content-Type': 'application/json', 'X-Transaction-ID': uuidv4() },
                         body: JSON.stringify(payload),
                     });
 
@@ -301,7 +303,7 @@ export const useStudioStore = create<StudioState>()(
                 try {
                     const response = await fetch('/api/py/tasks/submit/generate', {
                         method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
+                        headers: { 'Content-Type': 'application/json', 'X-Transaction-ID': uuidv4() },
                         body: JSON.stringify({
                             prompt: currentPrompt,
                             images: finalImages,
@@ -365,15 +367,134 @@ export const useStudioStore = create<StudioState>()(
     )
 );
 
-// --- Polling Logic ---
+// --- Task Progress Logic ---
+// Preferred: one Server-Sent Events stream for all active tasks (pushed by the backend TaskQueue).
+// Fallback: interval polling, used if EventSource is unavailable or the stream errors.
+const TERMINAL_STATUSES = ['COMPLETED', 'FAILED', 'CANCELLED'];
+
+// Legacy results inline a data URI; binary results carry a URL to /api/py/tasks/{id}/result
+const resultImageSrc = (result: any): string | undefined => result?.image_data || result?.image_url || undefined;
+
 let pollerInterval: NodeJS.Timeout | null = null;
+let taskStream: EventSource | null = null;
+let taskStreamKey = '';
+
+const applyTaskSnapshot = (get: () => StudioState, task: TaskItem, data: any) => {
+    const { activeTasks, updateTaskStatus, setGeneratedImage, fetchCredits, setGenerationStatus, setGenerationProgress } = get();
+
+    if (JSON.stringify(data.status) !== JSON.stringify(task.status) ||
+        data.progress !== task.progress ||
+        data.message !== task.message) {
+
+        updateTaskStatus(task.id, data.status, data.progress, data.message, data.result);
+
+        // Sync main UI
+        if (task.id === activeTasks[0]?.id) {
+            setGenerationStatus(data.message);
+            setGenerationProgress(data.progress);
+        }
+    }
+
+    if (data.status === 'COMPLETED') {
+        const imageSrc = resultImageSrc(data.result);
+        if (imageSrc) {
+            setGeneratedImage(imageSrc);
+            fetchCredits();
+            setGenerationStatus('Ready'); // Reset main UI status
+            setGenerationProgress(100);
+        }
+    }
+};
+
+// Full task fetch (also triggers the proxy's server-side auto-save for completed tasks)
+const fetchTaskSnapshot = async (get: () => StudioState, taskId: string) => {
+    const task = get().activeTasks.find(t => t.id === taskId);
+    if (!task) return;
+
+    const res = await fetch(`/api/py/tasks/${taskId}`);
+    if (res.status === 404) {
+        get().updateTaskStatus(taskId, 'FAILED', 0, 'Task not found');
+        return;
+    }
+    applyTaskSnapshot(get, task, await res.json());
+};
 
 const startTaskPoller = (get: () => StudioState, set: any) => {
+    if (typeof EventSource !== 'undefined' && !pollerInterval) {
+        syncTaskStream(get, set);
+        return;
+    }
+    startIntervalPoller(get, set);
+};
+
+const syncTaskStream = (get: () => StudioState, set: any) => {
+    const ids = get().activeTasks
+        .filter(t => !TERMINAL_STATUSES.includes(t.status))
+        .map(t => t.id);
+    const key = ids.join(',');
+    if (taskStream && key === taskStreamKey) return;
+
+    // One connection per client: reopen with the new task set
+    taskStream?.close();
+    taskStream = null;
+    taskStreamKey = key;
+    if (ids.length === 0) return;
+
+    console.log("Opening task event stream...");
+    const stream = new EventSource(`/api/py/tasks/events?ids=${encodeURIComponent(key)}`);
+
+    stream.addEventListener('progress', (ev) => {
+        const data = JSON.parse((ev as MessageEvent).data);
+        const task = get().activeTasks.find(t => t.id === data.id);
+        if (task) applyTaskSnapshot(get, task, data);
+    });
+
+    stream.addEventListener('final', async (ev) => {
+        const data = JSON.parse((ev as MessageEvent).data);
+        const task = get().activeTasks.find(t => t.id === data.id);
+        if (!task) return;
+        try {
+            if (data.status === 'NOT_FOUND') {
+                get().updateTaskStatus(task.id, 'FAILED', 0, 'Task not found');
+            } else if (data.status === 'COMPLETED') {
+                // Event only carries the result reference; load the full result once
+                await fetchTaskSnapshot(get, task.id);
+            } else {
+                applyTaskSnapshot(get, task, data);
+            }
+        } catch (e) {
+            console.warn(`Failed to load final state for task ${task.id}`, e);
+        }
+    });
+
+    stream.addEventListener('done', () => {
+        stream.close();
+        if (taskStream === stream) {
+            taskStream = null;
+            taskStreamKey = '';
+        }
+        syncTaskStream(get, set);
+    });
+
+    stream.onerror = () => {
+        console.warn("Task event stream failed, falling back to polling.");
+        stream.close();
+        if (taskStream === stream) {
+            taskStream = null;
+            taskStreamKey = '';
+        }
+        startIntervalPoller(get, set);
+    };
+
+    taskStream = stream;
+};
+
+const startIntervalPoller = (get: () => StudioState, set: any) => {
     if (pollerInterval) return;
 
     console.log("Starting Task Poller...");
     pollerInterval = setInterval(async () => {
-        const { activeTasks, updateTaskStatus, removeActiveTask, setGeneratedImage, fetchCredits, setGenerationStatus, setGenerationProgress } = get();
+        const { activeTasks } = get();
 
         if (activeTasks.length === 0) {
             if (pollerInterval) {
@@ -385,40 +506,12 @@ const startTaskPoller = (get: () => StudioState, set: any) => {
         }
 
         for (const task of activeTasks) {
-            if (['COMPLETED', 'FAILED', 'CANCELLED'].includes(task.status)) {
+            if (TERMINAL_STATUSES.includes(task.status)) {
                 continue;
             }
 
             try {
-                const res = await fetch(`/api/py/tasks/${task.id}`);
-                if (res.status === 404) {
-                    updateTaskStatus(task.id, 'FAILED', 0, 'Task not found');
-                    continue;
-                }
-
-                const data = await res.json();
-
-                if (JSON.stringify(data.status) !== JSON.stringify(task.status) ||
-                    data.progress !== task.progress ||
-                    data.message !== task.message) {
-
-                    updateTaskStatus(task.id, data.status, data.progress, data.message, data.result);
-
-                    // Sync main UI
-                    if (task === activeTasks[0]) {
-                        setGenerationStatus(data.message);
-                        setGenerationProgress(data.progress);
-                    }
-                }
-
-                if (data.status === 'COMPLETED') {
-                    if (data.result && data.result.image_data) {
-                        setGeneratedImage(data.result.image_data);
-                        fetchCredits();
-                        setGenerationStatus('Ready'); // Reset main UI status
-                        setGenerationProgress(100);
-                    }
-                }
+                await fetchTaskSnapshot(get, task.id);
             } catch (e) {
                 console.warn(`Polling failed for task ${task.id}`, e);
             }
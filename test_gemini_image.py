@@ -1,5 +1,6 @@
 """Gradio interface for testing Gemini image generation service."""
 
+import asyncio
 import io
 import json
 import logging
@@ -554,11 +555,10 @@ async def batch_image_to_image_async(
     if error:
         return error, None
 
-    outputs: list[tuple[Image.Image, str]] = []
     failures: list[str] = []
     service = get_service()
 
-    for idx, prompt in enumerate(prompts, start=1):
+    async def run_one(idx: int, prompt: str) -> tuple[Image.Image, str] | None:
         log_message(
             "user",
             "\n".join(
@@ -583,15 +583,14 @@ async def batch_image_to_image_async(
             if not result.success:
                 failures.append(f"{idx}. {prompt}: {result.error or 'Generation failed'}")
                 log_message("assistant", f"Batch prompt #{idx} failed: {result.error}")
-                continue
+                return None
             if not result.image_data:
                 failures.append(f"{idx}. {prompt}: No image data returned")
                 log_message("assistant", f"Batch prompt #{idx} failed: No image data returned")
-                continue
+                return None
 
             image = Image.open(io.BytesIO(result.image_data))
             caption = f"{idx}. {prompt}"
-            outputs.append((image, caption))
             log_message("assistant", f"Batch prompt #{idx} succeeded")
             log_generated_image(
                 image,
@@ -604,11 +603,19 @@ async def batch_image_to_image_async(
                     "source_count": len(image_input),
                 },
             )
+            return image, caption
         except Exception as e:  # pragma: no cover - best effort logging
             error_msg = f"{idx}. {prompt}: {e!s}"
             failures.append(error_msg)
             logger.exception("Batch prompt failed: %s", error_msg)
             log_message("assistant", f"Batch prompt #{idx} failed with exception: {e!s}")
+            return None
+
+    # All prompts at once: the service's shared rate limiter paces the actual Vertex calls,
+    # so a batch takes about as long as its slowest image instead of the sum of all of them
+    results = await asyncio.gather(*(run_one(idx, prompt) for idx, prompt in enumerate(prompts, start=1)))
+    outputs: list[tuple[Image.Image, str]] = [r for r in results if r is not None]
+    failures.sort(key=lambda f: int(f.split(".", 1)[0]))
 
     success_count = len(outputs)
     failure_count = len(failures)
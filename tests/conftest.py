@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Tests import `src.*` and `api_server` from the repo root, like the server does
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Keep everything the services write at import time out of the working tree
+_SCRATCH = tempfile.mkdtemp(prefix="imagegen-tests-")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "test-project")
+os.environ.setdefault("TASK_STORE", "memory")
+os.environ.setdefault("BLOB_STORE_DIR", os.path.join(_SCRATCH, "blobs"))
+os.environ.setdefault("ARTIFACT_LOG_DIR", os.path.join(_SCRATCH, "logs"))
+
+
+class FakeClock:
+    """Stand-in for a module's `time` import: monotonic()/time() only move when told to."""
+
+    def __init__(self, start: float = 1000.0) -> None:
+        self.now = start
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    """A FakeClock; patch it over the module under test's `time` with monkeypatch."""
+    return FakeClock()
@@ -0,0 +1,124 @@
+import asyncio
+
+import httpx
+import pytest
+
+from src.services import circuit_breaker
+from src.services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from src.services.retry_policy import UpstreamError
+
+FAIL = UpstreamError(503)
+
+
+@pytest.fixture
+def breaker(clock, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return CircuitBreaker(window=60.0, min_calls=4, error_threshold=0.5, timeout_threshold=0.3,
+                          open_seconds=10.0, max_open_seconds=35.0, probes=1, probe_successes=2)
+
+
+def _calls(breaker, *outcomes):
+    for exc in outcomes:
+        probe = breaker.acquire()
+        breaker.record(exc, probe)
+
+
+def _trip(breaker):
+    _calls(breaker, None, None, FAIL, FAIL)
+    assert breaker.state == OPEN
+
+
+def test_trips_on_error_rate_after_min_calls(breaker):
+    _calls(breaker, FAIL, FAIL, FAIL)
+    assert breaker.state == CLOSED  # below min_calls
+    _calls(breaker, None)
+    assert breaker.state == OPEN
+    assert breaker.trips == 1
+
+
+def test_trips_on_timeout_rate_alone(breaker):
+    _calls(breaker, None, None, None, None, httpx.ReadTimeout("slow"))
+    assert breaker.state == CLOSED  # 1 of 5
+    _calls(breaker, asyncio.TimeoutError())
+    assert breaker.state == OPEN  # 2 of 6: over the timeout threshold, under the error threshold
+
+
+def test_old_outcomes_leave_the_window(breaker, clock):
+    _calls(breaker, FAIL, FAIL, FAIL)
+    clock.advance(61.0)
+    _calls(breaker, None, None, None, FAIL)
+    assert breaker.state == CLOSED
+
+
+def test_quota_cancel_and_client_errors_do_not_trip(breaker):
+    _calls(breaker, *([UpstreamError(429), asyncio.CancelledError()] * 5))
+    assert breaker.stats()["window_calls"] == 0
+    _calls(breaker, UpstreamError(400), UpstreamError(400), UpstreamError(400), UpstreamError(400))
+    assert breaker.state == CLOSED
+
+
+def test_open_refuses_with_retry_after(breaker, clock):
+    _trip(breaker)
+    clock.advance(4.0)
+    with pytest.raises(CircuitOpenError) as refused:
+        breaker.acquire()
+    assert refused.value.retry_after == pytest.approx(6.0)
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.rejected == 2
+
+
+def test_half_open_admits_one_probe_then_closes(breaker, clock):
+    _trip(breaker)
+    clock.advance(10.0)
+    assert breaker.state == HALF_OPEN
+
+    assert breaker.acquire() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()  # the probe slot is taken
+    breaker.record(None, probe=True)
+    assert breaker.state == HALF_OPEN  # one of two successes
+
+    _calls(breaker, None)
+    assert breaker.state == CLOSED
+    assert breaker.probes_sent == 2
+    assert breaker.acquire() is False
+
+
+def test_failed_probe_reopens_for_longer(breaker, clock):
+    _trip(breaker)
+    # Each failed probe doubles the open period, up to max_open_seconds
+    for open_for in (10.0, 20.0, 35.0, 35.0):
+        clock.advance(open_for - 0.1)
+        assert breaker.state == OPEN
+        clock.advance(0.1)
+        assert breaker.state == HALF_OPEN
+        _calls(breaker, FAIL)
+        assert breaker.state == OPEN
+    assert breaker.trips == 5
+
+
+def test_neutral_probe_frees_the_slot_without_deciding(breaker, clock):
+    _trip(breaker)
+    clock.advance(10.0)
+    _calls(breaker, UpstreamError(429))
+    assert breaker.state == HALF_OPEN
+    assert breaker.acquire() is True
+
+
+def test_stragglers_do_not_count_while_open(breaker, clock):
+    _trip(breaker)
+    breaker.record(None)
+    breaker.record(FAIL)
+    clock.advance(10.0)
+    _calls(breaker, None, None)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["window_calls"] == 0
+
+
+def test_disabled_breaker_admits_everything(clock, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    breaker = CircuitBreaker(enabled=False, min_calls=1)
+    _calls(breaker, FAIL, FAIL, FAIL)
+    assert breaker.state == CLOSED
+    breaker.check()
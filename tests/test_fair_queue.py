@@ -0,0 +1,99 @@
+import pytest
+
+from src.services.task_queue import TaskQueue, TaskStatus
+
+
+@pytest.fixture
+def queue():
+    # A private instance: the scheduling state normally lives on the process-wide singleton
+    queue = object.__new__(TaskQueue)
+    queue._tasks, queue._pending, queue._tags = {}, [], {}
+    queue._user_tags, queue._user_running = {}, {}
+    queue._virtual_time = 0.0
+    queue.lane_costs = {"interactive": 1.0, "standard": 2.0, "batch": 4.0}
+    queue.max_running_per_user = 0
+    return queue
+
+
+def _add(queue, task_id, user_id=None, lane="standard", max_running=None):
+    queue._tasks[task_id] = {"id": task_id, "status": TaskStatus.PENDING, "user_id": user_id,
+                             "lane": lane, "max_running": max_running}
+    queue._enqueue_pending(task_id)
+
+
+def _drain(queue):
+    order = []
+    while True:
+        task_id = queue._pick_next()
+        if task_id is None:
+            return order
+        order.append(task_id)
+
+
+def test_cheap_lane_overtakes_queued_batch_jobs(queue):
+    for i in range(3):
+        _add(queue, f"batch{i}", lane="batch")
+    _add(queue, "click", lane="interactive")
+
+    assert queue._queue_position("click") == 1
+    assert _drain(queue)[0] == "click"
+
+
+def test_users_share_by_cost(queue):
+    for i in range(4):
+        _add(queue, f"a{i}", "alice")
+    for i in range(2):
+        _add(queue, f"b{i}", "bob")
+
+    # Bob's first job starts right behind Alice's first, not after all four
+    assert _drain(queue) == ["a0", "b0", "a1", "b1", "a2", "a3"]
+
+
+def test_late_user_starts_at_virtual_time(queue):
+    for i in range(3):
+        _add(queue, f"a{i}", "alice")
+    assert queue._pick_next() == "a0"
+    assert queue._pick_next() == "a1"
+
+    # Virtual time is now 4: a newcomer is tagged 6, level with Alice's last job (FIFO wins)
+    _add(queue, "c0", "carol")
+    assert queue._tags["c0"] == queue._tags["a2"] == 6.0
+    assert _drain(queue) == ["a2", "c0"]
+
+
+def test_anonymous_tasks_are_ordered_by_lane_cost_only(queue):
+    _add(queue, "n0")
+    _add(queue, "n1")
+    assert queue._tags == {"n0": 2.0, "n1": 2.0}
+    assert _drain(queue) == ["n0", "n1"]
+
+
+def test_running_cap_skips_capped_user(queue):
+    queue.max_running_per_user = 1
+    _add(queue, "a0", "alice")
+    _add(queue, "a1", "alice")
+    _add(queue, "b0", "bob", lane="batch")
+
+    queue._user_running["alice"] = 1
+    assert _drain(queue) == ["b0"]
+    queue._user_running["alice"] = 0
+    assert _drain(queue) == ["a0", "a1"]
+
+
+def test_task_max_running_overrides_user_cap(queue):
+    queue.max_running_per_user = 1
+    queue._user_running["alice"] = 1
+    _add(queue, "plain", "alice")
+    _add(queue, "child", "alice", max_running=4)
+
+    assert _drain(queue) == ["child"]
+    assert queue._pending == ["plain"]
+
+
+def test_queue_position(queue):
+    _add(queue, "a0", "alice", lane="batch")
+    _add(queue, "b0", "bob", lane="batch")
+    _add(queue, "c0", "carol", lane="interactive")
+
+    assert [queue._queue_position(t) for t in ("c0", "a0", "b0")] == [1, 2, 3]
+    assert queue._queue_position("unknown") is None
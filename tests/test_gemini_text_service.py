@@ -0,0 +1,136 @@
+import asyncio
+import json
+
+import pytest
+
+from src.interface.types.persona_types import DigitalPersona
+from src.services.gemini_text_service import GeminiTextService, InterpretBusyError
+from src.services.persona_cache import PersonaCache, normalize_text
+
+PERSONA = DigitalPersona(
+    meta={"is_human_realistic": True},
+    profile={"age": 30, "gender": "女", "ethnicity": "East Asian"},
+    body={"body_build": "Slim", "height_vibe": "Average"},
+    look={"hair_style": "bob", "hair_color": "black", "eye_color": "brown", "face_feature": "mole"},
+    skin={"skin_tone": "fair", "skin_texture": "smooth"},
+    style={"clothing": "suit", "expression": "calm", "lighting": "soft"},
+)
+
+
+class _Response:
+    text = PERSONA.model_dump_json()
+
+
+class _NoLimit:
+    async def acquire(self):
+        pass
+
+    def on_success(self):
+        pass
+
+    def on_rate_limited(self, retry_after=None):
+        pass
+
+
+@pytest.fixture
+def text_service(monkeypatch):
+    service = GeminiTextService(cache=PersonaCache())
+    service.rate_limiter = _NoLimit()
+    service.calls = []
+    service.running = service.peak = 0
+
+    async def generate_content(model, contents, config):
+        service.calls.append(contents)
+        service.running += 1
+        service.peak = max(service.peak, service.running)
+        try:
+            await asyncio.sleep(0.01)
+            if "fail" in contents:
+                raise RuntimeError("model error")
+            return _Response()
+        finally:
+            service.running -= 1
+
+    monkeypatch.setattr(service, "_get_config", lambda: None)
+    monkeypatch.setattr(service.client.aio.models, "generate_content", generate_content)
+    return service
+
+
+def test_interpret_returns_the_parsed_persona(text_service):
+    assert asyncio.run(text_service.interpret_persona_async("赛博朋克女孩")) == PERSONA
+    assert text_service.calls == ["User Intent: 赛博朋克女孩"]
+
+
+def test_concurrency_is_capped_and_overflow_rejected(text_service):
+    text_service.max_concurrency = 2
+    text_service.max_waiting = 2
+
+    async def main():
+        return await asyncio.gather(*(text_service.interpret_persona_async(f"text {i}") for i in range(6)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(main())
+    busy = [r for r in results if isinstance(r, InterpretBusyError)]
+    assert len(busy) == 2  # 2 running + 2 waiting fit
+    assert busy[0].retry_after >= 1
+    assert results.count(PERSONA) == 4
+    assert text_service.peak == 2
+
+
+def test_model_errors_propagate(text_service):
+    with pytest.raises(RuntimeError):
+        asyncio.run(text_service.interpret_persona_async("please fail"))
+    assert text_service._waiting == 0
+
+
+def test_identical_interpretations_share_one_call(text_service):
+    async def main():
+        return await asyncio.gather(*(
+            text_service.interpret_persona_async(text)
+            for text in ("赛博朋克 女孩", "赛博朋克女孩。", "赛博朋克女孩", "赛博朋克女孩！")
+        ))
+
+    results = asyncio.run(main())
+    assert results == [PERSONA] * 4
+    assert len(text_service.calls) == 1
+
+    # Later requests are answered from the cache
+    asyncio.run(text_service.interpret_persona_async("赛博朋克女孩"))
+    assert len(text_service.calls) == 1
+    assert text_service.cache.stats()["hits"] == 1
+
+
+def test_shared_failure_reaches_every_waiter_and_is_not_cached(text_service):
+    async def main():
+        return await asyncio.gather(*(text_service.interpret_persona_async("please fail") for _ in range(3)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert len(text_service.calls) == 1
+    assert text_service._inflight == {}
+
+    asyncio.run(main())
+    assert len(text_service.calls) == 2
+
+
+def test_persona_cache_ttl_lru_and_similarity(clock, monkeypatch):
+    import src.services.persona_cache as persona_cache
+
+    monkeypatch.setattr(persona_cache, "time", clock)
+    assert normalize_text(" 赛博朋克 女孩！") == normalize_text("赛博朋克女孩")
+
+    cache = PersonaCache(max_entries=2, ttl=60.0)
+    cache.put("ns", "a", {"v": 1})
+    cache.put("ns", "b", {"v": 2})
+    assert cache.get("ns", "a") == {"v": 1}
+    cache.put("ns", "c", {"v": 3})  # evicts "b", the least recently used
+    assert cache.get("ns", "b") is None
+    assert cache.get("other", "a") is None
+    clock.advance(61)
+    assert cache.get("ns", "a") is None
+
+    fuzzy = PersonaCache(similarity=0.5)
+    fuzzy.put("ns", "a girl in a red dress at night", {"v": 1})
+    assert fuzzy.get("ns", "a girl in a red dress at nite") == {"v": 1}
+    assert fuzzy.stats()["near_hits"] == 1
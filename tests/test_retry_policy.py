@@ -0,0 +1,126 @@
+import asyncio
+import random
+
+import httpx
+import pytest
+
+from src.services import retry_policy
+from src.services.retry_policy import (
+    MAX_DEADLINE_SECONDS,
+    NoImageError,
+    RetryPolicies,
+    RetryPolicy,
+    UpstreamError,
+    classify_error,
+    parse_retry_after,
+)
+
+
+@pytest.fixture(autouse=True)
+def frozen_time(clock, monkeypatch):
+    monkeypatch.setattr(retry_policy, "time", clock)
+    return clock
+
+
+@pytest.mark.parametrize("exc, cause", [
+    (UpstreamError(429), "429"),
+    (UpstreamError(408), "timeout"),
+    (UpstreamError(503), "5xx"),
+    (UpstreamError(400), None),
+    (UpstreamError(403), None),
+    (httpx.ReadTimeout("slow"), "timeout"),
+    (asyncio.TimeoutError(), "timeout"),
+    (httpx.ConnectError("refused"), "network"),
+    (NoImageError("blocked"), None),
+    (ValueError("bad"), None),
+])
+def test_classify_error(exc, cause):
+    assert classify_error(exc) == cause
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+
+
+def test_jitter_stays_within_decorrelated_bounds():
+    random.seed(1234)
+    policy = RetryPolicy(max_attempts=1000, deadline=MAX_DEADLINE_SECONDS, base_delay=2.0, max_delay=20.0)
+    budget = policy.start()
+    previous = policy.base_delay
+    delays = []
+    for _ in range(200):
+        cause, delay = budget.next_retry(UpstreamError(503))
+        assert cause == "5xx"
+        assert policy.base_delay <= delay <= min(policy.max_delay, 3 * previous)
+        previous = delay
+        delays.append(delay)
+    # Actually jittered, and the cap is reached
+    assert len(set(delays)) > 100
+    assert max(delays) > 15.0
+
+
+def test_retry_after_is_a_floor_for_5xx():
+    budget = RetryPolicy(base_delay=1.0, max_delay=2.0, deadline=600).start()
+    assert budget.next_retry(UpstreamError(503, retry_after=30.0)) == ("5xx", 30.0)
+
+
+def test_429_waits_for_retry_after_only():
+    budget = RetryPolicy(base_delay=5.0).start()
+    assert budget.next_retry(UpstreamError(429)) == ("429", 0.0)
+    assert budget.next_retry(UpstreamError(429, retry_after=3.0)) == ("429", 3.0)
+
+
+def test_attempts_are_capped():
+    budget = RetryPolicy(max_attempts=3, base_delay=0.0, max_delay=0.0).start()
+    assert budget.next_retry(UpstreamError(500)) is not None
+    assert budget.next_retry(UpstreamError(500)) is not None
+    assert budget.attempt == 3
+    assert budget.next_retry(UpstreamError(500)) is None
+
+
+def test_permanent_and_unlisted_causes_are_not_retried():
+    budget = RetryPolicy(retry_on=frozenset({"429"})).start()
+    assert budget.next_retry(UpstreamError(400)) is None
+    assert budget.next_retry(UpstreamError(503)) is None
+    assert budget.next_retry(UpstreamError(429)) == ("429", 0.0)
+
+
+def test_deadline_bounds_sleep_and_attempt_timeout(frozen_time):
+    budget = RetryPolicy(deadline=100.0, attempt_timeout=60.0, base_delay=10.0, max_delay=10.0).start()
+    assert budget.attempt_timeout() == 60.0
+
+    frozen_time.advance(70.0)
+    assert budget.remaining() == 30.0
+    assert budget.attempt_timeout() == 30.0
+    assert budget.next_retry(UpstreamError(502)) == ("5xx", 10.0)
+
+    # 10s of back-off wouldn't leave room for the call: give up now
+    frozen_time.advance(21.0)
+    assert budget.next_retry(UpstreamError(502)) is None
+    assert budget.next_retry(UpstreamError(429, retry_after=9.5)) is None
+    assert budget.next_retry(UpstreamError(429, retry_after=5.0)) == ("429", 5.0)
+
+    frozen_time.advance(100.0)
+    assert budget.remaining() == 0.0
+    assert budget.attempt_timeout() == 1.0
+
+
+def test_deadline_is_clamped():
+    assert RetryPolicy(deadline=10 * MAX_DEADLINE_SECONDS).deadline == MAX_DEADLINE_SECONDS
+
+
+def test_spec_overrides(monkeypatch):
+    policy = RetryPolicy().with_spec("attempts=8, deadline=300, retry_on=429|timeout|bogus, nonsense=1, base=x")
+    assert policy.max_attempts == 8
+    assert policy.deadline == 300.0
+    assert policy.retry_on == frozenset({"429", "timeout"})
+    assert policy.base_delay == RetryPolicy().base_delay
+
+    monkeypatch.setenv("RETRY_POLICY_IMAGE_4K", "attempts=9")
+    policies = RetryPolicies.from_env()
+    assert policies.get("image", "4k").max_attempts == 9
+    assert policies.get("image", "4K").deadline == 1500.0  # other keys keep the size default
+    assert policies.get("image", "8K") is policies.get("image", "4K")  # unknown size: most patient
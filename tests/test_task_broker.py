@@ -0,0 +1,134 @@
+import pytest
+
+from src.services import task_broker
+from src.services.task_broker import SQLiteTaskBroker
+
+
+@pytest.fixture
+def broker(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(task_broker, "time", clock)
+    broker = SQLiteTaskBroker(str(tmp_path / "broker.db"), lease_seconds=30.0, flush_interval=60.0)
+    yield broker
+    broker.close()
+
+
+def _record(task_id, user_id=None, **extra):
+    return {"id": task_id, "status": "PENDING", "updated_at": 0.0, "user_id": user_id, **extra}
+
+
+def _claim_all(broker, *args):
+    claimed = []
+    while True:
+        record = broker.claim(*args)
+        if record is None:
+            return claimed
+        claimed.append(record["id"])
+
+
+def test_claim_is_fifo_within_a_user(broker):
+    for i in range(3):
+        broker.enqueue(_record(f"t{i}"))
+
+    assert [broker.position(f"t{i}") for i in range(3)] == [1, 2, 3]
+    assert _claim_all(broker) == ["t0", "t1", "t2"]
+
+
+def test_claim_follows_fair_tags(broker):
+    for i in range(3):
+        broker.enqueue(_record(f"heavy{i}", "heavy"), cost=4)
+    for i in range(2):
+        broker.enqueue(_record(f"light{i}", "light"), cost=1)
+
+    # heavy: 4, 8, 12 / light starts at the head of the queue: 5, 6
+    assert [broker.position(t) for t in ("heavy0", "light0", "light1", "heavy1", "heavy2")] == [1, 2, 3, 4, 5]
+    assert _claim_all(broker) == ["heavy0", "light0", "light1", "heavy1", "heavy2"]
+
+
+def test_claim_marks_processing_and_leases_to_owner(broker, clock):
+    broker.enqueue(_record("t1"))
+    record = broker.claim()
+
+    assert record["status"] == "PROCESSING"
+    assert broker.get("t1")["status"] == "PROCESSING"
+    assert broker.position("t1") is None
+    row = broker._conn.execute("SELECT owner, lease_until FROM tasks WHERE id = 't1'").fetchone()
+    assert row == (broker.owner, clock.now + 30.0)
+    assert broker.claim() is None
+
+
+def test_claim_respects_per_user_cap(broker):
+    for i in range(3):
+        broker.enqueue(_record(f"u{i}", "u"), cost=1)
+    broker.enqueue(_record("anon0"), cost=10)
+    broker.enqueue(_record("anon1"), cost=10)
+
+    # Third task of "u" waits; anonymous tasks are never capped
+    assert _claim_all(broker, 2) == ["u0", "u1", "anon0", "anon1"]
+    assert broker.get("u2")["status"] == "PENDING"
+
+    broker.cancel("u0")
+    assert broker.claim(2)["id"] == "u2"
+
+
+def test_renew_reports_lost_leases(broker):
+    broker.enqueue(_record("mine"))
+    broker.enqueue(_record("theirs"))
+    other = SQLiteTaskBroker(broker.path, lease_seconds=30.0, flush_interval=60.0)
+    try:
+        assert broker.claim()["id"] == "mine"
+        assert other.claim()["id"] == "theirs"
+        assert broker.renew(["mine", "theirs"]) == {"theirs"}
+
+        broker.cancel("mine")
+        assert broker.renew(["mine"]) == {"mine"}
+    finally:
+        other.close()
+
+
+def test_expired_lease_is_requeued(broker, clock):
+    broker.enqueue(_record("t1"))
+    broker.claim()
+
+    clock.advance(29.0)
+    assert broker.requeue_expired() == 0
+    broker.renew(["t1"])
+    clock.advance(29.0)
+    assert broker.requeue_expired() == 0
+
+    clock.advance(2.0)
+    assert broker.requeue_expired() == 1
+    record = broker.get("t1")
+    assert record["status"] == "PENDING"
+    assert record["message"] == "Worker lost, re-queued"
+    assert broker.claim()["id"] == "t1"
+
+
+def test_release_hands_running_tasks_back(broker):
+    broker.enqueue(_record("t1"))
+    broker.enqueue(_record("t2"))
+    broker.claim()
+
+    assert broker.release() == 1
+    assert broker.counts() == {"PENDING": 2}
+
+
+def test_cancelled_row_is_not_reopened_by_owner_writes(broker):
+    broker.enqueue(_record("t1"))
+    record = broker.claim()
+    assert broker.cancel("t1")["status"] == "CANCELLED"
+    assert broker.cancel("t1") is None
+
+    # A progress tick the owner had in flight lands after the remote cancel
+    broker.save({**record, "progress": 50, "message": "Generating"})
+    broker.flush()
+    assert broker.get("t1")["status"] == "CANCELLED"
+    assert broker.count_pending() == 0
+
+
+def test_task_max_running_overrides_the_cap(broker):
+    for i in range(3):
+        broker.enqueue(_record(f"b{i}", "u", max_running=3), cost=1)
+    broker.enqueue(_record("plain", "u"), cost=1)
+
+    assert _claim_all(broker, 2) == ["b0", "b1", "b2"]
+    assert broker.get("plain")["status"] == "PENDING"
@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+import pytest
+
+from src.services.task_dedup import TaskDeduplicator
+from src.services.task_queue import TaskQueue, TaskStatus
+
+
+class FakeQueue:
+    """Just the lookups TaskDeduplicator makes."""
+
+    def __init__(self):
+        self.tasks = {}
+
+    def get_task(self, task_id):
+        return self.tasks.get(task_id)
+
+    async def get_task_async(self, task_id):
+        await asyncio.sleep(0)  # A broker lookup: other requests may run meanwhile
+        return self.get_task(task_id)
+
+    is_terminal = staticmethod(TaskQueue.is_terminal)
+
+    def add(self, task_id, status, updated_at=None):
+        self.tasks[task_id] = {"id": task_id, "status": status, "updated_at": updated_at or time.time()}
+
+
+@pytest.fixture
+def queue():
+    return FakeQueue()
+
+
+@pytest.fixture
+def dedup(queue):
+    return TaskDeduplicator(queue, max_keys=8, result_ttl=300.0)
+
+
+def _submit(dedup, queue, task_id, tx=None, content=None):
+    dedup.remember(task_id, tx, content)
+    queue.add(task_id, TaskStatus.PENDING)
+
+
+def _find(dedup, tx=None, content=None):
+    return asyncio.run(dedup.find(tx, content))
+
+
+IMAGE_B64 = "iVBORw0KGgoAAAANSUhEUg"
+
+
+def test_content_key_canonicalization():
+    meta = {"prompt": "cat", "aspect_ratio": "1:1", "images": [f"data:image/png;base64,{IMAGE_B64}"]}
+    same_bytes = {"aspect_ratio": "1:1", "prompt": "cat", "images": [f"data:image/jpeg;base64,{IMAGE_B64}"]}
+    key = TaskDeduplicator.content_key("generate", meta, "u1")
+
+    assert key.startswith("req:")
+    assert TaskDeduplicator.content_key("generate", same_bytes, "u1") == key
+    assert TaskDeduplicator.content_key("generate", meta, "u2") != key
+    assert TaskDeduplicator.content_key("persona", meta, "u1") != key
+    assert TaskDeduplicator.content_key("generate", {**meta, "prompt": "dog"}, "u1") != key
+
+
+def test_transaction_key():
+    assert TaskDeduplicator.transaction_key("abc", "u1") == "tx:u1:abc"
+    assert TaskDeduplicator.transaction_key("abc", None) == "tx::abc"
+    assert TaskDeduplicator.transaction_key("unknown_1700000000", "u1") is None
+    assert TaskDeduplicator.transaction_key(None, "u1") is None
+
+
+def test_identical_request_coalesces_onto_running_task(dedup, queue):
+    _submit(dedup, queue, "t1", "tx:u:1", "req:a")
+    assert _find(dedup, "tx:u:2", "req:a") == "t1"
+    queue.add("t1", TaskStatus.PROCESSING)
+    assert _find(dedup, None, "req:a") == "t1"
+    assert dedup.coalesced == 2
+
+    # Opted out of content matching (re-roll): a new task
+    assert _find(dedup, "tx:u:3", None) is None
+
+
+def test_transaction_replay_returns_the_original_task(dedup, queue):
+    _submit(dedup, queue, "t1", "tx:u:1", "req:a")
+    queue.add("t1", TaskStatus.COMPLETED, updated_at=time.time() - 3600)
+
+    assert _find(dedup, "tx:u:1", "req:other") == "t1"
+    assert dedup.replayed == 1
+    # Content match is past result_ttl: not reused
+    assert _find(dedup, "tx:u:2", "req:a") is None
+
+
+def test_completed_result_reused_within_ttl(dedup, queue):
+    _submit(dedup, queue, "t1", None, "req:a")
+    queue.add("t1", TaskStatus.COMPLETED)
+    assert _find(dedup, None, "req:a") == "t1"
+    assert dedup.reused_results == 1
+
+    no_reuse = TaskDeduplicator(queue)  # Result reuse is off by default
+    no_reuse.remember("t1", None, "req:a")
+    assert _find(no_reuse, None, "req:a") is None
+
+
+@pytest.mark.parametrize("status", [TaskStatus.FAILED, TaskStatus.CANCELLED, None])
+def test_failed_cancelled_or_expired_tasks_are_forgotten(dedup, queue, status):
+    _submit(dedup, queue, "t1", "tx:u:1", "req:a")
+    if status is None:
+        del queue.tasks["t1"]
+    else:
+        queue.add("t1", status)
+
+    assert _find(dedup, "tx:u:1", "req:a") is None
+    assert dedup.stats()["keys"] == 0
+
+
+def test_keys_are_bounded(dedup, queue):
+    for i in range(10):
+        _submit(dedup, queue, f"t{i}", None, f"req:{i}")
+    assert dedup.stats()["keys"] == 8
+    assert _find(dedup, None, "req:0") is None
+    assert _find(dedup, None, "req:9") == "t9"
+
+
+def test_lookup_redone_when_a_key_is_taken_meanwhile(dedup, queue):
+    _submit(dedup, queue, "old", None, "req:a")
+    queue.add("old", TaskStatus.FAILED)
+
+    async def submit_unless_known(task_id):
+        existing = await dedup.find(None, "req:a")
+        if existing is not None:
+            return existing
+        _submit(dedup, queue, task_id, None, "req:a")
+        return task_id
+
+    async def main():
+        return await asyncio.gather(submit_unless_known("t1"), submit_unless_known("t2"))
+
+    assert asyncio.run(main()) == ["t1", "t1"]
+    assert dedup.coalesced == 1
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from src.services.task_queue import TaskQueue, TaskStatus
+
+IMAGES = ["data:image/png;base64," + "A" * 4096]
+
+
+class RecordingStore:
+    def __init__(self):
+        self.saved = []
+
+    def save(self, record, urgent=False):
+        self.saved.append(record)
+
+
+@pytest.fixture
+def queue():
+    # A private instance with only the fields the store path touches
+    queue = object.__new__(TaskQueue)
+    queue._tasks = {}
+    queue._store = RecordingStore()
+    queue._broker = None
+    queue.spill_bytes = 1024
+    return queue
+
+
+def _add(queue, task_id, metadata):
+    refs = queue._spill({"metadata": metadata})
+    queue._tasks[task_id] = {"id": task_id, "status": TaskStatus.PROCESSING, "result": None,
+                             "metadata": metadata, "metadata_ref": refs.get("metadata")}
+
+
+def test_spilled_metadata_is_not_rewritten_on_save(queue):
+    _add(queue, "t1", {"prompt": "cat", "images": IMAGES})
+    assert queue._tasks["t1"]["metadata_ref"]
+
+    queue._save(dict(queue._tasks["t1"], progress=50))
+    assert queue._store.saved[-1]["metadata"] is None
+    assert queue._store.saved[-1]["metadata_ref"] == queue._tasks["t1"]["metadata_ref"]
+    # The in-memory record is untouched until the task finishes
+    assert queue._tasks["t1"]["metadata"]["images"] == IMAGES
+    assert queue.get_task_details("t1")["metadata"]["images"] == IMAGES
+
+
+def test_small_metadata_stays_inline(queue):
+    _add(queue, "t1", {"prompt": "cat"})
+    queue._save(dict(queue._tasks["t1"]))
+    assert queue._store.saved[-1]["metadata"] == {"prompt": "cat"}
+
+
+def test_offload_drops_spilled_metadata_without_rewriting_it(queue, monkeypatch):
+    _add(queue, "t1", {"prompt": "cat", "images": IMAGES})
+    ref = queue._tasks["t1"]["metadata_ref"]
+    spilled = []
+    monkeypatch.setattr(queue, "_spill", lambda fields: spilled.append(fields) or {})
+
+    asyncio.run(queue._offload_heavy_fields("t1"))
+    assert spilled == []
+    assert queue._tasks["t1"]["metadata"] is None
+    assert queue.get_task_details("t1")["metadata"]["images"] == IMAGES
+    assert queue._tasks["t1"]["metadata_ref"] == ref
@@ -0,0 +1,125 @@
+import asyncio
+import base64
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api_server
+from api_server import _parse_range
+from src.services.blob_store import get_blob_store
+from src.services.input_cache import InputImageCache
+from src.services.input_resolver import InputImageResolver, InputUnavailableError
+from src.services.task_queue import TaskStatus
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4  # 1032 bytes
+
+
+@pytest.fixture
+def etag():
+    return f'"{get_blob_store().put(IMAGE)}"'
+
+
+@pytest.fixture
+def client(monkeypatch, etag):
+    blob_id = etag.strip('"')
+    tasks = {
+        "ref": {"id": "ref", "status": TaskStatus.COMPLETED,
+                "result": {"image_ref": blob_id, "mime_type": "image/png", "content_length": len(IMAGE)}},
+        "datauri": {"id": "datauri", "status": TaskStatus.COMPLETED,
+                    "result": {"image_data": "data:image/jpeg;base64," + base64.b64encode(IMAGE).decode()}},
+        "running": {"id": "running", "status": TaskStatus.PROCESSING, "result": None},
+    }
+    monkeypatch.setattr(api_server.task_queue, "get_task_details", lambda task_id: tasks.get(task_id))
+    return TestClient(api_server.app)
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", (0, 9)),
+    ("bytes=100-", (100, 1031)),
+    ("bytes=1000-5000", (1000, 1031)),
+    ("bytes=-32", (1000, 1031)),
+    ("bytes=-5000", (0, 1031)),
+    ("bytes=0-0,5-9", None),
+    ("items=0-9", None),
+])
+def test_parse_range(header, expected):
+    assert _parse_range(header, 1032) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1032-", "bytes=20-10", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        _parse_range(header, 1032)
+
+
+def test_full_body_with_etag(client, etag):
+    response = client.get("/tasks/ref/result")
+    assert response.status_code == 200
+    assert response.content == IMAGE
+    assert response.headers["etag"] == etag
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-length"] == str(len(IMAGE))
+    assert response.headers["content-type"] == "image/png"
+
+
+def test_range_request(client):
+    response = client.get("/tasks/ref/result", headers={"Range": "bytes=8-15"})
+    assert response.status_code == 206
+    assert response.content == IMAGE[8:16]
+    assert response.headers["content-range"] == f"bytes 8-15/{len(IMAGE)}"
+    assert response.headers["content-length"] == "8"
+
+
+def test_suffix_range(client):
+    response = client.get("/tasks/ref/result", headers={"Range": "bytes=-4"})
+    assert response.status_code == 206
+    assert response.content == IMAGE[-4:]
+
+
+def test_unsatisfiable_range(client):
+    response = client.get("/tasks/ref/result", headers={"Range": f"bytes={len(IMAGE)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(IMAGE)}"
+
+
+def test_if_none_match(client, etag):
+    response = client.get("/tasks/ref/result", headers={"If-None-Match": f'"other", {etag}'})
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+def test_if_range(client, etag):
+    # Same representation: resume; changed one: the whole body again
+    matching = client.get("/tasks/ref/result", headers={"Range": "bytes=0-3", "If-Range": etag})
+    assert matching.status_code == 206
+    assert matching.content == IMAGE[:4]
+
+    stale = client.get("/tasks/ref/result", headers={"Range": "bytes=0-3", "If-Range": '"stale"'})
+    assert stale.status_code == 200
+    assert stale.content == IMAGE
+
+
+def test_datauri_result_is_served_the_same_way(client, etag):
+    response = client.get("/tasks/datauri/result", headers={"Range": "bytes=1-2"})
+    assert response.status_code == 206
+    assert response.content == IMAGE[1:3]
+    assert response.headers["etag"] == etag
+    assert response.headers["content-type"] == "image/jpeg"
+
+
+def test_unfinished_and_unknown_tasks(client):
+    assert client.get("/tasks/running/result").status_code == 409
+    assert client.get("/tasks/nope/result").status_code == 404
+
+
+@pytest.mark.parametrize("ref", ["/tasks/ref/result", "/api/py/tasks/ref/result", "/api/py/tasks/datauri/result?v=1"])
+def test_task_results_resolve_as_inputs(client, ref):
+    resolver = InputImageResolver(cache=InputImageCache())
+    assert asyncio.run(resolver.resolve([ref])) == [IMAGE]
+
+
+@pytest.mark.parametrize("ref", ["/api/py/tasks/running/result", "/api/py/tasks/gone/result", "/no/such/file.png"])
+def test_unresolvable_inputs_fail_the_request(client, ref):
+    resolver = InputImageResolver(cache=InputImageCache())
+    with pytest.raises(InputUnavailableError, match="1 of 2 input images unavailable"):
+        asyncio.run(resolver.resolve(["data:image/png;base64," + base64.b64encode(IMAGE).decode(), ref]))
@@ -0,0 +1,87 @@
+import base64
+import json
+
+import pytest
+
+from src.services.vertex_stream_parser import InlineImageStreamDecoder
+
+IMAGE = bytes(range(256)) * 37 + b"tail"  # 9476 bytes: base64 ends in "=" padding
+
+
+def _body(image=IMAGE, mime="image/png", escape_slashes=False):
+    encoded = base64.b64encode(image).decode("ascii")
+    part = {"inlineData": {"mimeType": mime, "data": encoded}}
+    body = json.dumps({"candidates": [{"content": {"role": "model", "parts": [{"text": "here \"you\" go"}, part]}}]})
+    if escape_slashes:
+        # Some encoders write "/" as "\/" inside strings
+        body = body.replace(encoded, encoded.replace("/", "\\/"))
+    return body.encode("utf-8")
+
+
+def _decode(body, chunk_size):
+    decoder = InlineImageStreamDecoder()
+    for i in range(0, len(body), chunk_size):
+        decoder.feed(body[i:i + chunk_size])
+    return decoder
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5, 7, 13, 4096, 1 << 20])
+@pytest.mark.parametrize("escape_slashes", [False, True])
+def test_decodes_across_any_chunk_boundary(chunk_size, escape_slashes):
+    body = _body(escape_slashes=escape_slashes)
+    decoder = _decode(body, chunk_size)
+
+    assert decoder.complete
+    assert bytes(decoder.result()) == IMAGE
+    assert decoder.mime_type == "image/png"
+    assert decoder.bytes_seen == len(body)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 4, 5])
+def test_unpadded_tail(size):
+    image = b"\xff" * size
+    encoded = base64.b64encode(image).decode("ascii").rstrip("=")
+    body = json.dumps({"candidates": [{"content": {"parts": [{"inlineData": {"data": encoded}}]}}]}).encode()
+
+    assert bytes(_decode(body, 3).result()) == image
+
+
+def test_result_is_the_decoder_buffer():
+    decoder = _decode(_body(), 4096)
+    assert decoder.result() is decoder.result()
+
+
+def test_data_outside_inline_data_is_skipped():
+    decoy = base64.b64encode(b"not the image").decode()
+    body = json.dumps({
+        "data": decoy,
+        "usageMetadata": {"inlineData": {"mimeType": "text/plain", "data": decoy}},
+        "candidates": [{"content": {"parts": [
+            {"data": decoy},
+            {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(IMAGE).decode()}},
+        ]}}],
+    }).encode()
+
+    decoder = _decode(body, 5)
+    assert bytes(decoder.result()) == IMAGE
+    assert decoder.mime_type == "image/png"
+
+
+def test_mime_type_comes_from_the_decoded_part():
+    jpeg = b"\xff\xd8" + b"x" * 100
+    first = {"inlineData": {"data": base64.b64encode(jpeg).decode(), "mimeType": "image/jpeg"}}
+    second = {"inlineData": {"mimeType": "image/png", "data": base64.b64encode(b"png").decode()}}
+    body = json.dumps({"candidates": [{"content": {"parts": [first, second]}}]}).encode()
+
+    decoder = _decode(body, 7)
+    assert bytes(decoder.result()) == jpeg
+    assert decoder.mime_type == "image/jpeg"
+
+
+def test_truncated_or_missing_image_gives_none():
+    body = _body()
+    assert _decode(body[: len(body) // 2], 64).result() is None
+
+    decoder = _decode(json.dumps({"candidates": [{"finishReason": "SAFETY"}]}).encode(), 8)
+    assert not decoder.found
+    assert decoder.result() is None